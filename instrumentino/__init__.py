@@ -14,19 +14,28 @@ from instrumentino import cfg
 from instrumentino.method import ActionsListCtrl
 from instrumentino.sequence import MethodsListCtrl
 from instrumentino.log_graph import LogGraphPanel
+from instrumentino import signal_log
 from instrumentino.action import SysAction, SysActionParamTime,\
     SysActionParamInt
 from instrumentino.controllers.arduino import Arduino, SysVarAnalogArduinoUnipolar,\
     SysVarAnalogArduinoBipolarWithExternalPolarity, SysVarDigitalArduino
 from instrumentino.util import SerialUtil
 from instrumentino.controllers.arduino.pins import AnalogPins, DigitalPins
+from instrumentino.controllers.discovery import ControllerDiscovery
+from threading import Thread
 
 class InstrumentinoApp(wx.App):
     '''
     This class implements the application
     '''
+    # variables are read this often, or at the fastest sampling period the variables declare (see MonitorPeriodMilisec)
     monitorUpdateDelayMilisec = Arduino.cacheReadDelayMilisec
     updateFrequency = 1000 / monitorUpdateDelayMilisec
+    plotRefreshDelayMilisec = 1000 // LogGraphPanel.plotFrameRate
+    # look for the controllers and connect them when starting
+    autoConnect = True
+    # how long closing waits for the controllers that are still being connected
+    connectTimeoutSec = 10
 
     def __init__(self, system):
         self.system = system
@@ -65,13 +74,14 @@ class InstrumentinoApp(wx.App):
         self.mainFrame.Bind(wx.EVT_MENU, self.OnSaveSequence, id=wx.xrc.XRCID('saveSequenceMenuItem'))
         self.mainFrame.Bind(wx.EVT_MENU, self.OnLoadMethod, id=wx.xrc.XRCID('loadMethodMenuItem'))
         self.mainFrame.Bind(wx.EVT_MENU, self.OnSaveMethod, id=wx.xrc.XRCID('saveMethodMenuItem'))
+        self.mainFrame.Bind(wx.EVT_MENU, self.OnReplaySignalLog, id=wx.xrc.XRCID('replaySignalLogMenuItem'))
         self.mainFrame.Bind(wx.EVT_MENU, self.OnClose, id=wx.xrc.XRCID('quitMenuItem'))
         self.mainFrame.Bind(wx.EVT_MENU, self.OnAbout, id=wx.xrc.XRCID('aboutMenuItem'))
         
         menusDict = dict(self.mainFrame.GetMenuBar().GetMenus())
         commMenu = [key for key, value in menusDict.iteritems() if value == 'Comm'][0]
         for comp in self.sysComps:
-            cfg.AddControllerIfNeeded(comp.controllerClass)
+            cfg.AddControllerIfNeeded(comp.controllerClass, comp.controllerId)
         
         for controller in cfg.controllers:
             menu = commMenu.Append(-1, controller.name, 'Connect the ' + controller.name)
@@ -123,14 +133,37 @@ class InstrumentinoApp(wx.App):
         # Monitor periodically
         self.timer = wx.Timer(self)
         self.Bind(wx.EVT_TIMER, self.MonitorUpdate, self.timer)
-        self.timer.Start(self.monitorUpdateDelayMilisec)
+        self.timer.Start(self.MonitorPeriodMilisec())
+        
+        # Plot periodically, at the plot's own rate
+        self.plotTimer = wx.Timer(self)
+        self.Bind(wx.EVT_TIMER, self.PlotUpdate, self.plotTimer)
+        self.plotTimer.Start(self.plotRefreshDelayMilisec)
+        
+        # Show the logged lines in batches
+        self.logViewTimer = wx.Timer(self)
+        self.Bind(wx.EVT_TIMER, self.LogViewUpdate, self.logViewTimer)
+        self.logViewTimer.Start(cfg.logViewRefreshMilisec)
+        
+        self.connectThread = None
+        if self.autoConnect:
+            self.connectThread = Thread(target=self.AutoConnect)
+            self.connectThread.daemon = True
+            self.connectThread.start()
+    
+    def AutoConnect(self):
+        '''
+        Find the controllers' ports and connect them all in parallel. Controllers that aren't found can be connected from the Comm menu.
+        '''
+        ControllerDiscovery(cfg.controllers, self.system.controllerPorts).ConnectAll(lambda controller: cfg.UpdateControlsFromOtherThread())
         
     def OnLogUpdate(self, event):
         '''
         Update log
         '''
         (text, critical) = event.data
-        cfg.Log(text)
+        # the event is already logged. Show it before the message.
+        cfg.FlushLogView()
         if critical:
             dlg = wx.MessageDialog(self.mainFrame,
                                text,
@@ -178,7 +211,7 @@ class InstrumentinoApp(wx.App):
         self.stopButton.Enable(cfg.AllOnline() and runningOperation)
         
         cfg.logTextCtrl.Enable(cfg.AllOnline())
-        cfg.logGraph.Enable(cfg.AllOnline())
+        cfg.logGraph.Enable(cfg.AllOnline() or cfg.logGraph.replay != None)
     
     def OnLoadSequence(self, event):
         '''
@@ -204,6 +237,36 @@ class InstrumentinoApp(wx.App):
         '''
         self.saveFile(event, "Save method as ...", cfg.methodWildcard, '.mtd', self.actionsListCtrl)
             
+    def OnReplaySignalLog(self, event):
+        '''
+        Replay a recorded signal log in the graph
+        '''
+        if any(controller.online for controller in cfg.controllers):
+            errDlg = wx.MessageDialog(self.mainFrame, 'Disconnect the controllers to replay a signal log',
+                                      'Error',
+                                      wx.OK | wx.ICON_ERROR)
+            errDlg.ShowModal()
+            errDlg.Destroy()
+            return
+        
+        dlg = wx.FileDialog(self.mainFrame, message="Choose a signal log", defaultDir=cfg.LogPath(),
+                            defaultFile="", wildcard=cfg.signalLogWildcard,
+                            style=wx.OPEN)
+
+        if dlg.ShowModal() == wx.ID_OK:
+            try:
+                self.logGraph.StartReplay(signal_log.OpenSignalLog(dlg.GetPath()))
+                self.logGraph.Enable(True)
+                wx.xrc.XRCCTRL(self.mainFrame, 'log').SetSelection(1)
+            except (IOError, ValueError, IndexError):
+                errDlg = wx.MessageDialog(self.mainFrame, 'Error loading the signal log',
+                                          'Error',
+                                          wx.OK | wx.ICON_ERROR)
+                errDlg.ShowModal()
+                errDlg.Destroy()
+        
+        dlg.Destroy()
+    
     def loadFile(self, event, message, wildcard, listCtrl):
         '''
         File loading helper function
@@ -271,15 +334,22 @@ class InstrumentinoApp(wx.App):
         if result == wx.ID_OK:
             cfg.userStopped = True
             self.timer.Stop()
-            
-            if cfg.commandsLogFile != None:
-                cfg.commandsLogFile.close()
+            self.plotTimer.Stop()
+            self.logViewTimer.Stop()
             
             cfg.logGraph.StopUpdates()
             if cfg.signalsLogFile != None:
                 cfg.signalsLogFile.close()
                 
+            # the controllers (and their threads) may log while they close, so the commands' log is closed last
+            if self.connectThread != None:
+                self.connectThread.join(self.connectTimeoutSec)
             cfg.Close()
+            
+            if cfg.commandsLogFile != None:
+                commandsLogFile = cfg.commandsLogFile
+                cfg.commandsLogFile = None
+                commandsLogFile.close()
 
             self.mainFrame.Destroy()
 
@@ -332,6 +402,16 @@ class InstrumentinoApp(wx.App):
         # Then we call wx.AboutBox giving it that info object
         wx.AboutBox(info)
 
+    def MonitorPeriodMilisec(self):
+        '''
+        Get how often the variables are read into the graph and the signal log.
+        Variables may declare their own sampling period (e.g. SysVarAnalogArduino's samplePeriodSec), so the monitor keeps up with the fastest one
+        and no sample is skipped. It isn't faster than the Arduino's acquisition tick, since pins aren't read more often than that.
+        '''
+        periods = [var.samplePeriodSec * 1000 for comp in self.sysComps for var in comp.vars.values()
+                   if getattr(var, 'samplePeriodSec', None) != None]
+        return int(max(Arduino.pollTickMilisec, min([self.monitorUpdateDelayMilisec] + periods)))
+    
     def MonitorUpdate(self, event):
         '''
         Read system variables' values from controllers
@@ -342,6 +422,20 @@ class InstrumentinoApp(wx.App):
         
         if cfg.AllOnline():
             self.logGraph.FinishUpdate()
+        
+        cfg.CheckLogWriters()
+    
+    def PlotUpdate(self, event):
+        '''
+        Show the new data on the graph
+        '''
+        self.logGraph.RefreshPlot()
+    
+    def LogViewUpdate(self, event):
+        '''
+        Show the newly logged lines
+        '''
+        cfg.FlushLogView()
             
 
 class SavedFile(object):
@@ -357,8 +451,13 @@ class Instrument():
     '''
     an instrument parent class
     '''
-    def __init__(self, comps, actions, version='1.0', name='Instrument', description='Instrument\'s description'):
+    def __init__(self, comps, actions, version='1.0', name='Instrument', description='Instrument\'s description', controllerPorts=None):
+        '''
+        controllerPorts - optional. For each controller name (e.g. 'Arduino HV'), the port name or the USB serial number of its board.
+                          Use it to tell apart several boards of the same kind.
+        '''
         self.comps = comps
+        self.controllerPorts = controllerPorts if controllerPorts != None else {}
         self.actions = actions
         self.version = version
         self.name = name
@@ -6,6 +6,8 @@ import sys
 from pkg_resources import resource_filename
 import wx
 import threading
+from collections import deque
+from instrumentino.util import AsyncFileWriter
 
 __author__ = 'yoelk'
 
@@ -20,6 +22,21 @@ numStringFormat = '{:' + str(numIntegerPartWidth) + '.' + str(numFractionPartWid
 # Files handeled
 methodWildcard = 'Method file (*.mtd)|*.mtd'
 sequenceWildcard = 'Sequence file (*.seq)|*.seq'
+signalLogWildcard = 'Signal log (*.isig;*.csv)|*.isig;*.csv'
+# the format of the signal log: 'csv', or 'binary' for a compact file that can be read straight into NumPy arrays (see signal_log)
+signalsLogFormat = 'csv'
+# also keep the signals in an SQLite database, which can be queried by variable and time range (see signal_store)
+signalsStore = False
+# the logs are written by background threads (see util.AsyncFileWriter). Data reaches the disk after logFlushIntervalSec,
+# after logFlushBytes, or right after critical events. With logFsync, flushes also wait for the disk.
+logFlushIntervalSec = 1
+logFlushBytes = 1024*1024
+logFsync = False
+logMaxQueuedBytes = 16*1024*1024
+# the commands' view shows the last logViewLines lines (the whole log is in the commands' file).
+# Logged lines are added to it in batches, every logViewRefreshMilisec.
+logViewLines = 1000
+logViewRefreshMilisec = 200
 
 # Events handeled by the main window
 EVT_LOG_UPDATE = wx.NewId()
@@ -35,6 +52,12 @@ logTextCtrl = None
 logGraph = None
 commandsLogFile = None
 signalsLogFile = None
+logWriters = []
+reportedLogWritersStats = {}
+logViewLock = threading.Lock()
+pendingLogLines = []
+shownLogLines = deque()
+logViewLineCount = 0
 systemUid = None
 
 controllers = []
@@ -54,6 +77,9 @@ def InitVariables(arguApp):
     logTextCtrl = wx.xrc.XRCCTRL(arguApp.mainFrame, 'logTextCtrl')
     logTextCtrl.SetEditable(False)
     
+    global shownLogLines
+    shownLogLines = deque(maxlen=logViewLines)
+    
     global logGraph
     logGraph = arguApp.logGraph
     
@@ -61,25 +87,26 @@ def InitVariables(arguApp):
     timeNow = datetime.now().strftime('%Y_%m_%d-%H_%M_%S')
     
     global commandsLogFile
-    commandsLogFile = open(LogPath(timeNow + '.txt'), 'w')
+    commandsLogFile = OpenLogFile(timeNow + '.txt')
     
     global signalsLogFile
-    signalsLogFile = open(LogPath(timeNow + '.csv'), 'w')
+    if signalsLogFormat == 'csv':
+        signalsLogFile = OpenLogFile(timeNow + '.csv')
     
     global systemUid
     systemUid = arguApp.system.GetSystemUid()
 
-def AddControllerIfNeeded(controllerClass):
+def AddControllerIfNeeded(controllerClass, controllerId=None):
     '''
     add a controller to the needed controllers list, only if it doesn't exist already
+    controllerId - identifies the controller, when there are several of the same class
     '''
     global controllers
-    for c in controllers:
-        if isinstance(c, controllerClass):
-            return
+    if GetController(controllerClass, controllerId) != None:
+        return
         
     # if reached here, add an object of the given class
-    controllers += [controllerClass()]
+    controllers += [controllerClass(controllerId) if controllerId != None else controllerClass()]
 
 def Close():
     global controllers
@@ -102,21 +129,20 @@ def IsCompOnline(sysComp):
     '''
     check if the controller of a component is online
     '''
-    global controllers
-    for c in controllers:
-        if isinstance(c, sysComp.controllerClass):
-            return c.online
+    controller = GetController(sysComp.controllerClass, sysComp.controllerId)
+    if controller != None:
+        return controller.online
         
     # if reached here, it's not online
     return False
 
-def GetController(controllerClass):
+def GetController(controllerClass, controllerId=None):
     '''
-    return the active controller instance of this class
+    return the active controller instance of this class (and id)
     '''
     global controllers
     for c in controllers:
-        if isinstance(c, controllerClass):
+        if isinstance(c, controllerClass) and getattr(c, 'controllerId', None) == controllerId:
             return c
         
     # if reached here, no controller exists
@@ -165,24 +191,83 @@ def LogPath(relativePath=''):
     '''
     return GetOrCreateDirectory('log') + relativePath
     
-def Log(text):
+def OpenLogFile(relativePath, mode='wb'):
     '''
-    Log an event
+    Open a file in the log directory, to be written in the background (see AsyncFileWriter).
+    The data is written as is, so line breaks should be given explicitly.
+    '''
+    global logWriters
+    writer = AsyncFileWriter(open(LogPath(relativePath), mode), logMaxQueuedBytes,
+                             flushIntervalSec=logFlushIntervalSec, flushBytes=logFlushBytes, fsync=logFsync)
+    logWriters.append(writer)
+    return writer
+
+def CheckLogWriters():
+    '''
+    Report when writing the logs falls behind (data was dropped because the disk is too slow, full or gone), or fails.
+    The writers are the log files (see OpenLogFile), and other writers added to logWriters (e.g. signal_store.SignalStoreWriter)
+    '''
+    global logWriters
+    global reportedLogWritersStats
+    for writer in logWriters:
+        stats = writer.Stats()
+        reported = reportedLogWritersStats.get(writer, {'dropped': 0, 'errors': 0})
+        if stats['dropped'] > reported['dropped']:
+            Log('Warning: the disk is too slow. %d writes to %s were dropped so far (slowest write: %.1f sec)' %
+                (stats['dropped'], os.path.basename(writer.name), stats['maxWriteSec']))
+        if stats['errors'] > reported['errors']:
+            Log('Warning: writing %s failed (%s)' % (os.path.basename(writer.name), stats['lastError']))
+        reportedLogWritersStats[writer] = stats
+
+def Log(text, critical=False):
+    '''
+    Log an event. It can be called from any thread: the line is written to the commands' file,
+    and shown in the commands' view on its next refresh (see FlushLogView).
+    Once the commands' file is closed (the application is closing), the line is only shown.
+    critical - make sure the log reaches the disk
     '''
-    global logTextCtrl
     global commandsLogFile
+    global pendingLogLines
+    
+    logFile = commandsLogFile
+    if logFile != None and not logFile.closed:
+        logFile.write(text + '\r')
+        if critical:
+            logFile.Sync()
+    with logViewLock:
+        pendingLogLines.append(text)
+
+def FlushLogView():
+    '''
+    Show the lines logged since the last call in the commands' view, all at once.
+    Called periodically by the GUI thread (see logViewRefreshMilisec).
+    The view keeps the last logViewLines lines. Older lines are removed in batches, so the view isn't rewritten on every call.
+    '''
+    global pendingLogLines
+    global logViewLineCount
+    with logViewLock:
+        lines, pendingLogLines = pendingLogLines, []
+    if len(lines) == 0 or logTextCtrl == None:
+        return
     
-    if logTextCtrl != None:
-        logTextCtrl.WriteText(text + '\r')
-    if commandsLogFile != None:
-        commandsLogFile.write(text + '\r')
+    shownLogLines.extend(lines)
+    logViewLineCount += len(lines)
+    if logViewLineCount > logViewLines + logViewLines // 10:
+        logTextCtrl.ChangeValue(''.join(line + '\r' for line in shownLogLines))
+        logTextCtrl.ShowPosition(logTextCtrl.GetLastPosition())
+        logViewLineCount = len(shownLogLines)
+    else:
+        logTextCtrl.AppendText(''.join(line + '\r' for line in lines))
         
 def LogFromOtherThread(text, critical=False):
     '''
     Log an event while running a method/sequence
+    critical - also show the event in an error message
     '''
     global mainFrame
-    wx.PostEvent(mainFrame, ResultEvent(EVT_LOG_UPDATE, (text, critical)))
+    Log(text, critical)
+    if critical:
+        wx.PostEvent(mainFrame, ResultEvent(EVT_LOG_UPDATE, (text, critical)))
 
 def UpdateControlsFromOtherThread(runningOperation=False):
     '''
@@ -17,11 +17,14 @@ class SysVar(object):
     - GetFunc()        -    read the value of the variable from the hardware
     - SetFunc(value)   -    Set the value of the variable in the hardware
     - OnEdit(event)    -    called when the display panel of the variable is edited
+    - GetSampleTime()  -    (optional) when the hardware acquired the value last returned by GetFunc
     '''
     def __init__(self, name, controllerClass, compName='', helpLine='', editable=True, PreSetFunc=None, PostGetFunc=None, showInSignalLog=True):
         self.name = name
         self.compName = compName
         self.controllerClass = controllerClass
+        # the id of the controller, when there are several of the same class (see SysComp.SetControllerId)
+        self.controllerId = None
         self.helpLine = helpLine
         self.editable = editable
         self.widget = None
@@ -38,6 +41,14 @@ class SysVar(object):
             self.PostGetFunc(value)
         return value
     
+    def GetSampleTime(self):
+        '''
+        Sub-classes should implement this if their controller knows when values were acquired
+        
+        Returns: the acquisition time of the value last returned by Get (seconds since the epoch), or None if it isn't known
+        '''
+        return None
+    
     def Set(self, value):
         '''
         Call the sub-class' SetFunc()
@@ -51,7 +62,7 @@ class SysVar(object):
         value = self.Get()
         self.UpdatePanel(value)
         if self.showInSignalLog:
-            cfg.logGraph.AddData(self.FullName(), value)
+            cfg.logGraph.AddData(self.FullName(), value, self.GetSampleTime())
             
     def FullName(self):
         unitsStr = ' (' + self.units + ')' if hasattr(self, 'units') else ''
@@ -62,7 +73,7 @@ class SysVar(object):
         '''
         Get the working instance of the appropriate controller
         '''
-        return cfg.GetController(self.controllerClass)
+        return cfg.GetController(self.controllerClass, self.controllerId)
 
 class SysVarAnalog(SysVar):
     '''
@@ -184,11 +195,25 @@ class SysComp(object):
     def __init__(self, name, vars, controllerClass, helpLine=''):
         self.name = name
         self.controllerClass = controllerClass
+        self.controllerId = None
         self.helpLine = helpLine
         self.vars = OrderedDict([(var.name, var) for var in vars])
         self.panel = None
         self.online = False
         
+    def SetControllerId(self, controllerId):
+        '''
+        Use a specific controller, when the system has several controllers of the same class (e.g. several Arduino boards).
+        Each id gets its own controller instance.
+        
+        Returns: the component itself, so it can be used in the system's definition 
+        '''
+        self.controllerId = controllerId
+        # variables that aren't shown on the panel are kept as attributes of the component
+        for var in self.vars.values() + [attr for attr in self.__dict__.values() if isinstance(attr, SysVar)]:
+            var.controllerId = controllerId
+        return self
+        
     def CreatePanel(self, parent):
         '''
         Create a panel for the component, based on its variables
@@ -239,4 +264,4 @@ class SysComp(object):
         '''
         Get the working instance of the appropriate controller
         '''
-        return cfg.GetController(self.controllerClass)
\ No newline at end of file
+        return cfg.GetController(self.controllerClass, self.controllerId)
\ No newline at end of file
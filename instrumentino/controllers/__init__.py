@@ -10,12 +10,16 @@ class InstrumentinoController(object):
     '''
     base class for instrumentino compatible controllers
     '''
+    # USB vendor ids of the controller's boards. Controllers that have them are discovered automatically (see discovery)
+    usbVendorIds = None
     
-    def __init__(self, name):
+    def __init__(self, name, controllerId=None):
         '''
         init
+        controllerId - identifies the controller, when there are several of the same class
         '''
-        self.name = name
+        self.controllerId = controllerId
+        self.name = name if controllerId == None else '%s %s'%(name, controllerId)
         self.online = False
         
     def __str__(self):
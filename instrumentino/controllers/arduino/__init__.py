@@ -5,10 +5,270 @@ from exceptions import ValueError
 __author__ = 'yoelk'
 
 from instrumentino import cfg
-import wx
 import serial
 import time
-from threading import Semaphore
+import struct
+import math
+import itertools
+from StringIO import StringIO
+from Queue import PriorityQueue, Empty
+from threading import Lock, Thread, Event, current_thread, local
+from contextlib import contextmanager
+from instrumentino.util import monotonic, RingBuffer
+import numpy as np
+
+class ArduinoBinaryProtocol(object):
+    '''
+    The host side of the binary framed protocol of the controlino sketch.
+
+    Every frame (in both directions) looks like this:
+    SYNC (1 byte) | payload length (2 bytes) | payload | CRC-16/CCITT of the length and payload fields (2 bytes)
+    All multi-byte fields are little-endian.
+
+    A command payload is a sequence number byte, an opcode byte and the packed arguments of the command.
+    A reply payload is the sequence number of its command, a status byte (STATUS_DONE for success) and the packed results.
+    Sequence numbers let several commands be in flight at once, and let late replies of timed-out commands be told apart.
+    Replies to 'Read' carry the Arduino's time when the pins were sampled (32-bit, in microseconds) and one 16-bit value per requested pin,
+    in the requested order. A 'Read' of no pins just returns the time (see ArduinoClock).
+    A 'Batch' payload holds several commands (without sequence numbers), each prefixed by its length (1 byte).
+    It's acknowledged by a single reply.
+    
+    While streaming, the Arduino also pushes frames by itself. Their payload starts with STREAM_BLOCK instead of a sequence number,
+    followed by samples. Each sample is a 32-bit timestamp (in microseconds, on the Arduino's clock) and a 16-bit value per streamed pin. 
+
+    Commands are given in the same text form used by the ASCII protocol (e.g. 'Write 3 digi 1'),
+    so the ASCII protocol can always be used as a fallback.
+    '''
+    SYNC = 0xA5
+    STATUS_DONE = 0
+    STREAM_BLOCK = 0x80
+    # sequence numbers are always below STREAM_BLOCK 
+    SEQUENCE_MODULO = 0x80
+
+    # argument types:
+    # B/H/I - unsigned 8/16/32-bit integer
+    # f     - 32-bit float
+    # E     - a keyword, sent as a byte (see keywords)
+    # P     - a list of pins (e.g. A0 D3), sent as a byte each. Analog pins have the highest bit set
+    # V     - a list of values, sent as a byte each
+    # W     - a list of values, sent as 16-bit integers
+    # S     - the rest of the command, sent as is
+    commands = {'Read':           (0x01, 'P'),
+                'Write':          (0x02, 'BEH'),
+                'Set':            (0x03, 'BE'),
+                'SetPwmFreq':     (0x04, 'BB'),
+                'PidRelayCreate': (0x05, 'BBBIfff'),
+                'PidRelaySet':    (0x06, 'BH'),
+                'PidRelayTune':   (0x07, 'Bfff'),
+                'PidRelayEnable': (0x08, 'BB'),
+                'HardSerConnect': (0x09, 'IB'),
+                'SoftSerConnect': (0x0A, 'BBIB'),
+                'SerSend':        (0x0B, 'EBS'),
+                'SerReceive':     (0x0C, 'EB'),
+                'Reset':          (0x0D, ''),
+                'BlinkPin':       (0x0E, 'BH'),
+                'I2cWrite':       (0x0F, 'BV'),
+                'SpiWrite':       (0x10, 'BV'),
+                'Protocol':       (0x11, 'E'),
+                'StreamStart':    (0x12, 'IP'),
+                'StreamStop':     (0x13, ''),
+                'Batch':          (0x14, ''),
+                'WaveLoad':       (0x15, 'HW'),
+                'WavePlay':       (0x16, 'EBHIHH'),
+                'WaveStop':       (0x17, '')}
+
+    keywords = {'digi': 0, 'anal': 1,
+                'in': 0, 'out': 1,
+                'hard': 0, 'soft': 1,
+                'ascii': 0, 'binary': 1,
+                'pwm': 0, 'spi': 1, 'i2c': 2}
+
+    ANALOG_PIN_FLAG = 0x80
+
+    def __init__(self):
+        self.crcTable = self._CreateCrcTable()
+        # called with the data of every stream block that arrives
+        self.streamHandler = None
+
+    def _CreateCrcTable(self):
+        '''
+        Prepare a lookup table for the CRC-16/CCITT calculation (polynomial 0x1021)
+        '''
+        table = []
+        for byte in range(256):
+            crc = byte << 8
+            for _ in range(8):
+                crc = ((crc << 1) ^ 0x1021) if crc & 0x8000 else (crc << 1)
+            table.append(crc & 0xFFFF)
+        return table
+
+    def Crc(self, data):
+        '''
+        Calculate the CRC-16/CCITT (initial value 0xFFFF) of data
+        '''
+        crc = 0xFFFF
+        for byte in bytearray(data):
+            crc = ((crc << 8) & 0xFFFF) ^ self.crcTable[(crc >> 8) ^ byte]
+        return crc
+
+    def EncodeFrame(self, payload):
+        '''
+        Wrap a payload in a frame
+        '''
+        body = struct.pack('<H', len(payload)) + payload
+        return struct.pack('<B', self.SYNC) + body + struct.pack('<H', self.Crc(body))
+
+    def EncodePins(self, pins):
+        '''
+        Pack a list of pin names (e.g. ['A0', 'D3'])
+        '''
+        return struct.pack('<%dB'%len(pins), *[(self.ANALOG_PIN_FLAG if pin[0] == 'A' else 0) | int(pin[1:]) for pin in pins])
+
+    def EncodeCommand(self, txData, sequence=0):
+        '''
+        Translate a text command (e.g. 'Write 3 digi 1') to a binary frame
+        sequence - the sequence number of the command
+        '''
+        return self.EncodeFrame(struct.pack('<B', sequence) + self.EncodePayload(txData))
+
+    def EncodeBatch(self, txDataList, sequence=0):
+        '''
+        Translate a list of text commands to a single 'Batch' frame
+        sequence - the sequence number of the batch
+        '''
+        payload = struct.pack('<BB', sequence, self.commands['Batch'][0])
+        for txData in txDataList:
+            commandPayload = self.EncodePayload(txData)
+            payload += struct.pack('<B', len(commandPayload)) + commandPayload
+        return self.EncodeFrame(payload)
+
+    def EncodePayload(self, txData):
+        '''
+        Translate a text command to its opcode and arguments
+        '''
+        name, _, args = txData.partition(' ')
+        opcode, argTypes = self.commands[name]
+        args = args.split(' ', len(argTypes) - 1) if args != '' else []
+        payload = struct.pack('<B', opcode)
+        for argType, arg in zip(argTypes, args):
+            if argType == 'E':
+                payload += struct.pack('<B', self.keywords[arg])
+            elif argType == 'P':
+                payload += self.EncodePins(arg.split())
+            elif argType == 'V':
+                values = [int(float(value)) for value in arg.split()]
+                payload += struct.pack('<%dB'%len(values), *values)
+            elif argType == 'W':
+                values = [int(float(value)) for value in arg.split()]
+                payload += struct.pack('<%dH'%len(values), *values)
+            elif argType == 'S':
+                payload += arg
+            elif argType == 'f':
+                payload += struct.pack('<f', float(arg))
+            else:
+                payload += struct.pack('<' + argType, int(float(arg)))
+        return payload
+
+    def ReadFrame(self, port):
+        '''
+        Read a single frame from port
+
+        Returns: the frame's payload, or None if no valid frame arrived in time
+        '''
+        # look for the beginning of a frame
+        while True:
+            sync = port.read(1)
+            if len(sync) == 0:
+                return None
+            if ord(sync) == self.SYNC:
+                break
+
+        length = port.read(2)
+        if len(length) < 2:
+            return None
+        payload = port.read(struct.unpack('<H', length)[0])
+        crc = port.read(2)
+        if len(crc) < 2 or struct.unpack('<H', crc)[0] != self.Crc(length + payload):
+            return None
+        return payload
+
+    def ReadReply(self, port, sequence=0):
+        '''
+        Read the reply for a command. Replies to other commands (which have timed out) are dropped.
+        sequence - the sequence number of the command
+
+        Returns: the reply data, or None if the command failed or no valid reply arrived
+        '''
+        # other frames keep arriving while streaming, so the port's timeout alone isn't enough
+        deadline = monotonic() + port.timeout
+        while True:
+            reply = self.ReadTaggedReply(port, deadline)
+            if reply == None:
+                return None
+            if reply[0] == sequence:
+                return reply[1]
+
+    def ReadTaggedReply(self, port, deadline=None):
+        '''
+        Read the next reply, whichever command it belongs to
+        deadline - stop waiting at this time (see util.monotonic)
+
+        Returns: (the sequence number of the command, the reply data or None if the command failed), or None if no valid reply arrived
+        '''
+        while True:
+            if deadline != None and monotonic() > deadline:
+                return None
+            payload = self.ReadFrame(port)
+            if payload == None or len(payload) == 0:
+                return None
+            if ord(payload[0]) != self.STREAM_BLOCK:
+                break
+            self._handleStreamBlock(payload)
+
+        if len(payload) < 2:
+            return None
+        sequence = ord(payload[0])
+        if ord(payload[1]) != self.STATUS_DONE:
+            return sequence, None
+        return sequence, payload[2:]
+
+    def ReadStreamBlocks(self, port):
+        '''
+        Read the stream blocks pushed by the Arduino, until no more data is waiting
+        '''
+        payload = self.ReadFrame(port)
+        while payload != None:
+            if len(payload) > 0 and ord(payload[0]) == self.STREAM_BLOCK:
+                self._handleStreamBlock(payload)
+            if port.inWaiting() == 0:
+                break
+            payload = self.ReadFrame(port)
+    
+    def _handleStreamBlock(self, payload):
+        '''
+        Pass the data of a stream block to the stream handler
+        '''
+        if self.streamHandler != None:
+            self.streamHandler(payload[1:])
+
+    def DecodeStreamBlock(self, data, pinsNum):
+        '''
+        Unpack the samples of a stream block
+        
+        Returns: (the Arduino's timestamps in microseconds, an array with a row of values for each sample)
+        '''
+        sampleType = np.dtype([('time', '<u4'), ('values', '<u2', (pinsNum,))])
+        samples = np.frombuffer(data, sampleType)
+        return samples['time'], samples['values'].reshape(len(samples), pinsNum)
+
+    def DecodeValues(self, data):
+        '''
+        Unpack the reply to a 'Read' command
+        
+        Returns: (the Arduino's time in microseconds when the pins were sampled, the values)
+        '''
+        return struct.unpack('<I', data[:4])[0], struct.unpack('<%dH'%((len(data) - 4) // 2), data[4:])
+
 
 class Arduino(InstrumentinoController):
     '''
@@ -39,24 +299,97 @@ class Arduino(InstrumentinoController):
     baudrate                = 115200
     serialTimeoutSec        = 0.05
     serialWriteTimeoutSec   = 0
+    # reply timeouts are adapted to the measured round-trip time of each command, within these limits
+    serialMinTimeoutSec     = 0.005
+    serialMaxTimeoutSec     = 1
     # the read delay should to at least twice the time for a single read, so there's also time to write
+    # this is the default sampling period of pins. Pins may have their own (see SetAnalogSamplePeriod)
     cacheReadDelayMilisec = max(250, (serialTimeoutSec + serialWriteTimeoutSec)*1000*2)
+    # the acquisition thread checks which pins are due for reading this often
+    pollTickMilisec = 10
     
     maxNonResponseAllowed = 10
     
-    pinValuesCache = {}
-    timer = None
+    # callers give up on a queued command after this long (e.g. if the acquisition thread is stuck)
+    commandTimeoutSec = 60
+    
+    # the Arduino restarts when the port is opened. It's polled until it answers, for up to this long.
+    bootTimeoutSec = 4
+    # time for devices on the Arduino's serial ports to get ready after connecting them (see HardSerConnect)
+    serialConnectSettleSec = 0
+    
+    # Arduino boards and common USB-serial chips (Arduino, Arduino.org, CH340, FTDI, CP210x)
+    usbVendorIds = (0x2341, 0x2A03, 0x1A86, 0x0403, 0x10C4)
+    
+    # try to switch to the binary protocol when connecting. The ASCII protocol is used if the sketch doesn't support it
+    useBinaryProtocol = True
+    
+    # streamed pins are kept in a ring buffer of this size, and the stream is checked this often for new samples
+    streamBufferSamples = 2**16
+    streamPollSec = 0.01
+    
+    # waveforms are kept in the Arduino's (small) RAM, and uploaded in chunks (see PlayWaveform)
+    waveformMaxSamples = 256
+    waveformChunkSamples = 16
+    
+    # when no pins are read, the Arduino's clock is still read this often, to keep track of its offset (see ArduinoClock)
+    clockSyncSec = 1
+    
+    # while waiting for a reply from a device on a serial port, the data it sent is collected this often (see SerSendAsync)
+    serialPollSec = 0.1
+    
+    # command priorities (lower values are executed first)
+    PRIORITY_WRITE      = 0
+    PRIORITY_COMMAND    = 1
+    PRIORITY_READ       = 2
+    
+    # how many pipelined commands may wait for their replies at once (see Pipeline).
+    # The commands in flight should also fit in the Arduino's serial receive buffer, or they'd be lost.
+    maxCommandsInFlight = 8
+    maxBytesInFlight = 64
+    # pipelined commands that may be sent again when their reply is missing (executing them twice does no harm)
+    resendableCommands = ('Read',)
+    
+    acquisitionThread = None
     
     name = 'Arduino'
     
-    def __init__(self):
+    def __init__(self, controllerId=None):
         '''
-        init 
+        init
+        controllerId - identifies the board, when there are several. Each board has its own pin cache and acquisition thread. 
         '''
-        InstrumentinoController.__init__(self, self.name)
-        self.accessSemaphore = Semaphore()
+        InstrumentinoController.__init__(self, self.name, controllerId)
+        self.pinValuesCache = {}
+        self.pinTimesCache = {}
+        self.clock = ArduinoClock()
+        self.clockSyncPending = False
+        self.nextClockSync = 0
+        self.commandQueue = PriorityQueue()
+        self.commandQueueLock = Lock()
+        self.commandCounter = itertools.count()
+        self.cacheUpdatePending = False
+        self.ResetCommandQueueStats()
+        self.cacheLock = Lock()
+        self.cacheUpdateTime = None
+        self.pinSchedules = {}
         self.serial = None
         self.nonResponsiveCounter = 0
+        self.protocol = None
+        self.roundTripEstimators = {}
+        self.batchState = local()
+        self.serialTransactions = {}
+        self.serialCollectionPending = False
+        self.nextSerialCollection = 0
+        self.sequence = 0
+        self.streaming = False
+        self.streamRates = {}
+        self.streamPins = []
+        self.streamTimes = None
+        self.streamValues = {}
+        self.streamLogFile = None
+        self.streamLogPins = None
+        self.streamLogPosition = 0
     
     def Connect(self, port):
         '''
@@ -68,15 +401,58 @@ class Arduino(InstrumentinoController):
             cfg.LogFromOtherThread('Arduino did not respond', True)
             return None
 
-        time.sleep(2)
-        
-        if self.serial == None or self._sendData('Read A0') == None:
+        # the Arduino's clock restarts with it
+        self.clock = ArduinoClock()
+        if not self.WaitUntilReady(self.bootTimeoutSec):
+            self.serial.close()
+            self.serial = None
             return None
         
-        # start reading timer
-        self.timer = wx.Timer(cfg.app)
-        cfg.app.Bind(wx.EVT_TIMER, self.CacheUpdate, self.timer)
-        self.timer.Start(self.cacheReadDelayMilisec)
+        if self.useBinaryProtocol:
+            self.NegotiateBinaryProtocol()
+        
+        # start reading pins periodically
+        self.acquisitionThread = ArduinoAcquisitionThread(self, self.pollTickMilisec / 1000)
+        self.acquisitionThread.start()
+        
+        return True
+
+    def WaitUntilReady(self, timeoutSec):
+        '''
+        Poll the Arduino until it answers, e.g. after it restarts. Boot times vary, so this is faster and safer than waiting a fixed time.
+        
+        Returns: True if the Arduino answered in time
+        '''
+        deadline = monotonic() + timeoutSec
+        while monotonic() < deadline:
+            self.serial.flushInput()
+            # poll quickly, instead of backing off like after a lost reply 
+            self.roundTripEstimators.pop('Read', None)
+            self.nonResponsiveCounter = 0
+            if self._sendData('Read A0', lock=False) != None:
+                return True
+        return False
+
+    def NegotiateBinaryProtocol(self):
+        '''
+        Ask the Arduino to switch to the binary protocol, and fall back to the ASCII protocol if it can't
+        
+        Returns: True if the binary protocol is used
+        '''
+        if self._sendData('Protocol binary') == None:
+            return False
+        
+        self.protocol = ArduinoBinaryProtocol()
+        self.protocol.streamHandler = self._onStreamBlock
+        if self._sendData('Read A0') == None:
+            # the Arduino accepted the switch but doesn't speak the binary protocol. Go back to ASCII.
+            # The binary frame is still in the sketch's line buffer, so it's ended with a bare line break first.
+            self.protocol = None
+            self._sendLine('\r')
+            self.serial.flushInput()
+            self._sendData('Protocol ascii')
+            self.serial.flushInput()
+            return False
         
         return True
 
@@ -85,34 +461,244 @@ class Arduino(InstrumentinoController):
         Close the connection to the Arduino
         '''
         if self.serial != None:
-            if self.timer != None:
-                self.timer.Stop()
+            if self.streaming:
+                self.StopStreaming()
+            self.StopAcquisition()
+            if self.streamLogFile != None:
+                self.streamLogFile.close()
+                self.streamLogFile = None
             if reset:
                 self.Reset()
             self.serial.close()
             self.serial = None
+            self.protocol = None
 
-    def CacheUpdate(self, event):
-        pins = ''
-        # save the keys in case they change while we read
-        keys = self.pinValuesCache.keys()
+    def StopAcquisition(self):
+        '''
+        Stop the acquisition thread. Commands still waiting in the queue are cancelled. 
+        '''
+        with self.commandQueueLock:
+            thread = self.acquisitionThread
+            self.acquisitionThread = None
+        
+        if thread != None:
+            thread.Stop()
+        self.CancelCommands()
+        
+        # nobody would collect the replies of open serial transactions anymore
+        for serialTransaction in self.serialTransactions.values():
+            serialTransaction.Finish()
+        self.serialTransactions = {}
+        self.serialCollectionPending = False
+
+    def CancelCommands(self):
+        '''
+        Cancel the commands waiting in the queue, so their callers don't wait for them
+        '''
+        while True:
+            try:
+                _, _, command = self.commandQueue.get_nowait()
+            except Empty:
+                break
+            if command != None:
+                command.Cancel()
+        self.cacheUpdatePending = False
+        self.clockSyncPending = False
+        self.serialCollectionPending = False
+    
+    def ScheduleCacheUpdate(self):
+        '''
+        Queue a cache update, unless one is already waiting.
+        Cache updates have the lowest priority, so waiting writes are executed first.
+        '''
+        if not self.cacheUpdatePending:
+            self.cacheUpdatePending = True
+            self._queueCommand(ArduinoCommand(self._cacheUpdateCommand, self.PRIORITY_READ))
+    
+    def ScheduleSerialCollection(self, now):
+        '''
+        Queue a collection of the data sent by devices on the Arduino's serial ports, if there are open transactions
+        and it's time to poll them (see SerSendAsync). To be called by the acquisition thread.
+        '''
+        if len(self.serialTransactions) > 0 and not self.serialCollectionPending and now >= self.nextSerialCollection:
+            self.serialCollectionPending = True
+            self.nextSerialCollection = now + self.serialPollSec
+            self._queueCommand(ArduinoCommand(self._serialCollectionCommand, self.PRIORITY_COMMAND))
+    
+    def ScheduleClockSync(self, now):
+        '''
+        Queue a read of the Arduino's clock, if it wasn't read lately (pin reads also read it). To be called by the acquisition thread.
+        Only the binary protocol carries the Arduino's time.
+        '''
+        if self.protocol != None and not self.clockSyncPending and now >= self.nextClockSync:
+            self.clockSyncPending = True
+            self._queueCommand(ArduinoCommand(self._clockSyncCommand, self.PRIORITY_READ))
+    
+    def _clockSyncCommand(self):
+        '''
+        This function should be called only in this class
+        A clock read, as executed from the command queue
+        '''
+        self.clockSyncPending = False
+        self._readPins([])
+    
+    def _serialCollectionCommand(self):
+        '''
+        This function should be called only in this class
+        A serial data collection, as executed from the command queue
+        '''
+        self.serialCollectionPending = False
+        self.CollectSerialData()
+    
+    def CollectSerialData(self, finishAll=False):
+        '''
+        Collect the data sent by devices on the Arduino's serial ports since the last collection,
+        and finish the transactions whose reply time is over.
+        finishAll - finish all the open transactions
+        '''
+        def transaction():
+            now = monotonic()
+            for portKey, serialTransaction in self.serialTransactions.items():
+                rxData = self._sendData('SerReceive %s %d'%portKey, lock=False)
+                serialTransaction.AddData(rxData)
+                if finishAll or now >= serialTransaction.collectUntil:
+                    del self.serialTransactions[portKey]
+                    serialTransaction.Finish()
+        
+        self._transact(transaction)
+    
+    def _cacheUpdateCommand(self):
+        '''
+        This function should be called only in this class
+        A cache update, as executed from the command queue
+        '''
+        self.cacheUpdatePending = False
+        self.CacheUpdate()
+
+    def GetNextCommand(self, timeout):
+        '''
+        Get the next command to execute (with the highest priority), waiting up to timeout seconds for one to arrive.
+        To be called by the acquisition thread.
+        
+        Returns: the command, or None if there was none 
+        '''
+        try:
+            _, _, command = self.commandQueue.get(True, max(0, timeout))
+            return command
+        except Empty:
+            return None
+    
+    def CommandExecuted(self, command):
+        '''
+        Keep statistics about executed commands. To be called by the acquisition thread.
+        '''
+        self.commandsExecuted += 1
+        self.commandsWaitSec += command.waitSec
+        self.maxCommandWaitSec = max(self.maxCommandWaitSec, command.waitSec)
+    
+    def GetCommandQueueStats(self):
+        '''
+        Get statistics about the command queue since the last reset.
+        
+        Returns: a dictionary with the current queue depth, maximal queue depth, number of executed commands,
+        the average and maximal time (in seconds) commands waited in the queue
+        and the estimated round-trip time of each command type
+        '''
+        executed = self.commandsExecuted
+        return {'queueDepth': self.commandQueue.qsize(),
+                'maxQueueDepth': self.maxCommandQueueDepth,
+                'commandsExecuted': executed,
+                'meanWaitSec': self.commandsWaitSec / executed if executed > 0 else 0,
+                'maxWaitSec': self.maxCommandWaitSec,
+                'roundTripSec': {name: estimator.smoothedSec for name, estimator in self.roundTripEstimators.items()}}
+
+    def ResetCommandQueueStats(self):
+        '''
+        Reset the command queue statistics
+        '''
+        self.maxCommandQueueDepth = 0
+        self.commandsExecuted = 0
+        self.commandsWaitSec = 0
+        self.maxCommandWaitSec = 0
+    
+    def CacheUpdate(self, event=None):
+        '''
+        Read the pins in the cache that are due for sampling from the Arduino.
+        This is called periodically from the command queue, by the acquisition thread.
+        '''
+        now = monotonic()
+        # save the keys in case they change while we read. Streamed pins don't need to be read.
+        with self.cacheLock:
+            keys = [key for key in self.pinValuesCache.keys() if key not in self.streamValues and self._getPinSchedule(key).IsDue(now)]
+        if len(keys) == 0:
+            return
         for k in keys:
-            pins += k + ' '
+            self.pinSchedules[k].Scheduled(now)
         
-        valuesStr = self._sendData('Read %s'%(pins.strip()))
-        if valuesStr == None:
+        reply = self._readPins(keys)
+        if reply == None:
             return
+        values, sampleTime = reply
         
-        values = valuesStr.split(' ')
+        # publish all the new values at once
+        with self.cacheLock:
+            self.pinValuesCache.update(zip(keys, values))
+            self.pinTimesCache.update((key, sampleTime) for key in keys)
+            self.cacheUpdateTime = time.time()
         
-        # values are received in the same order we asker for them
-        try:
-            for key, val in zip(keys, values):
-                self.pinValuesCache[key] = int(val)
-        except ValueError:
-            print 'Read %s'%(pins.strip())
-            print 'received: ' + valuesStr
+        for key, val in zip(keys, values):
+            self.pinSchedules[key].Sampled(val)
             
+    @contextmanager
+    def Batch(self):
+        '''
+        Group commands, for use in a with-statement. 
+        Commands sent inside the with-block (e.g. several pin writes) are collected, and sent together when the block ends,
+        as one 'Batch' frame of the binary protocol that's acknowledged once.
+        This saves round trips, and makes related pins change almost at the same time.
+        The ASCII protocol has no batches, so with it the commands are sent one by one.
+        Commands that return data (e.g. SerSend) first send the commands collected so far, so the order of commands is kept.
+        Batches may be nested. The commands are sent when the outermost batch ends.
+        A batch that isn't acknowledged isn't sent again, since its commands may have been executed and only the reply lost.
+        '''
+        with self._collectCommands('batch'):
+            yield
+    
+    @contextmanager
+    def Pipeline(self):
+        '''
+        Pipeline commands, for use in a with-statement.
+        Commands sent inside the with-block are collected, and sent when the block ends without waiting for each reply.
+        Up to maxCommandsInFlight commands wait for their replies at once, so the link's latency is paid about once, not per command.
+        This requires the binary protocol. With the ASCII protocol, the commands are sent one by one.
+        Like in a batch, commands that return data first send the commands collected so far.
+        Usage: with arduino.Pipeline() as replies: ...
+        After the block, replies holds the reply to each command (None for failed commands).
+        '''
+        with self._collectCommands('pipeline') as replies:
+            yield replies
+    
+    @contextmanager
+    def _collectCommands(self, kind):
+        '''
+        This function should be called only in this class
+        Collect the commands sent by this thread, and send them when the outermost collecting block ends.
+        kind - 'batch' or 'pipeline'. Nested blocks join the outermost one.
+        '''
+        state = self.batchState
+        if getattr(state, 'depth', 0) == 0:
+            state.depth = 0
+            state.kind = kind
+            state.commands = []
+            state.replies = []
+        state.depth += 1
+        try:
+            yield state.replies
+        finally:
+            state.depth -= 1
+            if state.depth == 0:
+                self._flushBatch()
+    
     def PinModeOut(self, pin):
         '''
         Set digital pin mode as output 
@@ -153,7 +739,7 @@ class Arduino(InstrumentinoController):
         Set the voltage level (using PWM) of a digital output pin using an 8-bit value
         value - between 0-255  
         '''
-        self._sendData('Write %d anal %d'%(pin, value), wait=True)
+        self._sendData('Write %d anal %d'%(pin, value), wait=True, priority=self.PRIORITY_WRITE)
             
     def SetHighFreqPwm(self, pin):
         '''
@@ -187,29 +773,25 @@ class Arduino(InstrumentinoController):
         
         Returns: value between 0-1023  
         '''
-        # Get value from cache if possible, and if not, add it to the wish-list
-        try:
-            return self.pinValuesCache['A' + str(pin)]
-        except KeyError:
-            self.pinValuesCache['A' + str(pin)] = 0
+        return self._readCache('A' + str(pin))
 
     def DigitalWriteHigh(self, pin):
         '''
         Set the voltage level of a digital output pin to the maximum (HIGH level)
         '''
-        self.DigitalWrite(self, pin, 1)
+        self.DigitalWrite(pin, 1)
 
     def DigitalWriteLow(self, pin):
         '''
         Set the voltage level of a digital output pin to the minimum (LOW level)
         '''
-        self.DigitalWrite(self, pin, 0)
+        self.DigitalWrite(pin, 0)
 
     def DigitalWrite(self, pin, value):
         '''
         Set the voltage level of a digital output pin to value (1 to HIGH and 0 to low)
         '''
-        self._sendData('Write %d digi %d'%(pin, value), wait=True)
+        self._sendData('Write %d digi %d'%(pin, value), wait=True, priority=self.PRIORITY_WRITE)
 
     def DigitalRead(self, pin):
         '''
@@ -217,11 +799,124 @@ class Arduino(InstrumentinoController):
         
         Returns: 1 for HIGH and 0 for LOW
         '''
-        # Get value from cache if possible, and if not, add it to the wish-list
+        return self._readCache('D' + str(pin))
+    
+    def AnalogReadTime(self, pin):
+        '''
+        Get the time when the value returned by AnalogRead was sampled.
+        With the binary protocol, this is the Arduino's timestamp of the read (or of the streamed sample), converted to the host's clock.
+        Otherwise, it's the middle of the read's round trip.
+        
+        Returns: seconds since the epoch, or None if the pin wasn't read yet
+        '''
+        return self._readCacheTime('A' + str(pin))
+    
+    def DigitalReadTime(self, pin):
+        '''
+        Get the time when the value returned by DigitalRead was sampled. See AnalogReadTime
+        '''
+        return self._readCacheTime('D' + str(pin))
+    
+    def SetAnalogSamplePeriod(self, pin, periodSec, maxPeriodSec=None, changeThreshold=2):
+        '''
+        Set how often an analog input pin is read. By default, pins are read every cacheReadDelayMilisec.
+        periodSec - the sampling period
+        maxPeriodSec - if given, the period adapts to the signal. It shortens (down to periodSec) while the value changes,
+                       and grows (up to maxPeriodSec) while it's steady
+        changeThreshold - the smallest change of the value (0-1023) that counts as a change
+        '''
+        self._setPinSchedule('A' + str(pin), ArduinoPinSchedule(periodSec, maxPeriodSec, changeThreshold))
+
+    def SetDigitalSamplePeriod(self, pin, periodSec, maxPeriodSec=None):
+        '''
+        Set how often a digital pin is read. See SetAnalogSamplePeriod 
+        '''
+        self._setPinSchedule('D' + str(pin), ArduinoPinSchedule(periodSec, maxPeriodSec, 0))
+    
+    def StreamAnalogPin(self, pin, rateHz):
+        '''
+        Have the Arduino push the values of an analog input pin, instead of polling it.
+        All streamed pins are sampled together, at the highest rate requested.
+        Streaming requires the binary protocol. Without it, the pin is polled as usual.
+        rateHz - the requested sample rate 
+        
+        Returns: True if the pin is streamed
+        '''
+        return self._streamPin('A' + str(pin), rateHz)
+
+    def StreamDigitalPin(self, pin, rateHz):
+        '''
+        Have the Arduino push the values of a digital pin, instead of polling it.
+        See StreamAnalogPin
+        '''
+        return self._streamPin('D' + str(pin), rateHz)
+    
+    def StopStreaming(self):
+        '''
+        Stop streaming. All pins are polled again.
+        '''
+        def transaction():
+            self.streamRates = {}
+            return self._restartStream()
+        
+        self._transact(transaction)
+    
+    def GetStreamedSamples(self, position=0):
+        '''
+        Get the samples streamed since position (no more than what the ring buffers hold)
+        
+        Returns: (sample times (seconds since the epoch), a dictionary of sample values for each streamed pin, the position after the last sample)
+        '''
+        streamTimes, streamValues, pins = self.streamTimes, self.streamValues, self.streamPins
+        if streamTimes == None:
+            return np.zeros(0), {}, 0
+        
+        # values are appended before times, so there are at least as many values as times
+        times, newPosition = streamTimes.GetSince(position)
+        values = {}
+        for key in pins:
+            values[key] = streamValues[key].GetSince(position)[0][:len(times)]
+        return times, values, newPosition
+    
+    def ReadStream(self, timeoutSec):
+        '''
+        Read the sample blocks pushed by the Arduino, waiting up to timeoutSec for them to arrive. To be called by the acquisition thread.
+        '''
+        self._setSerialTimeout(max(timeoutSec, self.serialMinTimeoutSec))
         try:
-            return self.pinValuesCache['D' + str(pin)]
-        except KeyError:
-            self.pinValuesCache['D' + str(pin)] = 0
+            self.protocol.ReadStreamBlocks(self.serial)
+        except:
+            pass
+    
+    def WriteStreamLog(self):
+        '''
+        Write the samples streamed since the last call to the stream log file, so every sample is logged. To be called by the acquisition thread.
+        The file is written, and the samples formatted, by the log's background thread (see cfg.OpenLogFile), so a slow disk doesn't delay acquisition.
+        '''
+        pins = self.streamPins
+        times, values, self.streamLogPosition = self.GetStreamedSamples(self.streamLogPosition)
+        if len(times) == 0:
+            return
+        
+        if self.streamLogFile == None:
+            self.streamLogFile = cfg.OpenLogFile(cfg.timeNow + '_' + self.name + '_stream.csv')
+        
+        if self.streamLogPins != pins:
+            self.streamLogFile.write('time,' + ','.join(pins) + '\r')
+            self.streamLogPins = pins
+        
+        # the samples are copies, so they can be passed to the background thread
+        self.streamLogFile.Submit(self._formatStreamRows, times, [values[key] for key in pins])
+    
+    @staticmethod
+    def _formatStreamRows(times, columns):
+        '''
+        This function should be called only in this class
+        Format streamed samples as CSV rows
+        '''
+        rows = StringIO()
+        np.savetxt(rows, np.column_stack([times] + columns), fmt=['%.6f'] + ['%d'] * len(columns), delimiter=',', newline='\r')
+        return rows.getvalue()
     
     def PidRelayCreate(self, pidVar, pinAnalIn, pinDigiOut, windowSizeMs, kp, ki, kd):
         '''
@@ -269,7 +964,8 @@ class Arduino(InstrumentinoController):
         port - the hardware serial port number
         '''
         self._sendData('HardSerConnect %d %d'%(baudrate, port), wait=True)
-        time.sleep(1)
+        if self.serialConnectSettleSec > 0:
+            time.sleep(self.serialConnectSettleSec)
     
     def SoftSerConnect(self, pinRx, pinTx, baudrate, port=1):
         '''
@@ -278,39 +974,74 @@ class Arduino(InstrumentinoController):
         port - a port number to identify future transactions
         '''
         self._sendData('SoftSerConnect %d %d %d %d'%(pinRx, pinTx, baudrate, port), wait=True)
-        time.sleep(1)
+        if self.serialConnectSettleSec > 0:
+            time.sleep(self.serialConnectSettleSec)
     
     def SerSend(self, serialData, writeTimeoutSec=None, isSoftSerial=True, port=1):
         '''
-        Send serial data over an open serial connection
+        Send serial data over an open serial connection, and wait for the reply.
+        The Arduino isn't blocked while waiting (see SerSendAsync).
         serialData - the data to send. a NULL ('\0') character is added at the end to signify the end of transmission
         writeTimeoutSec - time in seconds to wait for a software serial response
         isSoftSerial - True for software serial ports, False for hardware serial ports
         port - the port number to use
         
         Returns: the data received (if any)
-        '''        
-        self.accessSemaphore.acquire(True)
-        if writeTimeoutSec != None:
-            self._sendData('SerReceive %s %d'%('soft' if isSoftSerial else 'hard', port), lock=False)
-        
-        self._sendData('SerSend %s %d'%('soft' if isSoftSerial else 'hard', port), lock=False)
-        self._sendData(serialData + '\0', False, lock=False)
+        '''
+        serialTransaction = self.SerSendAsync(serialData, writeTimeoutSec, isSoftSerial, port)
+        if serialTransaction == None:
+            return None
         
-        rxData = None
-        if writeTimeoutSec != None:
+        if self.acquisitionThread == None:
+            # nobody collects the reply in the background
             time.sleep(writeTimeoutSec)
-            rxData = self._sendData('SerReceive %s %d'%('soft' if isSoftSerial else 'hard', port), lock=False)
+            self.CollectSerialData(finishAll=True)
+        return serialTransaction.Wait()
+    
+    def SerSendAsync(self, serialData, collectSec=None, isSoftSerial=True, port=1):
+        '''
+        Send serial data over an open serial connection, without waiting for the reply.
+        The reply is buffered on the Arduino, and collected every serialPollSec by the acquisition thread,
+        so pin reads and other commands go on while the device works. Each serial port has its own transaction,
+        so devices on several ports can work at the same time. A new transaction on a port finishes the previous one.
+        serialData - the data to send. a NULL ('\0') character is added at the end to signify the end of transmission
+        collectSec - time in seconds to collect the reply for. None if no reply is expected.
+        isSoftSerial - True for software serial ports, False for hardware serial ports
+        port - the port number to use
+        
+        Returns: an ArduinoSerialTransaction to wait on for the reply, or None if no reply is expected
+        '''
+        portKey = ('soft' if isSoftSerial else 'hard', port)
+        serialTransaction = ArduinoSerialTransaction(monotonic() + collectSec) if collectSec != None else None
+        
+        def transaction():
+            previous = self.serialTransactions.pop(portKey, None)
+            if previous != None:
+                previous.AddData(self._sendData('SerReceive %s %d'%portKey, lock=False))
+                previous.Finish()
+            elif serialTransaction != None:
+                # throw away data that was sent before
+                self._sendData('SerReceive %s %d'%portKey, lock=False)
             
-        self.accessSemaphore.release()
-        return rxData
+            if self.protocol != None:
+                # the data is sent in the same frame as the command
+                self._sendData('SerSend %s %d %s'%(portKey + (serialData,)), lock=False)
+            else:
+                self._sendData('SerSend %s %d'%portKey, lock=False)
+                self._sendData(serialData + '\0', False, lock=False)
+            
+            if serialTransaction != None:
+                self.serialTransactions[portKey] = serialTransaction
+        
+        self._transact(transaction)
+        return serialTransaction
 
     def Reset(self):
         '''
-        Reset the mode of all digital pins to input
+        Reset the mode of all digital pins to input.
+        The pins are reset when the Arduino acknowledges, so there's no need to wait.
         '''
         self._sendData('Reset', wait=True)
-        time.sleep(1)
         
     def BlinkPin(self, pin=PIN_LED, ms=500):
         '''
@@ -325,91 +1056,849 @@ class Arduino(InstrumentinoController):
         '''
         Send a list of values (bytes) over the I2C bus
         '''
-        self._sendData('I2cWrite %d %s'%(address, ' '.join(str(n) for n in values)), wait=True)
+        self._sendData('I2cWrite %d %s'%(address, ' '.join(str(n) for n in values)), wait=True, priority=self.PRIORITY_WRITE)
     
     def SpiWrite(self, cs_pin, values):
         '''
         Send a list of values (bytes) over the SPI bus
         '''
-        self._sendData('SpiWrite %d %s'%(cs_pin, ' '.join(str(n) for n in values)), wait=True)
+        self._sendData('SpiWrite %d %s'%(cs_pin, ' '.join(str(n) for n in values)), wait=True, priority=self.PRIORITY_WRITE)
+    
+    def PlayWaveform(self, values, rateHz, target, address, header=0, repeats=0):
+        '''
+        Upload a sampled waveform and have the Arduino play it at a fixed rate.
+        The samples are output by the Arduino's timer, so high-rate ramps are smooth, unlike when the host sets every sample.
+        values - the samples (16-bit). Up to waveformMaxSamples.
+        rateHz - samples per second
+        target - how samples are output:
+                 'pwm' - a PWM value for pin address
+                 'spi' - a 16-bit word (header | sample) to the SPI chip-select pin address
+                 'i2c' - the bytes header, sample to the I2C address
+        repeats - how many times to play the waveform (0 - until StopWaveform)
+        
+        Returns: True if the waveform is playing
+        '''
+        if len(values) == 0 or len(values) > self.waveformMaxSamples:
+            cfg.LogFromOtherThread('Arduino waveforms should have 1-%d samples'%(self.waveformMaxSamples), True)
+            return False
+        
+        values = [int(value) for value in values]
+        with self.Pipeline() as replies:
+            self._sendData('WaveStop', wait=True, priority=self.PRIORITY_WRITE)
+            for start in range(0, len(values), self.waveformChunkSamples):
+                chunk = values[start:start + self.waveformChunkSamples]
+                self._sendData('WaveLoad %d %s'%(start, ' '.join(str(value) for value in chunk)), wait=True, priority=self.PRIORITY_WRITE)
+        if None in replies:
+            return False
+        
+        # only start playing when all the samples are loaded
+        periodMicros = int(round(1e6 / rateHz))
+        return self._sendData('WavePlay %s %d %d %d %d %d'%(target, address, header, periodMicros, len(values), repeats), wait=True, priority=self.PRIORITY_WRITE) != None
+    
+    def StopWaveform(self):
+        '''
+        Stop playing the waveform. The output keeps its last value.
+        '''
+        self._sendData('WaveStop', wait=True, priority=self.PRIORITY_WRITE)
+    
+    def _readCache(self, key):
+        '''
+        This function should be called only in this class
+        Get a pin value from the cache if possible, and if not, add it to the wish-list
+        Streamed pins return their latest sample.
+        '''
+        streamBuffer = self.streamValues.get(key)
+        if streamBuffer != None:
+            value = streamBuffer.Latest()
+            if value != None:
+                return int(value)
+        
+        with self.cacheLock:
+            try:
+                return self.pinValuesCache[key]
+            except KeyError:
+                self.pinValuesCache[key] = 0
+    
+    def _readCacheTime(self, key):
+        '''
+        This function should be called only in this class
+        Get the time when a pin's value in the cache was sampled
+        '''
+        streamBuffer = self.streamValues.get(key)
+        if streamBuffer != None and self.streamTimes != None:
+            sampleTime = self.streamTimes.Latest()
+            if sampleTime != None:
+                return float(sampleTime)
+        
+        with self.cacheLock:
+            return self.pinTimesCache.get(key)
+    
+    def _readPins(self, keys):
+        '''
+        This function should be called only in this class
+        Read pins from the Arduino, and find out when they were sampled
+        keys - the pins to read (e.g. ['A0', 'D3']). With the binary protocol, reading no pins still reads the Arduino's clock.
+        
+        Returns: (the values, in the order of keys, the time they were sampled (seconds since the epoch)), or None if the read failed
+        '''
+        sentTime = time.time()
+        rxData = self._sendData(('Read ' + ' '.join(keys)).strip())
+        receivedTime = time.time()
+        if rxData == None:
+            return None
+        
+        if self.protocol != None:
+            deviceMicros, values = self.protocol.DecodeValues(rxData)
+            deviceSec = self.clock.Unwrap([deviceMicros])[0]
+            self.clock.AddExchange(sentTime, receivedTime, deviceSec)
+            self.nextClockSync = monotonic() + self.clockSyncSec
+            return values, float(self.clock.ToHostTime(deviceSec))
+        
+        try:
+            values = [int(val) for val in rxData.split(' ')]
+        except ValueError:
+            # a garbled reply. The pins are read again on their next tick.
+            return None
+        return values, (sentTime + receivedTime) / 2
+    
+    def _getPinSchedule(self, key):
+        '''
+        This function should be called only in this class
+        Get the sampling schedule of a pin. Pins without one are sampled every cacheReadDelayMilisec.
+        '''
+        try:
+            return self.pinSchedules[key]
+        except KeyError:
+            schedule = ArduinoPinSchedule(self.cacheReadDelayMilisec / 1000)
+            self.pinSchedules[key] = schedule
+            return schedule
+
+    def _setPinSchedule(self, key, schedule):
+        '''
+        This function should be called only in this class
+        Set the sampling schedule of a pin, and add it to the wish-list.
+        If several variables use the same pin, the fastest schedule is kept.
+        '''
+        with self.cacheLock:
+            current = self.pinSchedules.get(key)
+            if current == None or schedule.minPeriodSec < current.minPeriodSec:
+                self.pinSchedules[key] = schedule
+            self.pinValuesCache.setdefault(key, 0)
+
+    def _streamPin(self, key, rateHz):
+        '''
+        This function should be called only in this class
+        Add a pin to the streamed pins and restart the stream
+        '''
+        if self.protocol == None:
+            return False
+        
+        def transaction():
+            self.streamRates[key] = max(rateHz, self.streamRates.get(key, 0))
+            return self._restartStream()
+        
+        return self._transact(transaction)
+
+    def _restartStream(self):
+        '''
+        This function should be called only in this class
+        Stop the current stream and start streaming the pins in streamRates (if any).
+        Should be called with exclusive access to the Arduino (see _transact).
+        
+        Returns: True if streaming 
+        '''
+        if self.streaming:
+            self.streaming = False
+            self._sendData('StreamStop', lock=False)
+        
+        pins = sorted(self.streamRates.keys())
+        self.streamTimes = RingBuffer(self.streamBufferSamples)
+        self.streamValues = {key: RingBuffer(self.streamBufferSamples, np.uint16) for key in pins}
+        self.streamPins = pins
+        self.streamLogPosition = 0
+        if len(pins) == 0:
+            return False
+        
+        periodUs = int(1e6 / max(self.streamRates.values()))
+        if self._sendData('StreamStart %d %s'%(periodUs, ' '.join(pins)), lock=False, wait=True) == None:
+            # only the reply might have been lost, so make sure the Arduino isn't streaming
+            self._sendData('StreamStop', lock=False)
+            self.streamRates = {}
+            self.streamValues = {}
+            self.streamPins = []
+            return False
+        
+        self.streaming = True
+        return True
+    
+    def _onStreamBlock(self, data):
+        '''
+        This function should be called only in this class
+        Store the samples of a stream block in the ring buffers
+        '''
+        if not self.streaming:
+            # a leftover from a stopped stream
+            return
+        
+        deviceMicros, values = self.protocol.DecodeStreamBlock(data, len(self.streamPins))
+        if len(deviceMicros) == 0:
+            return
+        
+        deviceSec = self.clock.Unwrap(deviceMicros)
+        self.clock.AddArrival(time.time(), deviceSec[-1])
+        
+        for idx, key in enumerate(self.streamPins):
+            self.streamValues[key].Append(values[:, idx])
+        self.streamTimes.Append(self.clock.ToHostTime(deviceSec))
+    
+    def _queueCommand(self, command):
+        '''
+        This function should be called only in this class
+        Put a command in the command queue
+        '''
+        self.commandQueue.put((command.priority, next(self.commandCounter), command))
+        self.maxCommandQueueDepth = max(self.maxCommandQueueDepth, self.commandQueue.qsize())
+    
+    def _transact(self, func, priority=PRIORITY_COMMAND):
+        '''
+        This function should be called only in this class
+        Run func with exclusive access to the Arduino, and block until it's done.
+        When acquiring, func is queued and executed by the acquisition thread, according to its priority.
+        
+        Returns: the return value of func
+        '''
+        # commands collected in a batch go first
+        self._flushBatch()
+        
+        with self.commandQueueLock:
+            thread = self.acquisitionThread
+            if thread != None and current_thread() is not thread:
+                command = ArduinoCommand(func, priority)
+                self._queueCommand(command)
+            else:
+                command = None
+        
+        if command == None:
+            return func()
+        return command.Wait(self.commandTimeoutSec)
     
-    def _sendData(self, txData, addLineBreak=True, lock=True, wait=False, log=False):
+    def _flushBatch(self):
+        '''
+        This function should be called only in this class
+        Send the commands collected so far in this thread's batch or pipeline (if any)
+        '''
+        state = self.batchState
+        commands = getattr(state, 'commands', None)
+        if not commands:
+            return
+        state.commands = []
+        
+        txDataList = [txData for txData, _, _ in commands]
+        wait = any(wait for _, wait, _ in commands)
+        priority = min(priority for _, _, priority in commands)
+        if state.kind == 'pipeline':
+            replies = self._transact(lambda: self._sendPipelined(txDataList, wait), priority)
+            # the commands weren't sent if they were cancelled or timed out
+            state.replies.extend(replies if replies != None else [None] * len(txDataList))
+        else:
+            self._transact(lambda: self._sendBatch(txDataList, wait), priority)
+    
+    def _sendBatch(self, txDataList, wait):
+        '''
+        This function should be called only in this class
+        Send a list of commands as a batch (with the binary protocol), or one by one (with the ASCII protocol).
+        Should be called with exclusive access to the Arduino (see _transact).
+        '''
+        if self.protocol != None and len(txDataList) > 1:
+            self._sendData(txDataList, lock=False, wait=wait)
+            return
+        
+        for txData in txDataList:
+            self._sendData(txData, lock=False, wait=wait)
+    
+    def _sendPipelined(self, txDataList, wait):
+        '''
+        This function should be called only in this class
+        Send a list of commands, keeping up to maxCommandsInFlight of them (and maxBytesInFlight) waiting for replies at once.
+        Replies are matched to their commands by sequence number.
+        After a missing reply, the commands that weren't sent yet are sent one at a time. Of the commands that were sent,
+        only reads (see resendableCommands) are sent again, since the others may have been executed with only their reply lost.
+        Should be called with exclusive access to the Arduino (see _transact).
+        
+        Returns: a list with the reply to each command (None for failed commands)
+        '''
+        replies = [None] * len(txDataList)
+        nextIdx = 0
+        if self.protocol != None and self.serial != None and len(txDataList) > 1:
+            # wait for the slowest command
+            self._setSerialTimeout(max(self._getRoundTripEstimator(txData.partition(' ')[0]).timeoutSec for txData in txDataList))
+            inFlight = {}
+            bytesInFlight = 0
+            try:
+                while nextIdx < len(txDataList) or len(inFlight) > 0:
+                    while nextIdx < len(txDataList) and len(inFlight) < self.maxCommandsInFlight:
+                        sequence = self._nextSequence()
+                        frame = self.protocol.EncodeCommand(txDataList[nextIdx], sequence)
+                        if len(inFlight) > 0 and bytesInFlight + len(frame) > self.maxBytesInFlight:
+                            break
+                        self.serial.write(frame)
+                        inFlight[sequence] = (nextIdx, len(frame))
+                        bytesInFlight += len(frame)
+                        nextIdx += 1
+                    
+                    reply = self.protocol.ReadTaggedReply(self.serial, monotonic() + self.serial.timeout)
+                    if reply == None:
+                        break
+                    sequence, rxData = reply
+                    if sequence in inFlight:
+                        idx, frameLength = inFlight.pop(sequence)
+                        bytesInFlight -= frameLength
+                        replies[idx] = rxData
+            except:
+                pass
+        
+        for idx, txData in enumerate(txDataList):
+            if replies[idx] != None:
+                continue
+            if idx >= nextIdx or txData.partition(' ')[0] in self.resendableCommands:
+                replies[idx] = self._sendData(txData, lock=False, wait=wait)
+            else:
+                self.nonResponsiveCounter += 1
+                if wait == True or self.nonResponsiveCounter > self.maxNonResponseAllowed:
+                    cfg.LogFromOtherThread('Arduino did not respond %d times'%(self.nonResponsiveCounter), True)
+        return replies
+    
+    def _nextSequence(self):
+        '''
+        This function should be called only in this class
+        Advance the command sequence number
+        
+        Returns: the sequence number to use
+        '''
+        self.sequence = (self.sequence + 1) % ArduinoBinaryProtocol.SEQUENCE_MODULO
+        return self.sequence
+    
+    def _sendData(self, txData, addLineBreak=True, lock=True, wait=False, log=False, priority=PRIORITY_COMMAND):
         '''
         This function should be called only in this class
         Send a command (txData) to the Arduino and wait for acknowledgment.
         Failure of the acknowledgment to arrive logs the event and raises an exception
          
-        writeTimeoutSec - time in seconds to wait for a software serial response
+        txData - the command. A list of commands is sent as a batch (binary protocol only, see Batch)
         addLineBreak - add a line break after txData (to tell the Arduino to execute the command) 
-        lock - lock access to Arduino during this function
-        wait - wait until the Arduino is unlocked. This is used for critical commands such as write commands
+        lock - send the command through the command queue. Set to False only inside a transaction (see _transact)
+        wait - always report a failure. This is used for critical commands such as write commands
         log - log the communication to the screen. mostly for debug purposes
+        priority - the priority of the command in the command queue
         
         Returns: the data received (if any)
         '''
         if self.serial == None:
             return None
                 
+        isBatch = isinstance(txData, list)
         if lock == True:
-            if self.accessSemaphore.acquire(False) == False:
-                if wait:
-                    while self.accessSemaphore.acquire(False) == False:
-                        pass
-                else:
-                    return None
+            # commands that return data are never batched
+            batching = getattr(self.batchState, 'depth', 0) > 0
+            if batching and addLineBreak and not isBatch and txData.partition(' ')[0] not in ('Read', 'SerReceive'):
+                self.batchState.commands.append((txData, wait, priority))
+                return ''
+            return self._transact(lambda: self._sendData(txData, addLineBreak, False, wait, log), priority)
         
         if log:
-            print 'we say: ' + txData
-        if addLineBreak == True:
-            txData = txData + '\r'
+            print 'we say: ' + str(txData)
+        
+        # raw data (sent without a line break) is acknowledged like a command
+        if isBatch:
+            commandName = 'Batch'
+        else:
+            commandName = txData.partition(' ')[0] if addLineBreak else 'SerData'
+        estimator = self._getRoundTripEstimator(commandName)
+        self._setSerialTimeout(estimator.timeoutSec)
+        startTime = monotonic()
+        
+        if self.protocol != None:
+            rxData = self._sendFrame(txData)
+        else:
+            rxData = self._sendLine(txData + '\r' if addLineBreak else txData)
 
+        if log:
+            print 'Arduino says: ' + repr(rxData)
+        
+        if rxData == None:
+            estimator.Timeout()
+            self.nonResponsiveCounter += 1
+            if wait == True or self.nonResponsiveCounter > self.maxNonResponseAllowed:
+                cfg.LogFromOtherThread('Arduino did not respond %d times'%(self.nonResponsiveCounter), True)
+            return None
+
+        estimator.AddSample(monotonic() - startTime)
+        self.nonResponsiveCounter = 0            
+        return rxData
+
+    def _sendLine(self, txData):
+        '''
+        This function should be called only in this class
+        Send a command to the Arduino using the ASCII protocol and wait for its reply.
+        Should be called by _sendData, with exclusive access to the Arduino
+        
+        Returns: the data received before the 'done' terminator, or None if the command wasn't acknowledged
+        '''
         try:
             self.serial.write(txData)
             rxData = self._getData()
         except:
             rxData = ''
 
-        if lock == True:
-            self.accessSemaphore.release()
-                    
-        if log:
-            print 'Arduino says: ' + rxData
-        
         answerEnd = rxData.rfind("done") 
         if answerEnd == -1:
-            self.nonResponsiveCounter += 1
-            if wait == True or self.nonResponsiveCounter > self.maxNonResponseAllowed:
-                cfg.LogFromOtherThread('Arduino did not respond %d times'%(self.nonResponsiveCounter), True)
             return None
+        return rxData[0:answerEnd].strip()
 
-        self.nonResponsiveCounter = 0            
-        return rxData[0:answerEnd].strip();
+    def _sendFrame(self, txData):
+        '''
+        This function should be called only in this class
+        Send a command (or a list of commands) to the Arduino using the binary protocol and wait for its reply.
+        Should be called by _sendData, with exclusive access to the Arduino
+        
+        Returns: the data received, or None if the command wasn't acknowledged
+        '''
+        sequence = self._nextSequence()
+        try:
+            if isinstance(txData, list):
+                self.serial.write(self.protocol.EncodeBatch(txData, sequence))
+            else:
+                self.serial.write(self.protocol.EncodeCommand(txData, sequence))
+            return self.protocol.ReadReply(self.serial, sequence)
+        except:
+            return None
 
     def _getData(self):
         '''
         This function should be called only in the class
-        Reads the Arduino response for the last command
+        Reads the Arduino response for the last command.
+        Reading stops as soon as the 'done' terminator arrives, or when the serial port times out.
         
         Returns: the response
         '''
-        try:        
-            return self.serial.read(300)
+        rxData = ''
+        try:
+            while True:
+                chunk = self.serial.read(max(1, self.serial.inWaiting()))
+                if len(chunk) == 0:
+                    return rxData
+                rxData += chunk
+                # only look for the terminator where it might have just been completed
+                if rxData.find('done', max(0, len(rxData) - len(chunk) - 3)) != -1:
+                    return rxData
         except:
-            return ''
+            return rxData
+
+    def _getRoundTripEstimator(self, commandName):
+        '''
+        This function should be called only in this class
+        Get the round-trip time estimator for a command. Every command type has its own estimator, since their durations differ.
+        '''
+        try:
+            return self.roundTripEstimators[commandName]
+        except KeyError:
+            estimator = RoundTripEstimator(self.serialTimeoutSec, self.serialMinTimeoutSec, self.serialMaxTimeoutSec)
+            self.roundTripEstimators[commandName] = estimator
+            return estimator
     
+    def _setSerialTimeout(self, timeoutSec):
+        '''
+        This function should be called only in this class
+        Set the serial port's read timeout. Changing it reconfigures the port, so it's only done if the change is significant.
+        '''
+        if abs(self.serial.timeout - timeoutSec) > self.serialMinTimeoutSec / 2:
+            self.serial.timeout = timeoutSec
     
+
+class RoundTripEstimator(object):
+    '''
+    A running estimate of the round-trip time of a command, used to set the timeout for its reply.
+    The estimate is calculated like the TCP retransmission timer (RFC 6298):
+    timeout = smoothed RTT + 4 * RTT variation, and the timeout is doubled whenever a reply doesn't arrive.
+    '''
+    alpha = 1 / 8
+    beta = 1 / 4
+    
+    def __init__(self, initialTimeoutSec, minTimeoutSec, maxTimeoutSec):
+        self.minTimeoutSec = minTimeoutSec
+        self.maxTimeoutSec = maxTimeoutSec
+        self.smoothedSec = None
+        self.variationSec = None
+        self.timeoutSec = initialTimeoutSec
+    
+    def AddSample(self, roundTripSec):
+        '''
+        Update the estimate with a measured round-trip time
+        '''
+        if self.smoothedSec == None:
+            self.smoothedSec = roundTripSec
+            self.variationSec = roundTripSec / 2
+        else:
+            self.variationSec = (1 - self.beta) * self.variationSec + self.beta * abs(self.smoothedSec - roundTripSec)
+            self.smoothedSec = (1 - self.alpha) * self.smoothedSec + self.alpha * roundTripSec
+        
+        self.timeoutSec = min(self.maxTimeoutSec, max(self.minTimeoutSec, self.smoothedSec + 4 * self.variationSec))
+        
+    def Timeout(self):
+        '''
+        A reply didn't arrive in time. Back off.
+        '''
+        self.timeoutSec = min(self.maxTimeoutSec, self.timeoutSec * 2)
+
+
+class ArduinoClock(object):
+    '''
+    Converts the Arduino's timestamps (microseconds since it started) to the host's clock (seconds since the epoch).
+    The Arduino's time in a reply was taken between sending the command and receiving the reply,
+    so the offset between the clocks is best estimated by the exchanges with the shortest round trip (like NTP does).
+    The Arduino's clock drifts (ceramic resonators are only accurate to ~0.5%), so the offset is fitted as a line
+    through the best exchange of each of the last maxWindows windows.
+    '''
+    windowSec = 2
+    maxWindows = 30
+    
+    def __init__(self):
+        self.lastMicros = None
+        # the best exchange (deviceSec, offsetSec) of each window
+        self.windows = []
+        # the best exchange of the current window (roundTripSec, deviceSec, offsetSec) and when it started (deviceSec)
+        self.current = None
+        self.currentStartSec = None
+        # before there are exchanges, the offset is bounded by the arrival of pushed samples (see AddArrival)
+        self.arrivalOffsetSec = None
+        self.fit = None
+    
+    def Unwrap(self, deviceMicros):
+        '''
+        The Arduino's microseconds counter wraps around every ~70 minutes. Follow the wraps and convert to seconds.
+        Timestamps may arrive a little out of order (e.g. stream samples and read replies), but not by half the counter's range.
+        
+        Returns: an array of the Arduino's times in seconds since it started
+        '''
+        micros = np.asarray(deviceMicros, dtype=np.int64)
+        if self.lastMicros == None:
+            self.lastMicros = int(micros[0])
+        steps = np.diff(np.concatenate(([self.lastMicros % 2**32], micros)))
+        # the shortest step between two timestamps, forwards or backwards
+        steps = (steps + 2**31) % 2**32 - 2**31
+        unwrapped = self.lastMicros + np.cumsum(steps)
+        self.lastMicros = int(unwrapped[-1])
+        return unwrapped / 1e6
+    
+    def AddExchange(self, sentSec, receivedSec, deviceSec):
+        '''
+        Add the timing of a command and its reply
+        sentSec, receivedSec - when the command was sent and when the reply was received (host time)
+        deviceSec - the Arduino's time in the reply (unwrapped)
+        '''
+        sample = (receivedSec - sentSec, deviceSec, (sentSec + receivedSec) / 2 - deviceSec)
+        if self.current == None or deviceSec - self.currentStartSec > self.windowSec:
+            if self.current != None:
+                self.windows = (self.windows + [self.current[1:]])[-self.maxWindows:]
+            self.current = sample
+            self.currentStartSec = deviceSec
+        elif sample[0] < self.current[0]:
+            self.current = sample
+        else:
+            return
+        self.fit = None
+    
+    def AddArrival(self, receivedSec, deviceSec):
+        '''
+        Add the arrival time of data the Arduino pushed (e.g. a stream block). It was sampled before it arrived,
+        which bounds the offset until there are exchanges.
+        '''
+        offsetSec = receivedSec - deviceSec
+        if self.arrivalOffsetSec == None or offsetSec < self.arrivalOffsetSec:
+            self.arrivalOffsetSec = offsetSec
+    
+    def Offset(self, deviceSec):
+        '''
+        Returns: the estimated offset between the clocks at deviceSec (a number or an array), or None if there's no estimate yet
+        '''
+        if self.current == None:
+            return self.arrivalOffsetSec
+        
+        if self.fit == None:
+            points = self.windows + [self.current[1:]]
+            if len(points) < 2:
+                self.fit = (0, points[0][0], points[0][1])
+            else:
+                deviceTimes, offsets = np.array(points).T
+                slope, intercept = np.polyfit(deviceTimes - deviceTimes[0], offsets, 1)
+                self.fit = (slope, deviceTimes[0], intercept)
+        slope, originSec, intercept = self.fit
+        return intercept + slope * (deviceSec - originSec)
+    
+    def ToHostTime(self, deviceSec):
+        '''
+        Convert the Arduino's time (a number or an array) to seconds since the epoch.
+        If there's no estimate of the offset yet, the current time is used.
+        '''
+        if self.current == None and self.arrivalOffsetSec == None:
+            return deviceSec * 0 + time.time()
+        return deviceSec + self.Offset(deviceSec)
+
+
+class ArduinoPinSchedule(object):
+    '''
+    When to read a pin.
+    The sampling period is either fixed, or adapts to how fast the pin's value changes:
+    it's halved (down to minPeriodSec) whenever the value changes by more than changeThreshold,
+    and slowly grows back (up to maxPeriodSec) while the value is steady.
+    '''
+    growthFactor = 1.25
+    
+    def __init__(self, periodSec, maxPeriodSec=None, changeThreshold=2):
+        self.minPeriodSec = periodSec
+        self.maxPeriodSec = maxPeriodSec if maxPeriodSec != None else periodSec
+        self.periodSec = periodSec
+        self.changeThreshold = changeThreshold
+        self.lastValue = None
+        self.nextDue = 0
+        
+    def IsDue(self, now):
+        '''
+        Returns: True if the pin should be read now (or if the clock stepped back, see util.monotonic)
+        '''
+        return now >= self.nextDue or self.nextDue - now > self.maxPeriodSec
+    
+    def Scheduled(self, now):
+        '''
+        The pin is being read. Set the next time it's due.
+        Pins with the same period are kept on the same time grid, so they're read together. 
+        '''
+        self.nextDue = (math.floor(now / self.periodSec) + 1) * self.periodSec
+    
+    def Sampled(self, value):
+        '''
+        Adapt the sampling period to the change in the pin's value
+        '''
+        if self.maxPeriodSec > self.minPeriodSec and self.lastValue != None:
+            if abs(value - self.lastValue) > self.changeThreshold:
+                self.periodSec = max(self.minPeriodSec, self.periodSec / 2)
+            else:
+                self.periodSec = min(self.maxPeriodSec, self.periodSec * self.growthFactor)
+        self.lastValue = value
+
+
+class ArduinoSerialTransaction(object):
+    '''
+    Data sent to a device on one of the Arduino's serial ports, and the reply collected for it in the background
+    '''
+    def __init__(self, collectUntil):
+        self.collectUntil = collectUntil
+        self.rxData = None
+        self.doneEvent = Event()
+    
+    def AddData(self, rxData):
+        '''
+        Add data collected from the device
+        '''
+        if rxData:
+            self.rxData = rxData if self.rxData == None else self.rxData + rxData
+    
+    def Finish(self):
+        '''
+        No more data will be collected. Wake up the waiting caller.
+        '''
+        self.doneEvent.set()
+    
+    def IsDone(self):
+        return self.doneEvent.is_set()
+    
+    def Wait(self, timeoutSec=None):
+        '''
+        Wait until the reply was collected
+        
+        Returns: the data received (None if nothing arrived)
+        '''
+        self.doneEvent.wait(timeoutSec)
+        return self.rxData
+
+
+class ArduinoCommand(object):
+    '''
+    A command waiting in the command queue of an Arduino.
+    The caller blocks on the command until the acquisition thread executes it.
+    '''
+    def __init__(self, func, priority):
+        self.func = func
+        self.priority = priority
+        self.result = None
+        self.queuedTime = monotonic()
+        self.waitSec = 0
+        self.doneEvent = Event()
+        self.cancelled = False
+        
+    def Execute(self):
+        '''
+        Execute the command and wake up the caller
+        '''
+        self.waitSec = monotonic() - self.queuedTime
+        if self.cancelled:
+            return
+        try:
+            self.result = self.func()
+        except Exception as e:
+            cfg.LogFromOtherThread('Arduino command failed: ' + str(e))
+        finally:
+            self.doneEvent.set()
+        
+    def Cancel(self):
+        '''
+        Wake up the caller without executing the command
+        '''
+        self.cancelled = True
+        self.doneEvent.set()
+    
+    def Wait(self, timeoutSec=None):
+        '''
+        Wait until the command was executed
+        timeoutSec - give up waiting after this long. The command is then cancelled, if it wasn't executed yet.
+        
+        Returns: the command's result (None if it was cancelled or timed out)
+        '''
+        if not self.doneEvent.wait(timeoutSec):
+            self.cancelled = True
+            cfg.LogFromOtherThread('Arduino command timed out after %g sec' % timeoutSec)
+        return self.result
+
+
+class ArduinoAcquisitionThread(Thread):
+    '''
+    Thread class that owns the serial connection to an Arduino.
+    It executes the commands in the Arduino's command queue by their priority, and periodically queues a read of the pins into the cache,
+    so acquisition doesn't depend on the GUI thread.
+    Reads are scheduled on a monotonic clock. If a read takes too long, the missed ticks are skipped rather than bunched up.
+    '''
+    def __init__(self, arduino, periodSec):
+        Thread.__init__(self)
+        self.daemon = True
+        self.arduino = arduino
+        self.periodSec = periodSec
+        self.stopEvent = Event()
+        self.lastError = None
+
+    def run(self):
+        '''
+        Read the pins until stopped. Errors are logged, and don't stop the thread.
+        When the thread ends, the commands still waiting for it are cancelled.
+        '''
+        try:
+            self._loop()
+        finally:
+            with self.arduino.commandQueueLock:
+                if self.arduino.acquisitionThread is self:
+                    self.arduino.acquisitionThread = None
+            self.arduino.CancelCommands()
+    
+    def _loop(self):
+        '''
+        This function should be called only in this class
+        '''
+        nextTick = monotonic()
+        nextStreamLog = nextTick
+        while not self.stopEvent.is_set():
+            now = monotonic()
+            if nextTick - now > self.periodSec:
+                # the clock stepped back (only the wall clock can, see util.monotonic)
+                nextTick = nextStreamLog = now
+            if now >= nextTick:
+                if self.arduino.streaming and now >= nextStreamLog:
+                    nextStreamLog = now + self.arduino.cacheReadDelayMilisec / 1000
+                    self._guard(self.arduino.WriteStreamLog)
+                self._guard(self._schedule, now)
+                nextTick += self.periodSec
+                if nextTick < now:
+                    nextTick = now + self.periodSec - ((now - nextTick) % self.periodSec)
+            
+            if not self._guard(self._execute, now, nextTick):
+                # don't spin on a persistent error
+                self.stopEvent.wait(self.periodSec)
+    
+    def _schedule(self, now):
+        '''
+        This function should be called only in this class
+        Queue the periodic commands
+        '''
+        self.arduino.ScheduleCacheUpdate()
+        self.arduino.ScheduleSerialCollection(now)
+        self.arduino.ScheduleClockSync(now)
+    
+    def _execute(self, now, nextTick):
+        '''
+        This function should be called only in this class
+        Execute the next command, waiting for one until the next tick
+        '''
+        if self.arduino.streaming:
+            # don't block on the queue, since stream blocks have to be read as they arrive
+            command = self.arduino.GetNextCommand(0)
+            if command == None:
+                self.arduino.ReadStream(min(nextTick - now, self.arduino.streamPollSec))
+        else:
+            command = self.arduino.GetNextCommand(nextTick - now)
+        
+        if command != None:
+            command.Execute()
+            self.arduino.CommandExecuted(command)
+    
+    def _guard(self, func, *args):
+        '''
+        This function should be called only in this class
+        Call func, and log its errors instead of letting them end the thread.
+        The same error usually repeats on every tick, so it's only logged when it changes.
+        
+        Returns: True if func succeeded
+        '''
+        try:
+            func(*args)
+            return True
+        except Exception as e:
+            if str(e) != self.lastError:
+                cfg.LogFromOtherThread('Arduino acquisition failed: ' + str(e))
+            self.lastError = str(e)
+            return False
+
+    def Stop(self):
+        '''
+        Stop executing commands and wait for the current one to finish
+        '''
+        self.stopEvent.set()
+        # wake the thread up if it's waiting for commands
+        self.arduino.commandQueue.put((-1, -1, None))
+        self.join()
+
+
 # base class and variables
 class SysVarDigitalArduino(SysVarDigital):
-    def __init__(self, name, pin, compName='', stateToValue={'on': 1, 'off':0}, helpLine='', editable=True, PreSetFunc=None):
+    def __init__(self, name, pin, compName='', stateToValue={'on': 1, 'off':0}, helpLine='', editable=True, PreSetFunc=None, streamRateHz=None, samplePeriodSec=None, maxSamplePeriodSec=None):
         self.stateToValue = stateToValue
         self.valueToState = {v: k for k, v in stateToValue.items()}
         SysVarDigital.__init__(self, name, self.stateToValue.keys(), Arduino, compName, helpLine, editable, PreSetFunc)
         self.pin = pin
         self.lastSetState = None
+        self.streamRateHz = streamRateHz
+        self.samplePeriodSec = samplePeriodSec
+        self.maxSamplePeriodSec = maxSamplePeriodSec
 
     def FirstTimeOnline(self):
         if self.pin != None:
             self.GetController().PinMode(self.pin, self.editable)
+            if self.samplePeriodSec != None:
+                self.GetController().SetDigitalSamplePeriod(self.pin, self.samplePeriodSec, self.maxSamplePeriodSec)
+            if self.streamRateHz != None:
+                self.GetController().StreamDigitalPin(self.pin, self.streamRateHz)
+        
+    def Set(self, state):
+        # writes done by PreSetFunc are sent together with the variable's own write
+        with self.GetController().Batch():
+            SysVarDigital.Set(self, state)
         
     def GetFunc(self):
         if self.pin != None:
@@ -418,6 +1907,10 @@ class SysVarDigitalArduino(SysVarDigital):
         else:
             return self.lastSetState
     
+    def GetSampleTime(self):
+        if self.pin != None:
+            return self.GetController().DigitalReadTime(self.pin)
+    
     def SetFunc(self, state):
         self.lastSetState = state
         if self.pin != None:
@@ -427,7 +1920,7 @@ class SysVarAnalogArduino(SysVarAnalog):
     '''
     An Arduino analog variable
     '''
-    def __init__(self, name, range, pinAnalIn, pinPwmOut=None, SetPolarityPositiveFunc=None, GetPolarityPositiveFunc=None, compName='', helpLine='', units='', PreSetFunc=None, highFreqPWM=False, pinOutVoltsMax=5, pinInVoltsMax=5, pinOutVoltsMin=0, pinInVoltsMin=0, PostGetFunc=None, I2cDac=None):
+    def __init__(self, name, range, pinAnalIn, pinPwmOut=None, SetPolarityPositiveFunc=None, GetPolarityPositiveFunc=None, compName='', helpLine='', units='', PreSetFunc=None, highFreqPWM=False, pinOutVoltsMax=5, pinInVoltsMax=5, pinOutVoltsMin=0, pinInVoltsMin=0, PostGetFunc=None, I2cDac=None, streamRateHz=None, samplePeriodSec=None, maxSamplePeriodSec=None):
         showEditBox = (pinPwmOut != None) or (PreSetFunc != None) or (I2cDac != None)
         SysVarAnalog.__init__(self, name, range, Arduino, compName, helpLine, showEditBox , units, PreSetFunc, PostGetFunc)
         self.pinIn = pinAnalIn
@@ -440,12 +1933,26 @@ class SysVarAnalogArduino(SysVarAnalog):
         self.pinOutVoltsMin = pinOutVoltsMin
         self.pinInVoltsMin = pinInVoltsMin
         self.I2cDac = I2cDac
+        self.streamRateHz = streamRateHz
+        self.samplePeriodSec = samplePeriodSec
+        self.maxSamplePeriodSec = maxSamplePeriodSec
         
     def FirstTimeOnline(self):
+        if self.samplePeriodSec != None:
+            self.GetController().SetAnalogSamplePeriod(self.pinIn, self.samplePeriodSec, self.maxSamplePeriodSec)
         if self.pinOut != None:
             self.GetController().PinModeOut(self.pinOut)
             if self.highFreqPWM:
                 self.GetController().SetHighFreqPwm(self.pinOut)
+        if self.I2cDac != None:
+            self.I2cDac.FirstTimeOnline(self.GetController())
+        if self.streamRateHz != None:
+            self.GetController().StreamAnalogPin(self.pinIn, self.streamRateHz)
+    
+    def Set(self, value):
+        # writes done by PreSetFunc (e.g. setting the polarity) are sent together with the variable's own write
+        with self.GetController().Batch():
+            SysVarAnalog.Set(self, value)
     
     def GetUnipolarRange(self):
         return self.GetUnipolarMax() - self.GetUnipolarMin()
@@ -455,6 +1962,9 @@ class SysVarAnalogArduino(SysVarAnalog):
         sign = 1 if self.GetPolarityPositiveFunc() else -1
         return sign * (self.GetUnipolarMin() + (self.GetUnipolarRange() * fraction)) if fraction != None else None
     
+    def GetSampleTime(self):
+        return self.GetController().AnalogReadTime(self.pinIn)
+    
     def SetFunc(self, value):
         fraction = (abs(value) - self.GetUnipolarMin()) / self.GetUnipolarRange()
         if self.pinOut != None:
@@ -463,6 +1973,28 @@ class SysVarAnalogArduino(SysVarAnalog):
             minV = self.pinOutVoltsMin
             maxV = self.pinOutVoltsMax
             self.I2cDac.WriteFraction((minV + (maxV - minV) * fraction) / 5, self.GetController())
+    
+    def PlayWaveform(self, values, rateHz, repeats=0):
+        '''
+        Have the Arduino play a sampled waveform on the variable's output at a fixed rate (see Arduino.PlayWaveform)
+        The polarity isn't changed while playing, so values should all have the current polarity.
+        values - the variable's values, one per sample
+        rateHz - samples per second
+        repeats - how many times to play the waveform (0 - until stopped)
+        
+        Returns: True if the waveform is playing
+        '''
+        minV = self.pinOutVoltsMin
+        maxV = self.pinOutVoltsMax
+        volts = [minV + (maxV - minV) * (abs(value) - self.GetUnipolarMin()) / self.GetUnipolarRange() for value in values]
+        if self.pinOut != None:
+            return self.GetController().PlayWaveform([Arduino.ANAL_OUT_VAL_MAX * v / Arduino.PIN_VOLT_MAX for v in volts], rateHz, 'pwm', self.pinOut, repeats=repeats)
+        elif self.I2cDac != None:
+            return self.I2cDac.PlayWaveform([v / 5 for v in volts], rateHz, self.GetController(), repeats)
+        return False
+    
+    def StopWaveform(self):
+        self.GetController().StopWaveform()
 
 
 class SysVarAnalogArduinoUnipolar(SysVarAnalogArduino):
@@ -470,8 +2002,8 @@ class SysVarAnalogArduinoUnipolar(SysVarAnalogArduino):
     A unipolar analog variable, for which the range has to be [X1,X2] or [-X1,-X2].
     The voltage on the pin (normally 0-5 V) corresponds percentage-wise to the variable's value between X1 and X2 (or -X1 and -X2).
     '''
-    def __init__(self, name, range, pinAnalIn, pinPwmOut, compName='', helpLine='', units='', PreSetFunc=None, highFreqPWM=False, pinOutVoltsMax=5, pinInVoltsMax=5, pinOutVoltsMin=0, pinInVoltsMin=0, PostGetFunc=None, I2cDac=None):
-        SysVarAnalogArduino.__init__(self, name, range, pinAnalIn, pinPwmOut, self.SetPolarityPositiveFunc, self.GetPolarityPositiveFunc, compName, helpLine, units, PreSetFunc, highFreqPWM, pinOutVoltsMax, pinInVoltsMax, pinOutVoltsMin, pinInVoltsMin, PostGetFunc, I2cDac)
+    def __init__(self, name, range, pinAnalIn, pinPwmOut, compName='', helpLine='', units='', PreSetFunc=None, highFreqPWM=False, pinOutVoltsMax=5, pinInVoltsMax=5, pinOutVoltsMin=0, pinInVoltsMin=0, PostGetFunc=None, I2cDac=None, streamRateHz=None, samplePeriodSec=None, maxSamplePeriodSec=None):
+        SysVarAnalogArduino.__init__(self, name, range, pinAnalIn, pinPwmOut, self.SetPolarityPositiveFunc, self.GetPolarityPositiveFunc, compName, helpLine, units, PreSetFunc, highFreqPWM, pinOutVoltsMax, pinInVoltsMax, pinOutVoltsMin, pinInVoltsMin, PostGetFunc, I2cDac, streamRateHz, samplePeriodSec, maxSamplePeriodSec)
         self.sign = 1 if range[0] >=0 and range[1] >= 0 else -1
 
     def SetPolarityPositiveFunc(self):
@@ -492,8 +2024,8 @@ class SysVarAnalogArduinoBipolarWithExternalPolarity(SysVarAnalogArduino):
     The voltage on the pin (normally 0-5 V) corresponds percentage-wise to the variable's absolute value between 0 and X (or -X).
     Polarity is set and read by user specific functions
     '''
-    def __init__(self, name, range, pinAnalIn, pinPwmOut, SetPolarityPositiveFunc, GetPolarityPositiveFunc, compName='', helpLine='', units='', PreSetFunc=None, highFreqPWM=False, pinOutVoltsMax=5, pinInVoltsMax=5, pinOutVoltsMin=0, pinInVoltsMin=0, PostGetFunc=None, I2cDac=None):
-        SysVarAnalogArduino.__init__(self, name, range, pinAnalIn, pinPwmOut, SetPolarityPositiveFunc, GetPolarityPositiveFunc, compName, helpLine, units, PreSetFunc, highFreqPWM, pinOutVoltsMax, pinInVoltsMax, pinOutVoltsMin, pinInVoltsMin, PostGetFunc, I2cDac)
+    def __init__(self, name, range, pinAnalIn, pinPwmOut, SetPolarityPositiveFunc, GetPolarityPositiveFunc, compName='', helpLine='', units='', PreSetFunc=None, highFreqPWM=False, pinOutVoltsMax=5, pinInVoltsMax=5, pinOutVoltsMin=0, pinInVoltsMin=0, PostGetFunc=None, I2cDac=None, streamRateHz=None, samplePeriodSec=None, maxSamplePeriodSec=None):
+        SysVarAnalogArduino.__init__(self, name, range, pinAnalIn, pinPwmOut, SetPolarityPositiveFunc, GetPolarityPositiveFunc, compName, helpLine, units, PreSetFunc, highFreqPWM, pinOutVoltsMax, pinInVoltsMax, pinOutVoltsMin, pinInVoltsMin, PostGetFunc, I2cDac, streamRateHz, samplePeriodSec, maxSamplePeriodSec)
 
     def GetUnipolarMin(self):
         return 0
@@ -508,8 +2040,10 @@ class SysCompArduino(SysComp):
         SysComp.__init__(self, name, vars, Arduino, helpLine)
         
     def FirstTimeOnline(self):
-        for var in self.vars.values():
-            var.FirstTimeOnline()
+        # the variables' setup commands don't wait for each other
+        with self.GetController().Pipeline():
+            for var in self.vars.values():
+                var.FirstTimeOnline()
             
 
 class SysVarPidRelayArduino(SysVarAnalog):
@@ -539,6 +2073,9 @@ class SysVarPidRelayArduino(SysVarAnalog):
         fraction = self.GetController().AnalogReadFraction(self.pinAnalIn, self.pinInVoltsMax, self.pinInVoltsMin)
         return (self.range[0] + (self.range[1] - self.range[0]) * fraction) if fraction != None else None
     
+    def GetSampleTime(self):
+        return self.GetController().AnalogReadTime(self.pinAnalIn)
+    
     def SetFunc(self, value):
         # write the setpoint in the range of the analog input pin
         fraction = (value - self.range[0]) / (self.range[1] - self.range[0])
@@ -4,11 +4,39 @@ class ArduinoDac(object):
     def __init__(self, dacBits):
         self.maxVal = 2**dacBits-1
 
+    def FirstTimeOnline(self, controller):
+        '''Prepare the pins the DAC needs (if any)
+        '''
+        pass
+
+    def FractionToValue(self, fraction):
+        return (int)(self.maxVal * fraction)
+
     def WriteFraction(self, fraction, controller):
         '''Sub-classes should implement this
         '''
         pass
 
+    def WaveformTarget(self):
+        '''How the Arduino writes waveform samples to this DAC: (target, address, header) (see Arduino.PlayWaveform)
+        Sub-classes that support waveforms should implement this
+        '''
+        return None
+
+    def PlayWaveform(self, fractions, rateHz, controller, repeats=0):
+        '''Upload a sampled waveform and have the Arduino play it on this DAC at a fixed rate
+        fractions - the output samples, each between 0-1
+        rateHz - samples per second
+        repeats - how many times to play the waveform (0 - until stopped)
+
+        Returns: True if the waveform is playing
+        '''
+        target = self.WaveformTarget()
+        if target == None:
+            return False
+        target, address, header = target
+        return controller.PlayWaveform([self.FractionToValue(fraction) for fraction in fractions], rateHz, target, address, header, repeats)
+
 class DacI2cMAX517(ArduinoDac):
     '''An I2C DAC connected to an Arduino.
     '''
@@ -17,31 +45,101 @@ class DacI2cMAX517(ArduinoDac):
         self.dacBits = 8
         super(DacI2cMAX517, self).__init__(self.dacBits)
 
+    def CommandByte(self):
+        return 0
+
+    def I2cValues(self, fraction):
+        '''The bytes that set the output to fraction. Several of them can be sent in one I2C write (see ArduinoDacGroup).
+        '''
+        return (self.CommandByte(), self.FractionToValue(fraction))
+
     def WriteFraction(self, fraction, controller):
-        controller.I2cWrite(self.address, (0, self.maxVal * fraction,))
+        controller.I2cWrite(self.address, self.I2cValues(fraction))
+
+    def WaveformTarget(self):
+        return ('i2c', self.address, self.CommandByte())
+
+class DacI2cMAX518(DacI2cMAX517):
+    '''A channel in a dual I2C DAC connected to an Arduino.
+    When both channels are written in the same I2C write, they're updated together (see ArduinoDacGroup).
+    '''
+    def __init__(self, address, channel):
+        self.channel = channel
+        super(DacI2cMAX518, self).__init__(address)
+
+    def CommandByte(self):
+        return self.channel & 1
 
 class DacSpiMCP4922(ArduinoDac):
     '''A channel in an SPI DAC connected to an Arduino.
+    ldac_pin - the digital pin connected to the chip's LDAC input (optional). It's kept low, so outputs change as soon as they're written,
+               and raised while several channels are written, so they change together (see ArduinoDacGroup).
     '''
-    def __init__(self, cs_pin, channel):
+    def __init__(self, cs_pin, channel, ldac_pin=None):
         self.dacBits = 12
         self.maxVal = 2**self.dacBits-1
         self.cs_pin = cs_pin
         self.channel = channel
-        
+        self.ldac_pin = ldac_pin
+
         super(DacSpiMCP4922, self).__init__(self.dacBits)
 
+    def FirstTimeOnline(self, controller):
+        if self.ldac_pin != None:
+            controller.PinModeOut(self.ldac_pin)
+            controller.DigitalWrite(self.ldac_pin, 0)
+
+    def Header(self):
+        '''The configuration bits of a 16-bit write to the DAC's register (channel, 1x gain, active)
+        '''
+        dac_register = 0x3000
+        if self.channel == 1:
+            dac_register |= (1<<15)
+        return dac_register
+
     def WriteFraction(self, fraction, controller):
-        value = (int)(self.maxVal * fraction)
-        
-        dac_register = 0x30
-        dac_byte2_mask = 0x00FF
-        dac_byte1 = (value >> 8) | dac_register
-        dac_byte2 = value & dac_byte2_mask
-
-        if self.channel == 0:
-            dac_byte1 &= ~(1<<7)
-        elif self.channel == 1:
-            dac_byte1 |= (1<<7)
-        
-        controller.SpiWrite(self.cs_pin, (dac_byte1, dac_byte2))
\ No newline at end of file
+        word = self.Header() | self.FractionToValue(fraction)
+        controller.SpiWrite(self.cs_pin, (word >> 8, word & 0x00FF))
+
+    def WaveformTarget(self):
+        return ('spi', self.cs_pin, self.Header())
+
+class ArduinoDacGroup(object):
+    '''DAC channels (possibly on several chips) that are updated together, in one transaction (see Arduino.Batch).
+    Chips with latched updates change their outputs at the same moment: MCP4922 channels with an LDAC pin are held while they're written,
+    and the channels of a MAX518 are written in a single I2C write.
+    '''
+    def __init__(self, dacs):
+        self.dacs = dacs
+
+    def FirstTimeOnline(self, controller):
+        for dac in self.dacs:
+            dac.FirstTimeOnline(controller)
+
+    def WriteFractions(self, fractions, controller):
+        '''Write a fraction (between 0-1) to each DAC, in the order of the DACs
+        '''
+        ldacPins = []
+        i2cWrites = []
+        for dac in self.dacs:
+            ldacPin = getattr(dac, 'ldac_pin', None)
+            if ldacPin != None and ldacPin not in ldacPins:
+                ldacPins.append(ldacPin)
+
+        with controller.Batch():
+            for pin in ldacPins:
+                controller.DigitalWrite(pin, 1)
+            for dac, fraction in zip(self.dacs, fractions):
+                if isinstance(dac, DacI2cMAX517):
+                    for address, values in i2cWrites:
+                        if address == dac.address:
+                            values.extend(dac.I2cValues(fraction))
+                            break
+                    else:
+                        i2cWrites.append((dac.address, list(dac.I2cValues(fraction))))
+                else:
+                    dac.WriteFraction(fraction, controller)
+            for address, values in i2cWrites:
+                controller.I2cWrite(address, values)
+            for pin in ldacPins:
+                controller.DigitalWrite(pin, 0)
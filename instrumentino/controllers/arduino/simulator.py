@@ -0,0 +1,502 @@
+from __future__ import division
+__author__ = 'yoelk'
+
+import os
+import pty
+import tty
+import time
+import math
+import select
+import struct
+import random
+from threading import Thread, Event, Lock
+from Queue import Queue
+from instrumentino.controllers.arduino import ArduinoBinaryProtocol
+from instrumentino.util import monotonic
+
+class ControlinoSimulator(object):
+    '''
+    A software stand-in for the controlino sketch, running on a pseudo-terminal (Linux only).
+    It speaks both the ASCII and the binary protocol, so Arduino.Connect can be pointed at it like at any other port.
+    This allows benchmarking and testing the Arduino controller and the components without real boards.
+
+    The latency, the noise of analog inputs and the rate of dropped replies are configurable.
+    Analog inputs read a constant, a function of time, or the PWM value of a linked output pin.
+
+    Usage:
+        simulator = ControlinoSimulator(latencySec=0.002, noiseCounts=1)
+        simulator.Start()
+        arduino.Connect(simulator.portName)
+        ...
+        simulator.Stop()
+    '''
+
+    # the keywords of each command's enumerated argument (the binary protocol sends their index)
+    keywordChoices = {'Write': ('digi', 'anal'),
+                      'Set': ('in', 'out'),
+                      'SerSend': ('hard', 'soft'),
+                      'SerReceive': ('hard', 'soft'),
+                      'Protocol': ('ascii', 'binary'),
+                      'WavePlay': ('pwm', 'spi', 'i2c')}
+
+    # stream blocks are sent this often
+    streamBlockSec = 0.01
+
+    def __init__(self, latencySec=0, noiseCounts=0, dropRate=0, seed=None):
+        '''
+        latencySec - the delay before each reply is sent
+        noiseCounts - the standard deviation of the gaussian noise added to analog inputs (0-1023)
+        dropRate - the probability of a reply to get lost (the command is still executed)
+        seed - a seed for the random noise and drops, for repeatable runs
+        '''
+        self.latencySec = latencySec
+        self.noiseCounts = noiseCounts
+        self.dropRate = dropRate
+        self.random = random.Random(seed)
+        self.protocol = ArduinoBinaryProtocol()
+        self.opcodes = {opcode: (name, argTypes) for name, (opcode, argTypes) in self.protocol.commands.items()}
+
+        self.master = None
+        self.slave = None
+        self.portName = None
+        self.writeLock = Lock()
+        self.stopEvent = Event()
+        self.replies = Queue()
+        self.threads = []
+        self.startTime = monotonic()
+        self.analogInputs = {}
+        self.linkedPins = {}
+        self.serialResponders = {}
+        self.Reset()
+
+    def Reset(self):
+        '''
+        Return the simulated board to its power-up state
+        '''
+        self.binary = False
+        self.pinModesOut = {}
+        self.digitalValues = {}
+        self.pwmValues = {}
+        self.highFreqPwmPins = set()
+        self.pidRelays = {}
+        self.i2cWrites = {}
+        self.spiWrites = {}
+        self.serialPorts = {}
+        self.blinkingPins = {}
+        self.streamPeriodUs = None
+        self.streamPins = []
+        self.waveform = [0] * 256
+        self.waveformPlaying = None
+        self.commandsExecuted = 0
+        self.repliesDropped = 0
+
+    def Start(self):
+        '''
+        Open the pseudo-terminal and start serving commands
+
+        Returns: the name of the port to connect to
+        '''
+        self.master, self.slave = pty.openpty()
+        tty.setraw(self.slave)
+        self.portName = os.ttyname(self.slave)
+        self.stopEvent.clear()
+        self.threads = [Thread(target=self._serve), Thread(target=self._sendReplies), Thread(target=self._stream)]
+        for thread in self.threads:
+            thread.daemon = True
+            thread.start()
+        return self.portName
+
+    def Stop(self):
+        '''
+        Stop serving commands and close the pseudo-terminal
+        '''
+        self.stopEvent.set()
+        self.replies.put((0, None))
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+        os.close(self.master)
+        os.close(self.slave)
+        self.master = None
+        self.slave = None
+
+    def SetAnalogInput(self, pin, value):
+        '''
+        Set what an analog input pin reads
+        value - a value between 0-1023, or a function that gets the time (in seconds since the start) and returns such a value
+        '''
+        self.analogInputs[pin] = value
+
+    def LinkPins(self, pinPwmOut, pinAnalIn):
+        '''
+        Have an analog input pin read the PWM output of another pin, as if they were wired together
+        '''
+        self.linkedPins[pinAnalIn] = pinPwmOut
+
+    def SetSerialResponder(self, port, responder):
+        '''
+        Set how a device on a serial port (software or hardware) responds to the data sent to it
+        responder - a function that gets the sent data and returns the response. By default, the data is echoed back.
+        '''
+        self.serialResponders[port] = responder
+
+    def AnalogRead(self, pin):
+        '''
+        Returns: the value of an analog input pin, as the sketch would read it (0-1023)
+        '''
+        self._playWaveform()
+        if pin in self.linkedPins:
+            value = self.pwmValues.get(self.linkedPins[pin], 0) * 1023 / 255
+        else:
+            value = self.analogInputs.get(pin, 0)
+            if callable(value):
+                value = value(monotonic() - self.startTime)
+        if self.noiseCounts > 0:
+            value += self.random.gauss(0, self.noiseCounts)
+        return int(min(1023, max(0, round(value))))
+
+    def DigitalRead(self, pin):
+        '''
+        Returns: the value of a digital pin (0 or 1)
+        '''
+        for pidRelay in self.pidRelays.values():
+            if pidRelay['pinDigiOut'] == pin and pidRelay['enabled']:
+                return 1 if self.AnalogRead(pidRelay['pinAnalIn']) < pidRelay['setPoint'] else 0
+        if pin in self.blinkingPins:
+            return int((monotonic() - self.startTime) * 1000 / self.blinkingPins[pin]) % 2
+        return self.digitalValues.get(pin, 0)
+
+    def Execute(self, name, args):
+        '''
+        Execute a command, given as a name and a list of text arguments (as in the ASCII protocol)
+
+        Returns: the reply's values (a list of numbers or a string), or None if the command failed
+        '''
+        self.commandsExecuted += 1
+        self._playWaveform()
+        try:
+            if name == 'Read':
+                return [self.AnalogRead(int(pin[1:])) if pin[0] == 'A' else self.DigitalRead(int(pin[1:])) for pin in args]
+            elif name == 'Write':
+                if args[1] == 'digi':
+                    self.digitalValues[int(args[0])] = int(args[2])
+                else:
+                    self.pwmValues[int(args[0])] = int(args[2])
+            elif name == 'Set':
+                self.pinModesOut[int(args[0])] = (args[1] == 'out')
+            elif name == 'SetPwmFreq':
+                self.highFreqPwmPins.add(int(args[0]))
+            elif name == 'PidRelayCreate':
+                self.pidRelays[int(args[0])] = {'pinAnalIn': int(args[1]), 'pinDigiOut': int(args[2]), 'windowSizeMs': int(args[3]),
+                                                'tuning': [float(k) for k in args[4:7]], 'setPoint': 0, 'enabled': False}
+            elif name == 'PidRelaySet':
+                self.pidRelays[int(args[0])]['setPoint'] = float(args[1])
+            elif name == 'PidRelayTune':
+                self.pidRelays[int(args[0])]['tuning'] = [float(k) for k in args[1:4]]
+            elif name == 'PidRelayEnable':
+                self.pidRelays[int(args[0])]['enabled'] = (int(args[1]) != 0)
+            elif name == 'HardSerConnect':
+                self.serialPorts[int(args[1])] = ''
+            elif name == 'SoftSerConnect':
+                self.serialPorts[int(args[3])] = ''
+            elif name == 'SerSend':
+                port = int(args[1])
+                data = args[2] if len(args) > 2 else ''
+                responder = self.serialResponders.get(port, lambda data: data)
+                self.serialPorts[port] = self.serialPorts.get(port, '') + responder(data)
+            elif name == 'SerReceive':
+                port = int(args[1])
+                data = self.serialPorts.get(port, '')
+                self.serialPorts[port] = ''
+                return data
+            elif name == 'Reset':
+                self.pinModesOut = {}
+                self.blinkingPins = {}
+                self.pidRelays = {}
+                self.waveformPlaying = None
+            elif name == 'BlinkPin':
+                self.blinkingPins[int(args[0])] = int(args[1])
+            elif name == 'I2cWrite':
+                self.i2cWrites[int(args[0])] = [int(float(value)) for value in args[1:]]
+            elif name == 'SpiWrite':
+                self.spiWrites[int(args[0])] = [int(float(value)) for value in args[1:]]
+            elif name == 'Protocol':
+                self.binary = (args[0] == 'binary')
+            elif name == 'StreamStart':
+                self.streamPins = args[1:]
+                self.streamPeriodUs = int(args[0])
+            elif name == 'StreamStop':
+                self.streamPeriodUs = None
+            elif name == 'WaveLoad':
+                start = int(args[0])
+                values = [int(value) for value in args[1:]]
+                if start + len(values) > len(self.waveform):
+                    return None
+                self.waveform[start:start + len(values)] = values
+            elif name == 'WavePlay':
+                samplesNum = int(args[4])
+                if samplesNum == 0 or samplesNum > len(self.waveform):
+                    return None
+                self.waveformPlaying = {'target': args[0], 'address': int(args[1]), 'header': int(args[2]), 'periodUs': int(args[3]),
+                                        'samplesNum': samplesNum, 'repeats': int(args[5]), 'startTime': monotonic()}
+                self._playWaveform()
+            elif name == 'WaveStop':
+                self.waveformPlaying = None
+            elif name == 'Batch':
+                for subName, subArgs in args:
+                    if self.Execute(subName, subArgs) == None:
+                        return None
+            else:
+                return None
+        except (ValueError, IndexError, KeyError):
+            return None
+        return []
+
+    def _playWaveform(self):
+        '''
+        This function should be called only in this class
+        Output the waveform sample that should be playing now (if any), as the sketch's timer would
+        '''
+        playing = self.waveformPlaying
+        if playing == None:
+            return
+        
+        idx = int((monotonic() - playing['startTime']) * 1e6 / playing['periodUs'])
+        if playing['repeats'] > 0 and idx >= playing['repeats'] * playing['samplesNum']:
+            idx = playing['samplesNum'] - 1
+            self.waveformPlaying = None
+        value = self.waveform[idx % playing['samplesNum']]
+        
+        if playing['target'] == 'pwm':
+            self.pwmValues[playing['address']] = value
+        elif playing['target'] == 'spi':
+            word = playing['header'] | value
+            self.spiWrites[playing['address']] = [word >> 8, word & 0xFF]
+        else:
+            self.i2cWrites[playing['address']] = [playing['header'], value]
+
+    def _serve(self):
+        '''
+        This function should be called only in this class
+        Read and execute commands until stopped
+        '''
+        buf = ''
+        while not self.stopEvent.is_set():
+            ready, _, _ = select.select([self.master], [], [], 0.05)
+            if len(ready) == 0:
+                continue
+            try:
+                buf += os.read(self.master, 4096)
+            except OSError:
+                continue
+
+            while True:
+                if self.binary:
+                    buf, done = self._serveFrame(buf)
+                else:
+                    buf, done = self._serveLine(buf)
+                if not done:
+                    break
+
+    def _serveLine(self, buf):
+        '''
+        This function should be called only in this class
+        Execute the next ASCII command line in buf, if complete. Commands in a line may be batched (separated by ';').
+        After a 'SerSend' line, the data to send follows, up to a NULL character.
+
+        Returns: (the rest of buf, True if a command was executed)
+        '''
+        idx = min([i for i in (buf.find('\r'), buf.find('\n')) if i != -1] or [-1])
+        if idx == -1:
+            return buf, False
+        line, buf = buf[:idx].strip(), buf[idx + 1:]
+        if line == '':
+            return buf, True
+
+        values = []
+        for command in line.split(';'):
+            name, _, args = command.strip().partition(' ')
+            args = args.split()
+            if name == 'SerSend':
+                # acknowledge the command, and wait for the data
+                self._reply('done\r\n')
+                end = buf.find('\0')
+                while end == -1 and not self.stopEvent.is_set():
+                    select.select([self.master], [], [], 0.05)
+                    buf += os.read(self.master, 4096)
+                    end = buf.find('\0')
+                args.append(buf[:end])
+                buf = buf[end + 1:]
+            values = self.Execute(name, args)
+            if values == None:
+                break
+
+        if values == None:
+            # the sketch doesn't reply to unknown or bad commands
+            return buf, True
+        text = values if isinstance(values, str) else ' '.join(str(value) for value in values)
+        self._reply((text + ' ' if text != '' else '') + 'done\r\n')
+        return buf, True
+
+    def _serveFrame(self, buf):
+        '''
+        This function should be called only in this class
+        Execute the next binary command frame in buf, if complete
+
+        Returns: (the rest of buf, True if a command was executed)
+        '''
+        start = buf.find(chr(ArduinoBinaryProtocol.SYNC))
+        if start == -1:
+            return '', False
+        buf = buf[start:]
+        if len(buf) < 3:
+            return buf, False
+        length = struct.unpack('<H', buf[1:3])[0]
+        if len(buf) < 5 + length:
+            return buf, False
+
+        body, crc, buf = buf[1:3 + length], buf[3 + length:5 + length], buf[5 + length:]
+        if struct.unpack('<H', crc)[0] != self.protocol.Crc(body) or length < 2:
+            # a corrupted frame. Look for the next one.
+            return body + crc + buf, True
+
+        sequence = ord(body[2])
+        try:
+            name, args = self._decodePayload(body[3:])
+        except (KeyError, IndexError, struct.error):
+            return buf, True
+
+        wasBinary = self.binary
+        values = self.Execute(name, args)
+        if values == None:
+            reply = struct.pack('<BB', sequence, 1)
+        elif name == 'Read':
+            # the time when the pins were sampled comes first
+            reply = struct.pack('<BBI%dH'%len(values), sequence, ArduinoBinaryProtocol.STATUS_DONE, self._micros() % 2**32, *values)
+        elif isinstance(values, str):
+            reply = struct.pack('<BB', sequence, ArduinoBinaryProtocol.STATUS_DONE) + values
+        else:
+            reply = struct.pack('<BB%dH'%len(values), sequence, ArduinoBinaryProtocol.STATUS_DONE, *values)
+
+        self._reply(self.protocol.EncodeFrame(reply) if wasBinary else 'done\r\n')
+        return buf, True
+
+    def _decodePayload(self, payload):
+        '''
+        This function should be called only in this class
+        Translate a binary command (opcode and arguments) to its name and text arguments
+        '''
+        name, argTypes = self.opcodes[ord(payload[0])]
+        data = payload[1:]
+        if name == 'Batch':
+            commands = []
+            while len(data) > 0:
+                length = ord(data[0])
+                commands.append(self._decodePayload(data[1:1 + length]))
+                data = data[1 + length:]
+            return name, commands
+
+        args = []
+        for argType in argTypes:
+            if argType == 'E':
+                args.append(self.keywordChoices[name][ord(data[0])])
+                data = data[1:]
+            elif argType == 'P':
+                args += [('A' if ord(pin) & ArduinoBinaryProtocol.ANALOG_PIN_FLAG else 'D') + str(ord(pin) & ~ArduinoBinaryProtocol.ANALOG_PIN_FLAG) for pin in data]
+                data = ''
+            elif argType == 'V':
+                args += [str(ord(value)) for value in data]
+                data = ''
+            elif argType == 'W':
+                args += [str(value) for value in struct.unpack('<%dH'%(len(data) // 2), data)]
+                data = ''
+            elif argType == 'S':
+                args.append(data)
+                data = ''
+            else:
+                size = struct.calcsize('<' + argType)
+                args.append(str(struct.unpack('<' + argType, data[:size])[0]))
+                data = data[size:]
+        return name, args
+
+    def _reply(self, data):
+        '''
+        This function should be called only in this class
+        Send a reply after the configured latency, unless it's dropped
+        '''
+        if self.dropRate > 0 and self.random.random() < self.dropRate:
+            self.repliesDropped += 1
+            return
+        self.replies.put((monotonic() + self.latencySec, data))
+
+    def _sendReplies(self):
+        '''
+        This function should be called only in this class
+        Send the replies when they're due
+        '''
+        while not self.stopEvent.is_set():
+            dueTime, data = self.replies.get()
+            if data == None:
+                break
+            delay = dueTime - monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            self._write(data)
+
+    def _stream(self):
+        '''
+        This function should be called only in this class
+        Push stream blocks while streaming
+        '''
+        nextSampleUs = None
+        while not self.stopEvent.wait(self.streamBlockSec):
+            periodUs, pins = self.streamPeriodUs, self.streamPins
+            if periodUs == None or not self.binary:
+                nextSampleUs = None
+                continue
+
+            nowUs = self._micros()
+            if nextSampleUs == None:
+                nextSampleUs = nowUs
+            samples = ''
+            while nextSampleUs <= nowUs:
+                values = [self.AnalogRead(int(pin[1:])) if pin[0] == 'A' else self.DigitalRead(int(pin[1:])) for pin in pins]
+                samples += struct.pack('<I%dH'%len(values), nextSampleUs % 2**32, *values)
+                nextSampleUs += periodUs
+            if samples != '':
+                self._write(self.protocol.EncodeFrame(struct.pack('<B', ArduinoBinaryProtocol.STREAM_BLOCK) + samples))
+
+    def _micros(self):
+        '''
+        This function should be called only in this class
+        Returns: the simulated board's time in microseconds since it started. Like the Arduino's counter, it's sent modulo 2**32.
+        '''
+        return int((monotonic() - self.startTime) * 1e6)
+
+    def _write(self, data):
+        '''
+        This function should be called only in this class
+        Write data to the port
+        '''
+        with self.writeLock:
+            try:
+                os.write(self.master, data)
+            except OSError:
+                pass
+
+
+def SineWave(amplitude=400, offset=512, periodSec=10):
+    '''
+    An analog input that follows a sine wave (see ControlinoSimulator.SetAnalogInput)
+    '''
+    return lambda t: offset + amplitude * math.sin(2 * math.pi * t / periodSec)
+
+if __name__ == '__main__':
+    simulator = ControlinoSimulator(latencySec=0.001, noiseCounts=1)
+    simulator.SetAnalogInput(0, SineWave())
+    print 'Simulated controlino on ' + simulator.Start()
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        simulator.Stop()
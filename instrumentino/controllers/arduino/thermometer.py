@@ -6,9 +6,11 @@ __author__ = 'yoelk'
 from instrumentino import cfg
 
 class AnalogPinThermometer(SysCompArduino):
-    def __init__(self, name, rangeT, pinInT, pinInVoltsMax, pinInVoltsMin):
+    # temperature changes slowly, so it's sampled at most once a second, and less often while it's steady
+    def __init__(self, name, rangeT, pinInT, pinInVoltsMax, pinInVoltsMin, samplePeriodSec=1, maxSamplePeriodSec=10):
         SysCompArduino.__init__(self, name,
-                                (SysVarAnalogArduinoUnipolar('T', rangeT, pinInT, None, name, 'Temperature', 'C', pinInVoltsMax=pinInVoltsMax, pinInVoltsMin=pinInVoltsMin),),
+                                (SysVarAnalogArduinoUnipolar('T', rangeT, pinInT, None, name, 'Temperature', 'C', pinInVoltsMax=pinInVoltsMax, pinInVoltsMin=pinInVoltsMin,
+                                                             samplePeriodSec=samplePeriodSec, maxSamplePeriodSec=maxSamplePeriodSec),),
                                 'measure the temperature')
 
 
@@ -0,0 +1,89 @@
+from __future__ import division
+__author__ = 'yoelk'
+
+from threading import Thread, Condition
+from instrumentino.util import SerialUtil
+
+class ControllerDiscovery(object):
+    '''
+    Find the serial ports of controllers and connect them, probing all the candidate ports in parallel.
+    Candidate ports are the USB ports of the vendors a controller class declares (usbVendorIds).
+    A controller is identified by connecting to it, which includes its handshake (e.g. the Arduino has to answer a command).
+    Controllers without usbVendorIds are only connected if their port is given.
+    '''
+    def __init__(self, controllers, controllerPorts={}):
+        '''
+        controllers - the controllers to connect. Controllers that are already online are skipped.
+        controllerPorts - for each controller name, the port name or the USB serial number of its board (optional)
+        '''
+        self.controllers = controllers
+        self.controllerPorts = controllerPorts
+        self.condition = Condition()
+        self.claimed = set()
+        self.connected = {}
+
+    def ConnectAll(self, OnConnect=None):
+        '''
+        Connect all the controllers that can be found. Blocks until all the candidate ports are probed.
+        OnConnect - called with each controller that connects (from the probing thread)
+
+        Returns: a dictionary of the connected controllers and their ports
+        '''
+        pending = [c for c in self.controllers if not c.online and (c.usbVendorIds != None or c.name in self.controllerPorts)]
+        if len(pending) == 0:
+            return {}
+
+        # ports given explicitly aren't candidates for other controllers
+        reserved = set(self.controllerPorts.values())
+        ports = SerialUtil().getSerialPortsInfo()
+        listed = set(port for port, _, _ in ports) | set(serialNumber for _, _, serialNumber in ports)
+        # ports given explicitly might not be listed (e.g. pseudo-terminals)
+        ports += [(hint, None, None) for hint in reserved if hint not in listed]
+        
+        threads = []
+        for port, vendorId, serialNumber in ports:
+            candidates = []
+            for controller in pending:
+                hint = self.controllerPorts.get(controller.name)
+                if hint != None:
+                    if hint in (port, serialNumber):
+                        candidates.insert(0, controller)
+                elif vendorId in controller.usbVendorIds and port not in reserved and serialNumber not in reserved:
+                    candidates.append(controller)
+
+            if len(candidates) > 0:
+                thread = Thread(target=self._probe, args=(port, candidates, OnConnect))
+                thread.daemon = True
+                thread.start()
+                threads.append(thread)
+
+        for thread in threads:
+            thread.join()
+        return dict(self.connected)
+
+    def _probe(self, port, candidates, OnConnect):
+        '''
+        This function should be called only in this class
+        Try connecting the candidate controllers to a port, until one of them connects.
+        A controller is tried on one port at a time. If it's being tried on another port, this waits for the result,
+        and tries it here only if it didn't connect there.
+        '''
+        for controller in candidates:
+            with self.condition:
+                while controller in self.claimed:
+                    self.condition.wait()
+                if controller.online:
+                    continue
+                self.claimed.add(controller)
+
+            connected = controller.Connect(port)
+            with self.condition:
+                if connected:
+                    controller.online = True
+                    self.connected[controller] = port
+                self.claimed.discard(controller)
+                self.condition.notify_all()
+            if connected:
+                if OnConnect != None:
+                    OnConnect(controller)
+                return
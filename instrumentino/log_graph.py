@@ -1,10 +1,14 @@
 from __future__ import division
 __author__ = 'yoelk'
 from datetime import datetime
+import time
 import wx
 from wx import xrc
 from instrumentino.comp import SysVarAnalog, SysVarDigital
 from instrumentino import cfg
+from instrumentino.util import SignalBuffer, MinMaxPyramid
+from instrumentino import signal_log, signal_store
+from instrumentino.replay import SignalLogReplay
 from itertools import cycle
 import numpy as np
 import matplotlib
@@ -15,28 +19,72 @@ from matplotlib.backends.backend_wx import NavigationToolbar2Wx
 from matplotlib.backends.backend_wxagg import NavigationToolbar2WxAgg as NavigationToolbar
 from matplotlib import pyplot as plt
 from matplotlib.dates import DateFormatter, MinuteLocator, SecondLocator,\
-    AutoDateFormatter, AutoDateLocator
+    AutoDateFormatter, AutoDateLocator, epoch2num
 
-class Data():
+class Data(SignalBuffer):
     '''
-    A class to describe collected data
+    A class to describe collected data: the values and their acquisition times
     '''
-    def __init__(self):
-        self.data = []
+    def __init__(self, dtype=np.float64, spill=False):
+        '''
+        spill - keep the data that doesn't fit in memory on disk (see LogGraphPanel.spillDirectory)
+        '''
+        SignalBuffer.__init__(self, LogGraphPanel.bufferChunkRows, LogGraphPanel.bufferWindowChunks, dtype,
+                              spill=spill, spillDirectory=LogGraphPanel.spillDirectory)
 
 class AnalogData(Data):
     '''
     A class to describe collected analog data
     '''
-    def __init__(self, yRange):
-        Data.__init__(self)
+    def __init__(self, yRange, decimated=False, spill=False):
+        '''
+        decimated - also keep the data at lower resolutions, for plotting (see MinMaxPyramid)
+        spill - keep the data that doesn't fit in memory on disk, so it can still be plotted
+        '''
+        Data.__init__(self, spill=spill)
         self.yRange = yRange
+        self.pyramid = MinMaxPyramid(LogGraphPanel.bufferChunkRows, LogGraphPanel.bufferWindowChunks,
+                                     spill, LogGraphPanel.spillDirectory) if decimated else None
+
+    def Append(self, sampleTime, value=None):
+        Data.Append(self, sampleTime, value)
+        if self.pyramid != None:
+            self.pyramid.Append(sampleTime, value)
+
+    def Extend(self, times, values=None):
+        Data.Extend(self, times, values)
+        if self.pyramid != None:
+            self.pyramid.Extend(times, values)
+
+    def Close(self):
+        Data.Close(self)
+        if self.pyramid != None:
+            self.pyramid.Close()
 
 class LogGraphPanel(wx.Panel):
     '''
     A panel with a log graph
     adapted from examples by Eli Bendersky (eliben@gmail.com)
     '''
+    # the data is kept in memory for the longest zoom (60 minutes at the default update rate).
+    # Older plotted data is moved to memory-mapped files in spillDirectory (None for the system's temporary directory),
+    # so the whole run can be viewed. When spillToDisk is False, older data is only in the log file.
+    bufferChunkRows = 1024
+    bufferWindowChunks = 16
+    spillToDisk = True
+    spillDirectory = None
+    
+    # the time axis follows the data in steps of this fraction of the visible span, rather than on every update,
+    # so the cached background only has to be redrawn once per step (see Redraw)
+    axisStepFraction = 0.1
+    
+    # the plot is refreshed on its own timer (see RefreshPlot), at most this many times a second, whatever the acquisition rate
+    plotFrameRate = 10
+    
+    # recorded logs can be replayed in the graph (see StartReplay), at these speeds
+    replaySpeeds = [1, 10, 100, 1000]
+    replayTickMilisec = 100
+    
     def __init__(self, parent, sysComps):
         '''
         Creates the main panel with all the controls on it
@@ -54,6 +102,22 @@ class LogGraphPanel(wx.Panel):
         self.slider_zoom.SetTickFreq(10, 1)
         self.Bind(wx.EVT_COMMAND_SCROLL_THUMBTRACK, self.on_slider_width, self.slider_zoom)
 
+        # replay controls, only shown while a recorded log is replayed
+        self.replay = None
+        self.replayTimer = wx.Timer(self)
+        self.Bind(wx.EVT_TIMER, self.OnReplayTimer, self.replayTimer)
+        self.replayPlayButton = wx.ToggleButton(self, -1, "Play")
+        self.Bind(wx.EVT_TOGGLEBUTTON, self.on_replay_play, self.replayPlayButton)
+        self.replaySpeedChoice = wx.Choice(self, -1, choices=[str(speed) + 'x' for speed in self.replaySpeeds])
+        self.replaySpeedChoice.SetSelection(0)
+        self.Bind(wx.EVT_CHOICE, self.on_replay_speed, self.replaySpeedChoice)
+        self.replaySlider = wx.Slider(self, -1, value=0, minValue=0, maxValue=1000)
+        for event in (wx.EVT_COMMAND_SCROLL_THUMBRELEASE, wx.EVT_COMMAND_SCROLL_PAGEUP, wx.EVT_COMMAND_SCROLL_PAGEDOWN):
+            self.Bind(event, self.on_replay_seek, self.replaySlider)
+        self.replayTimeLabel = wx.StaticText(self, -1, "")
+        self.replayStopButton = wx.Button(self, -1, "Stop replay")
+        self.Bind(wx.EVT_BUTTON, self.on_replay_stop, self.replayStopButton)
+
         # set figure
         self.dpi = 100
         self.figure, self.axes = plt.subplots()
@@ -68,6 +132,13 @@ class LogGraphPanel(wx.Panel):
         self.axes.set_axis_bgcolor('white')
         
         self.figure.canvas.mpl_connect('pick_event', self.OnPick)
+        self.figure.canvas.mpl_connect('draw_event', self.OnDraw)
+        self.background = None
+        self.backgroundKey = None
+        self.axisZoom = None
+        self.plottedRowsCount = 0
+        self.plottedBounds = None
+        self.nextFrameTime = 0
 
         # Show on screen
         self.controllersHBox = wx.BoxSizer(wx.HORIZONTAL)
@@ -80,6 +151,16 @@ class LogGraphPanel(wx.Panel):
         self.vbox = wx.BoxSizer(wx.VERTICAL)
         self.vbox.Add(self.canvas, 1, wx.EXPAND | wx.GROW | wx.ALL)
         self.vbox.Add(self.controllersHBox, 0, wx.EXPAND)
+        
+        self.replayHBox = wx.BoxSizer(wx.HORIZONTAL)
+        self.replayHBox.Add(self.replayPlayButton, 0)
+        self.replayHBox.Add(self.replaySpeedChoice, 0)
+        self.replayHBox.Add(self.replaySlider, 1)
+        self.replayHBox.Add(self.replayTimeLabel, 0, wx.ALIGN_CENTER_VERTICAL)
+        self.replayHBox.AddSpacer(10)
+        self.replayHBox.Add(self.replayStopButton, 0)
+        self.vbox.Add(self.replayHBox, 0, wx.EXPAND)
+        self.vbox.Show(self.replayHBox, False)
                 
         # fit all to screen
         self.parent.GetSizer().Add(self, 1, wx.EXPAND | wx.GROW | wx.ALL)
@@ -88,12 +169,18 @@ class LogGraphPanel(wx.Panel):
                 
         # order data sources
         self.lastTime = None
-        self.time = []
+        self.firstRowTime = None
+        self.time = SignalBuffer(self.bufferChunkRows, self.bufferWindowChunks, None)
+        self.rowTimes = []
         self.realAnalogData = {}
         self.plottedAnalogData = {}
         self.digitalData = {}
         self.allRealData = {}
         self.plottedLines = {}
+        # the variables' description in a binary signal log or store (see signal_log, signal_store)
+        self.logVariables = {}
+        self.signalLogs = []
+        self.csvExporter = None
         variableNamesOnLegend = []
         colors = ['b', 'g', 'r', 'c', 'm', 'b', 'y']
         colorCycler = cycle(colors)
@@ -108,6 +195,7 @@ class LogGraphPanel(wx.Panel):
                 if isinstance(var, SysVarAnalog):
                     variableNamesOnLegend += [name]
                     self.realAnalogData[name] = AnalogData(var.range)
+                    self.logVariables[name] = {'name': name, 'kind': 'analog', 'range': list(var.range), 'units': var.units}
                     color = next(colorCycler)
                     lineWidth = next(lineWidthCycler)
                     if var.showInSignalLog:
@@ -117,23 +205,24 @@ class LogGraphPanel(wx.Panel):
                         nameOnLegend = None
                         graphVisible = False
                     if not self.hasBipolarRange(name):
-                        self.plottedAnalogData[name] = AnalogData(var.range)
-                        self.plottedLines[name] = self.axes.plot(self.time, self.plottedAnalogData[name].data,
+                        self.plottedAnalogData[name] = AnalogData(var.range, decimated=True, spill=self.spillToDisk)
+                        self.plottedLines[name] = self.axes.plot([], [],
                                                                  '-', lw=lineWidth, color=color, label=nameOnLegend, visible=graphVisible)[0]
                             
                     else:
                         # split this variable to two unipolar variables for the sake of plotting
-                        self.plottedAnalogData[name+'_POS'] = AnalogData([0,var.range[1]])
-                        self.plottedAnalogData[name+'_NEG'] = AnalogData([var.range[0],0])
+                        self.plottedAnalogData[name+'_POS'] = AnalogData([0,var.range[1]], decimated=True, spill=self.spillToDisk)
+                        self.plottedAnalogData[name+'_NEG'] = AnalogData([var.range[0],0], decimated=True, spill=self.spillToDisk)
                         
-                        self.plottedLines[name+'_POS'] = self.axes.plot(self.time, self.plottedAnalogData[name+'_POS'].data,
+                        self.plottedLines[name+'_POS'] = self.axes.plot([], [],
                                                                         '-', lw=lineWidth, color=color, label=nameOnLegend, visible=graphVisible)[0]
-                        self.plottedLines[name+'_NEG'] = self.axes.plot(self.time, self.plottedAnalogData[name+'_NEG'].data,
+                        self.plottedLines[name+'_NEG'] = self.axes.plot([], [],
                                                                         '--', lw=lineWidth, color=color, visible=graphVisible)[0]
                     
                 # digital data isn't plotted
                 if isinstance(var, SysVarDigital):
-                    self.digitalData[name] = Data()
+                    self.digitalData[name] = Data(object)
+                    self.logVariables[name] = {'name': name, 'kind': 'digital', 'states': list(var.states)}
                 
         self.allRealData.update(self.realAnalogData)
         self.allRealData.update(self.digitalData)
@@ -142,6 +231,12 @@ class LogGraphPanel(wx.Panel):
         self.axes.set_ybound(0,100)
         leg = self.axes.legend(loc='upper left', fancybox=True, shadow=True)
         leg.get_frame().set_alpha(0.4)
+        
+        # the lines and the legend above them are drawn over a cached background (see Redraw)
+        self.legend = leg
+        self.legend.set_animated(True)
+        for line in self.plottedLines.values():
+            line.set_animated(True)
         self.lineLegendDict = {}
         for legline, lineName in zip(leg.get_lines(), variableNamesOnLegend):
             legline.set_picker(5)  # 5 pts tolerance
@@ -184,70 +279,324 @@ class LogGraphPanel(wx.Panel):
         relevantEdge = yRange[0] if yRange[0] >= 0 else yRange[1]
         return abs(value - relevantEdge) / abs(yRange[1] - yRange[0]) * 100
         
-    def AddData(self, name, value):
+    def AddData(self, name, value, timestamp=None):
+        '''
+        Add a variable's value to the current row
+        timestamp - when the value was acquired (seconds since the epoch). If not given, it's the current time.
+        '''
+        # live data isn't mixed with a replayed log, and is never skipped: it ends the replay
+        if self.replay != None:
+            cfg.Log('Signal log replay stopped: live data arrived')
+            self.StopReplay()
+        
         # keep all data arrays the same length. the time array should be updated last
-        if len(self.allRealData[name].data) <= len(self.time):
+        if self.allRealData[name].Count() <= self.time.Count():
             if value == None:
-                value = self.allRealData[name].data[-1] if len(self.allRealData[name].data) > 0 else 0
+                value = self.allRealData[name].Last() if len(self.allRealData[name]) > 0 else 0
+            sampleTime = timestamp if timestamp != None else time.time()
+            # cached values repeat old timestamps, and clock corrections can move them back, but the times must stay sorted (see SignalBuffer.IndexOf)
+            if len(self.allRealData[name]) > 0:
+                sampleTime = max(sampleTime, self.allRealData[name].Times()[-1])
+            self.rowTimes += [sampleTime]
+            # plotted lines are in the graph's date units
+            plotTime = epoch2num(sampleTime)
                 
-            self.allRealData[name].data += [value]
+            self.allRealData[name].Append(sampleTime, value)
             if name in self.realAnalogData.keys():
                 if not self.hasBipolarRange(name):
                     normVal = self.NormalizePositiveValue(value, self.plottedAnalogData[name].yRange)
-                    self.plottedAnalogData[name].data += [normVal]
+                    self.plottedAnalogData[name].Append(plotTime, normVal)
                 else:
                     normPosVal = self.NormalizePositiveValue(value, self.plottedAnalogData[name+'_POS'].yRange)
                     normNegVal = self.NormalizePositiveValue(value, self.plottedAnalogData[name+'_NEG'].yRange)
-                    self.plottedAnalogData[name+'_POS'].data += [normPosVal if value>=0 else None]
-                    self.plottedAnalogData[name+'_NEG'].data += [normNegVal if value<0 else None]
+                    self.plottedAnalogData[name+'_POS'].Append(plotTime, normPosVal if value>=0 else None)
+                    self.plottedAnalogData[name+'_NEG'].Append(plotTime, normNegVal if value<0 else None)
             
     def FinishUpdate(self):
-        self.time += [datetime.now()]
+        if self.replay != None:
+            cfg.Log('Signal log replay stopped: live data arrived')
+            self.StopReplay()
+        
+        # a row's time is when its last value was acquired. Each plotted line uses its own values' acquisition times.
+        rowTime = max(self.rowTimes) if len(self.rowTimes) > 0 else time.time()
+        # rows are never before the previous one (see AddData)
+        if len(self.time) > 0:
+            rowTime = max(rowTime, self.time.Times()[-1])
+        self.time.Append(rowTime)
+        self.rowTimes = []
+        if self.firstRowTime == None:
+            self.firstRowTime = self.time.Times()[0]
 
         # write a header with variable names
-        if len(self.time) == 1:
-            cfg.signalsLogFile.write('time,' + str(self.allRealData.keys())[1:-1] + '\r')
+        if self.csvExporter == None and len(self.signalLogs) == 0 and self.time.Count() == 1:
+            if cfg.signalsLogFile != None:
+                self.csvExporter = signal_log.SignalCsvExporter(self.allRealData.keys())
+                cfg.signalsLogFile.write(self.csvExporter.Header())
+            variables = [self.logVariables[name] for name in self.allRealData.keys()]
+            if cfg.signalsLogFormat == 'binary':
+                self.signalLogs.append(signal_log.SignalLogWriter(cfg.OpenLogFile(cfg.timeNow + signal_log.fileExtension, 'wb'), variables, sampleTimes=True))
+            if cfg.signalsStore:
+                store = signal_store.SignalStoreWriter(cfg.LogPath(cfg.timeNow + signal_store.fileExtension), variables)
+                # its drops and errors are reported like those of the log files
+                cfg.logWriters.append(store)
+                self.signalLogs.append(store)
             
-        # update the signals' file once in a while
-        if len(self.time) % self.dataWriteBulk == 0:
-            for idx in range(-1*self.dataWriteBulk,0):
-                cfg.signalsLogFile.write(str(self.time[idx].strftime('%H:%M:%S.%f')) + ',' + str([v.data[idx] for v in self.allRealData.values()])[1:-1] + '\r')
+        # update the signals' file once in a while (long before rows are dropped from memory)
+        if self.time.Count() % self.dataWriteBulk == 0:
+            self.WriteRows(self.dataWriteBulk)
                         
+    def AddRows(self, times, columns):
+        '''
+        Add whole rows at once (e.g. from a recorded log), rather than value by value. Nothing is written to the signals' file.
+        times - the rows' times (seconds since the epoch)
+        columns - the values of each variable in the rows ({name: values}). Missing variables get no value (NaN or None).
+        '''
+        times = np.asarray(times, np.float64)
+        if len(times) == 0:
+            return
+        
+        self.time.Extend(times)
+        if self.firstRowTime == None:
+            self.firstRowTime = times[0]
+        plotTimes = epoch2num(times)
+        for name, data in self.allRealData.items():
+            if name in self.realAnalogData:
+                values = np.asarray(columns[name], np.float64) if name in columns else np.full(len(times), np.nan)
+                data.Extend(times, values)
+                if not self.hasBipolarRange(name):
+                    self.plottedAnalogData[name].Extend(plotTimes, self.NormalizePositiveValue(values, self.plottedAnalogData[name].yRange))
+                else:
+                    normPosValues = self.NormalizePositiveValue(values, self.plottedAnalogData[name+'_POS'].yRange)
+                    normNegValues = self.NormalizePositiveValue(values, self.plottedAnalogData[name+'_NEG'].yRange)
+                    self.plottedAnalogData[name+'_POS'].Extend(plotTimes, np.where(values >= 0, normPosValues, np.nan))
+                    self.plottedAnalogData[name+'_NEG'].Extend(plotTimes, np.where(values < 0, normNegValues, np.nan))
+            else:
+                data.Extend(times, list(columns[name]) if name in columns else [None] * len(times))
+    
+    def Clear(self):
+        '''
+        Remove all the data from the graph
+        '''
+        # the old buffers' temporary files are deleted right away, rather than when they're garbage collected
+        for data in self.plottedAnalogData.values() + self.allRealData.values() + [self.time]:
+            data.Close()
+        for name, data in self.realAnalogData.items():
+            self.realAnalogData[name] = AnalogData(data.yRange)
+        for name, data in self.plottedAnalogData.items():
+            self.plottedAnalogData[name] = AnalogData(data.yRange, decimated=True, spill=self.spillToDisk)
+        for name in self.digitalData.keys():
+            self.digitalData[name] = Data(object)
+        self.allRealData = {}
+        self.allRealData.update(self.realAnalogData)
+        self.allRealData.update(self.digitalData)
+        
+        self.time = SignalBuffer(self.bufferChunkRows, self.bufferWindowChunks, None)
+        self.rowTimes = []
+        self.firstRowTime = None
+        for line in self.plottedLines.values():
+            line.set_data([], [])
+        self.plottedRowsCount = 0
+        self.plottedBounds = None
+        self.axisZoom = None
+        self.background = None
+        self.canvas.draw()
+    
+    def StartReplay(self, reader):
+        '''
+        Show a recorded signal log (see signal_log.OpenSignalLog) instead of the live data, from its start
+        '''
+        if self.replay != None:
+            self.StopReplay(clear=False)
+        else:
+            # the live rows are written before they're cleared
+            self.WriteRows(self.time.Count() % self.dataWriteBulk)
+        self.replay = SignalLogReplay(reader, self)
+        self.replay.Seek(self.replay.start)
+        self.replayPlayButton.SetValue(False)
+        self.UpdateReplayControls()
+        self.vbox.Show(self.replayHBox, True)
+        self.vbox.Layout()
+        self.replayTimer.Start(self.replayTickMilisec)
+    
+    def StopReplay(self, clear=True):
+        '''
+        Stop replaying a log, and go back to the live data
+        clear - remove the replayed data from the graph
+        '''
+        if self.replay == None:
+            return
+        self.replayTimer.Stop()
+        self.replay.Close()
+        self.replay = None
+        self.vbox.Show(self.replayHBox, False)
+        self.vbox.Layout()
+        if clear:
+            self.Clear()
+    
+    def OnReplayTimer(self, event):
+        if not self.replay.Tick():
+            self.replayPlayButton.SetValue(False)
+        self.ReportReplayError()
+        self.UpdateReplayControls()
+    
+    def ReportReplayError(self):
+        '''
+        Log the replay's error, if reading the log failed (e.g. a corrupt row)
+        '''
+        if self.replay.error != None:
+            cfg.Log('Replaying the signal log failed: ' + self.replay.error)
+            self.replay.error = None
+    
+    def UpdateReplayControls(self):
+        '''
+        Show the replay's position
+        '''
+        duration = self.replay.end - self.replay.start
+        self.replaySlider.SetValue(int(round((self.replay.position - self.replay.start) / duration * 1000)) if duration > 0 else 0)
+        self.replayTimeLabel.SetLabel(datetime.fromtimestamp(self.replay.position).strftime('%Y-%m-%d %H:%M:%S'))
+    
+    def RefreshPlot(self):
+        '''
+        Plot the rows added since the last refresh, or the data in a new part of the time axis (e.g. when it's panned in freeze mode).
+        Called periodically (see plotFrameRate), independently of the acquisition.
+        Nothing is drawn while the graph isn't on screen. When drawing takes longer than a frame, frames are skipped,
+        so drawing never takes more than half of the GUI's time.
+        '''
+        rowsCount = self.time.Count()
         # only show the graph when there's at least 2 data points
-        if len(self.time) < 2:
+        if rowsCount < 2 or (rowsCount == self.plottedRowsCount and self.axes.get_xbound() == self.plottedBounds):
             return
-        self.Redraw(len(self.time) == 2)
+        if not self.IsShownOnScreen():
+            return
+        
+        now = time.time()
+        if now < self.nextFrameTime:
+            return
+        
+        self.Redraw(self.plottedRowsCount < 2)
+        self.plottedRowsCount = rowsCount
+        self.plottedBounds = self.axes.get_xbound()
+        self.nextFrameTime = now + 2 * (time.time() - now)
+
+    def WriteRows(self, rowsNum):
+        '''
+        Write the last rowsNum rows to the signals' file
+        '''
+        if rowsNum <= 0:
+            return
+        
+        if cfg.signalsLogFile != None:
+            # the rows are formatted by the file's writing thread
+            cfg.signalsLogFile.Submit(self.csvExporter.FormatRows, self.time.Times(-rowsNum).copy(), [v.Values(-rowsNum).copy() for v in self.allRealData.values()])
+        # the binary logs also keep when each value was acquired, since a row's values may be of different times (see FinishUpdate)
+        for signalLog in self.signalLogs:
+            signalLog.Append(self.time.Times(-rowsNum), [v.Values(-rowsNum) for v in self.allRealData.values()],
+                             [v.Times(-rowsNum) for v in self.allRealData.values()])
 
     def StopUpdates(self):
-        for idx in range(-1*(len(self.time) % self.dataWriteBulk),0):
-            cfg.signalsLogFile.write(str(self.time[idx].strftime('%H:%M:%S.%f')) + ',' + str([v.data[idx] for v in self.allRealData.values()])[1:-1] + '\r')
+        if self.replay != None:
+            self.StopReplay(clear=False)
+        else:
+            self.WriteRows(self.time.Count() % self.dataWriteBulk)
+        for signalLog in self.signalLogs:
+            signalLog.Close()
             
         plt.close()
     
     def Redraw(self, firstTime=False):
         """ Redraws the figure
+        Normally only the lines are drawn, over a cached image of the rest of the figure (blitting).
+        The whole figure is only drawn when the axes change (e.g. the time axis moves a step, the zoom changes or the window is resized).
         """
             
         if not self.cb_freeze.IsChecked():
-            self.axes.set_xbound(lower=self.time[max(0,len(self.time)-int(self.slider_zoom.GetValue() * 60 * cfg.app.updateFrequency))],
-                                                 upper=self.time[-1])
+            self.UpdateTimeAxis()
         
-        for name in self.plottedAnalogData.keys():
-            self.plottedLines[name].set_ydata(np.append(self.plottedLines[name].get_ydata(), self.plottedAnalogData[name].data[-1]))
-            self.plottedLines[name].set_xdata(np.append(self.plottedLines[name].get_xdata(), self.time[-1]))
+        # draw no more points than there are pixels, whatever the zoom. Full resolution data is passed as views, without copying.
+        start, end = self.axes.get_xbound()
+        maxPoints = max(2, int(self.axes.bbox.width))
+        for name, data in self.plottedAnalogData.items():
+            self.plottedLines[name].set_data(*data.pyramid.Decimate(data, start, end, maxPoints))
 
         if firstTime:
-            self.axes.get_xaxis().set_major_formatter(DateFormatter('%H:%M'))
-            self.axes.get_xaxis().set_major_locator(MinuteLocator())
+            # the ticks adapt to the span, which can be anything from seconds to the whole run (see spillToDisk)
+            locator = AutoDateLocator()
+            self.axes.get_xaxis().set_major_locator(locator)
+            self.axes.get_xaxis().set_major_formatter(AutoDateFormatter(locator))
             self.axes.set_ybound(0,100)
-                        
-        self.canvas.draw()
+        
+        if self.background == None or self.backgroundKey != self.GetBackgroundKey():
+            # OnDraw caches the new background and draws the lines
+            self.canvas.draw()
+        else:
+            self.canvas.restore_region(self.background)
+            self.DrawAnimatedArtists()
+            self.canvas.blit(self.axes.bbox)
+    
+    def UpdateTimeAxis(self):
+        '''
+        Show the last zoom minutes of data (or all the data, if there's less). 
+        The axis only moves when the data reaches its end, and then leaves some room ahead (see axisStepFraction).
+        '''
+        times = self.time.Times()
+        latest = epoch2num(times[-1])
+        zoom = self.slider_zoom.GetValue()
+        lower, upper = self.axes.get_xbound()
+        if zoom == self.axisZoom and lower <= latest <= upper:
+            return
+        
+        self.axisZoom = zoom
+        lower = max(epoch2num(self.firstRowTime), latest - zoom / (24 * 60))
+        self.axes.set_xbound(lower=lower, upper=latest + max(latest - lower, 1e-9) * self.axisStepFraction)
+    
+    def GetBackgroundKey(self):
+        '''
+        Returns: what the cached background depends on
+        '''
+        return (self.axes.get_xbound(), self.axes.get_ybound(), tuple(self.axes.bbox.bounds))
+    
+    def OnDraw(self, event):
+        '''
+        After the figure is drawn (by Redraw, or e.g. by the toolbar), cache its background and draw the lines over it
+        '''
+        self.background = self.canvas.copy_from_bbox(self.axes.bbox)
+        self.backgroundKey = self.GetBackgroundKey()
+        self.DrawAnimatedArtists()
+    
+    def DrawAnimatedArtists(self):
+        '''
+        Draw the lines and the legend
+        '''
+        for line in self.plottedLines.values():
+            self.axes.draw_artist(line)
+        self.axes.draw_artist(self.legend)
     
     def on_cb_freeze(self, event):
+        # when unfrozen, go back to following the data
+        self.axisZoom = None
         self.Redraw()
     
     def on_slider_width(self, event):
         self.Redraw()
+    
+    def on_replay_play(self, event):
+        if self.replayPlayButton.GetValue():
+            self.replay.Play(self.replaySpeeds[self.replaySpeedChoice.GetSelection()])
+        else:
+            self.replay.Pause()
+    
+    def on_replay_speed(self, event):
+        self.replay.SetSpeed(self.replaySpeeds[self.replaySpeedChoice.GetSelection()])
+    
+    def on_replay_seek(self, event):
+        # the graph shows the zoom minutes before the new position
+        position = self.replay.start + (self.replay.end - self.replay.start) * self.replaySlider.GetValue() / 1000
+        self.replay.Seek(position, self.slider_zoom.GetValue() * 60)
+        self.ReportReplayError()
+        self.UpdateReplayControls()
+    
+    def on_replay_stop(self, event):
+        self.StopReplay()
 
 ##############################
 class SimpleFrame(wx.Frame):
@@ -0,0 +1,126 @@
+from __future__ import division
+__author__ = 'yoelk'
+
+import numpy as np
+from instrumentino.util import monotonic
+
+class SignalLogReplay(object):
+    '''
+    Replay a recorded signal log (see signal_log.OpenSignalLog) into a LogGraphPanel, as if it was acquired again,
+    at 1x-1000x speed. The log is read block by block as the replay advances, so it's never loaded as a whole.
+    Call Tick periodically to advance the replay.
+    '''
+    minSpeed = 1
+    maxSpeed = 1000
+
+    def __init__(self, reader, logGraph):
+        '''
+        reader - an opened signal log (see signal_log.SignalReader)
+        logGraph - the LogGraphPanel to show the log in. Variables it doesn't have are skipped.
+        '''
+        self.reader = reader
+        self.logGraph = logGraph
+        self.speed = self.minSpeed
+        self.playing = False
+        timeRange = reader.TimeRange()
+        self.start, self.end = timeRange if timeRange != None else (0, 0)
+        self.position = self.start
+        self.lastTick = None
+        self.blocks = iter([])
+        # the block being fed, and its first row that wasn't fed yet
+        self.pending = None
+        self.pendingRow = 0
+        # why the replay stopped, if reading the log failed
+        self.error = None
+
+    def Play(self, speed=None):
+        '''
+        Continue the replay
+        speed - how much faster than real time (None to keep the current speed)
+        '''
+        if speed != None:
+            self.SetSpeed(speed)
+        self.playing = True
+        self.lastTick = monotonic()
+
+    def SetSpeed(self, speed):
+        '''
+        speed - how much faster than real time (between minSpeed and maxSpeed)
+        '''
+        self.speed = min(max(speed, self.minSpeed), self.maxSpeed)
+
+    def Pause(self):
+        self.playing = False
+
+    def Seek(self, position, historySec=0):
+        '''
+        Jump to a time in the log (seconds since the epoch). The graph is cleared, and shows the historySec seconds before it.
+        '''
+        self.position = min(max(position, self.start), self.end)
+        self.logGraph.Clear()
+        self.blocks = self.reader.ReadBlocks(self.position - historySec)
+        self.pending = None
+        self._safeFeed(self.position)
+        self.lastTick = monotonic()
+
+    def Tick(self):
+        '''
+        Advance the replay by the time that passed since the last tick (times the speed)
+
+        Returns: True if the replay is still playing (it stops at the end of the log, or if the log can't be read)
+        '''
+        if not self.playing:
+            return False
+
+        now = monotonic()
+        self.position = min(self.position + (now - self.lastTick) * self.speed, self.end)
+        self.lastTick = now
+        self._safeFeed(self.position)
+        if self.position >= self.end:
+            self.playing = False
+        return self.playing
+
+    def Close(self):
+        self.playing = False
+        self.reader.Close()
+
+    def _safeFeed(self, upTo):
+        '''
+        This function should be called only in this class
+        Feed the graph, and stop the replay if the log can't be read (the error is kept in error)
+        '''
+        try:
+            self._feed(upTo)
+        except Exception as e:
+            self.error = str(e)
+            self.playing = False
+            self.blocks = iter([])
+            self.pending = None
+
+    def _feed(self, upTo):
+        '''
+        This function should be called only in this class
+        Add the log's rows up to a time to the graph
+        '''
+        while True:
+            if self.pending == None:
+                try:
+                    self.pending = next(self.blocks)
+                except StopIteration:
+                    return
+                self.pendingRow = 0
+            times, columns = self.pending
+            # rows may have the same time, so the rows are counted rather than compared by time
+            first = self.pendingRow
+            last = max(first, np.searchsorted(times, upTo, 'right'))
+            if first < last:
+                rows = {}
+                for name, values in columns.items():
+                    if name in self.reader.states:
+                        values = np.array(self.reader.States(name), object)[values]
+                    rows[name] = values[first:last]
+                self.logGraph.AddRows(times[first:last], rows)
+                self.pendingRow = last
+            if last < len(times):
+                return
+            self.pending = None
@@ -0,0 +1,673 @@
+'''
+A binary, columnar format for the signal log, which is much smaller than CSV and can be read straight into NumPy arrays.
+
+A file consists of:
+    header  - 'ISIG', format version (uint16), JSON length (uint32) and a JSON object describing the columns:
+              the time (float64, seconds since the epoch), then one column per variable. Analog variables are float64,
+              digital ones are uint8 codes of their states. If 'sampleTimes' is set, each variable also has a column of
+              the times its values were acquired (float64), after the variables' columns.
+    blocks  - 'IBLK', JSON length (uint32), a JSON object (rows number, first and last time, the size of each column's data,
+              and the digital states first seen in the block), then each column's data (little-endian, optionally zlib compressed).
+    footer  - 'IIDX', JSON length (uint32), a JSON object indexing the blocks (offset, rows, first and last time) and holding all
+              the digital states. It ends with the footer's offset (uint64) and 'IEND'.
+A file without a footer (e.g. when the program didn't close properly) can still be read. Its blocks are found by scanning it.
+'''
+from __future__ import division
+__author__ = 'yoelk'
+
+import os
+import re
+import ast
+import mmap
+import json
+import time
+import zlib
+import struct
+from datetime import datetime
+import numpy as np
+
+formatVersion = 1
+fileExtension = '.isig'
+
+class StateCodes(object):
+    '''
+    Numeric codes for the states of a digital variable. States get codes in the order they're first seen.
+    '''
+    def __init__(self, states=[]):
+        self.states = []
+        self.codes = {}
+        self.Encode(states)
+
+    def Encode(self, values):
+        '''
+        Returns: the codes of the values (converted to strings), and the states that were new
+        '''
+        encoded = []
+        newStates = []
+        for value in values:
+            state = str(value)
+            if state not in self.codes:
+                self.codes[state] = len(self.states)
+                self.states.append(state)
+                newStates.append(state)
+            encoded.append(self.codes[state])
+        return encoded, newStates
+
+
+class SignalLogWriter(object):
+    '''
+    Write the signal log in blocks of rows. Rows are gathered in memory, and written when there are blockRows of them.
+    '''
+    def __init__(self, path, variables, compress=True, blockRows=4096, sampleTimes=False):
+        '''
+        path - the file to create, or a file opened for binary writing (e.g. an AsyncFileWriter)
+        variables - a description of each variable (dictionary): 'name', 'kind' ('analog' or 'digital'), 'states' for digital
+                    variables, and any other metadata to keep in the header (e.g. 'range', 'units')
+        compress - compress each column's data in a block with zlib
+        blockRows - rows per block
+        sampleTimes - also keep the time each value was acquired (see Append), and not only the rows' times
+        '''
+        self.file = open(path, 'wb') if isinstance(path, basestring) else path
+        self.variables = [dict(variable) for variable in variables]
+        self.compress = compress
+        self.blockRows = blockRows
+        self.sampleTimes = sampleTimes
+        self.stateCodes = {}
+        for variable in self.variables:
+            if variable['kind'] == 'digital':
+                variable['type'] = 'uint8'
+                self.stateCodes[variable['name']] = StateCodes(variable.get('states', []))
+                variable['states'] = list(self.stateCodes[variable['name']].states)
+            else:
+                variable['type'] = 'float64'
+        self.pendingTimes = []
+        self.pendingColumns = [[] for _ in self.variables]
+        self.pendingSampleTimes = [[] for _ in self.variables]
+        self.pendingRows = 0
+        self.newStates = {}
+        self.index = []
+        self.offset = 0
+
+        header = json.dumps({'version': formatVersion,
+                             'created': datetime.now().isoformat(),
+                             'compression': 'zlib' if compress else None,
+                             'sampleTimes': sampleTimes,
+                             'columns': [{'name': 'time', 'type': 'float64'}] + self.variables})
+        self._write('ISIG' + struct.pack('<HI', formatVersion, len(header)) + header)
+
+    def Append(self, times, columns, sampleTimes=None):
+        '''
+        Add rows
+        times - the rows' times (seconds since the epoch)
+        columns - the values of each variable in the rows, in the order of the variables
+        sampleTimes - the times each variable's values were acquired, in the order of the variables (None - the rows' times).
+                      They're only kept if the writer was created with sampleTimes.
+        '''
+        self.pendingTimes.append(np.array(times, np.float64))
+        for idx, (variable, values) in enumerate(zip(self.variables, columns)):
+            if variable['kind'] == 'digital':
+                values, newStates = self.stateCodes[variable['name']].Encode(values)
+                if len(newStates) > 0:
+                    self.newStates.setdefault(variable['name'], []).extend(newStates)
+            self.pendingColumns[idx].append(np.array(values, variable['type']))
+            if self.sampleTimes:
+                self.pendingSampleTimes[idx].append(np.array(sampleTimes[idx] if sampleTimes != None else times, np.float64))
+        self.pendingRows += len(times)
+
+        if self.pendingRows >= self.blockRows:
+            self.Flush()
+
+    def Flush(self):
+        '''
+        Write the rows gathered so far as a block
+        '''
+        if self.pendingRows == 0:
+            return
+
+        times = np.concatenate(self.pendingTimes)
+        data = [times.astype('<f8').tostring()]
+        for variable, values in zip(self.variables, self.pendingColumns):
+            data.append(np.concatenate(values).astype(np.dtype(variable['type']).newbyteorder('<')).tostring())
+        if self.sampleTimes:
+            data += [np.concatenate(sampleTimes).astype('<f8').tostring() for sampleTimes in self.pendingSampleTimes]
+        if self.compress:
+            data = [zlib.compress(columnData) for columnData in data]
+
+        blockHeader = json.dumps({'rows': len(times),
+                                  'first': times[0],
+                                  'last': times[-1],
+                                  'sizes': [len(columnData) for columnData in data],
+                                  'newStates': self.newStates})
+        self.index.append([self.offset, len(times), times[0], times[-1]])
+        self._write('IBLK' + struct.pack('<I', len(blockHeader)) + blockHeader + ''.join(data))
+        self.file.flush()
+
+        self.pendingTimes = []
+        self.pendingColumns = [[] for _ in self.variables]
+        self.pendingSampleTimes = [[] for _ in self.variables]
+        self.pendingRows = 0
+        self.newStates = {}
+
+    def Close(self):
+        '''
+        Write the remaining rows and the footer, and close the file
+        '''
+        self.Flush()
+        footerOffset = self.offset
+        footer = json.dumps({'blocks': self.index, 'states': {name: codes.states for name, codes in self.stateCodes.items()}})
+        self._write('IIDX' + struct.pack('<I', len(footer)) + footer + struct.pack('<Q', footerOffset) + 'IEND')
+        self.file.close()
+
+    def _write(self, data):
+        '''
+        This function should be called only in this class
+        '''
+        self.file.write(data)
+        self.offset += len(data)
+
+
+class SignalReader(object):
+    '''
+    The common part of signal log readers. Sub-classes set names (the variables' names, in the order of the columns)
+    and states (the states of each digital variable, in the order of their codes), and implement ReadBlocks and TimeRange.
+    '''
+    def States(self, name):
+        '''
+        Returns: the states of a digital variable, in the order of their codes
+        '''
+        return self.states[name]
+
+    def ReadBlocks(self, start=None, end=None, names=None):
+        '''
+        Read the rows between two times (seconds since the epoch, None for no limit), block by block
+        names - the variables to read (None for all of them)
+        Sub-classes should implement this
+
+        Returns: a generator of (times, {name: values}) for each block. Digital values are the codes of the states (see States).
+        '''
+        return iter([])
+
+    def TimeRange(self):
+        '''
+        Sub-classes should implement this
+
+        Returns: (first time, last time), or None if the file has no rows
+        '''
+        return None
+
+    def Read(self, name, start=None, end=None):
+        '''
+        Read a variable's values between two times (seconds since the epoch, None for no limit)
+
+        Returns: (times, values). Digital values are the codes of the states (see States).
+        '''
+        times = []
+        values = []
+        for blockTimes, columns in self.ReadBlocks(start, end, [name]):
+            times.append(blockTimes)
+            values.append(columns[name])
+        if len(times) == 0:
+            return np.zeros(0), np.zeros(0, np.uint8 if name in self.states else np.float64)
+        return np.concatenate(times), np.concatenate(values)
+
+    def ExportCsv(self, path, start=None, end=None, timeFormat='clock', stateCodes=False):
+        '''
+        Write the rows between two times (seconds since the epoch, None for no limit) as a CSV file.
+        By default it's like the one written during runs.
+        timeFormat, stateCodes - see SignalCsvExporter
+        '''
+        exporter = SignalCsvExporter(self.names, self.states, timeFormat, stateCodes)
+        with open(path, 'w') as csvFile:
+            csvFile.write(exporter.Header())
+            for times, columns in self.ReadBlocks(start, end):
+                csvFile.write(exporter.FormatRows(times, [columns[name] for name in self.names]))
+
+
+class SignalLogReader(SignalReader):
+    '''
+    Read a signal log file. The file is memory-mapped, and only the blocks in the requested time range are read.
+    '''
+    def __init__(self, path):
+        self.file = open(path, 'rb')
+        self.mapped = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.mapped[:4] != 'ISIG':
+            raise ValueError(path + ' is not a signal log file')
+
+        version, headerLength = struct.unpack_from('<HI', self.mapped, 4)
+        if version > formatVersion:
+            raise ValueError(path + ' was written by a newer version (%d)' % version)
+        header = json.loads(self.mapped[10:10 + headerLength])
+        self.compression = header['compression']
+        self.sampleTimes = header.get('sampleTimes', False)
+        self.columns = header['columns']
+        # JSON strings are read as unicode, while the program uses byte strings
+        self.names = [column['name'].encode('utf-8') for column in self.columns[1:]]
+        self.states = {column['name'].encode('utf-8'): [state.encode('utf-8') for state in column['states']]
+                       for column in self.columns if column.get('kind') == 'digital'}
+        self.blocks = []
+        if not self._readFooter():
+            self._scanBlocks(10 + headerLength)
+
+    def Variables(self):
+        '''
+        Returns: the description of each variable (see SignalLogWriter)
+        '''
+        return self.columns[1:]
+
+    def Count(self):
+        '''
+        Returns: the number of rows in the file
+        '''
+        return sum(block['rows'] for block in self.blocks)
+
+    def TimeRange(self):
+        if len(self.blocks) == 0:
+            return None
+        return self.blocks[0]['first'], self.blocks[-1]['last']
+
+    def ReadBlocks(self, start=None, end=None, names=None):
+        '''
+        Uncompressed data is read without copying it from the file (see SignalReader.ReadBlocks)
+        '''
+        names = names if names != None else self.names
+        for block, times, first, last in self._blockRanges(start, end):
+            yield times[first:last], {name: self._readColumn(block, 1 + self.names.index(name))[first:last] for name in names}
+
+    def Read(self, name, start=None, end=None):
+        '''
+        If the file keeps the variables' sample times (see SignalLogWriter), they're returned instead of the rows' times
+        (see SignalReader.Read). The rows are still selected by their times.
+        '''
+        times, values = SignalReader.Read(self, name, start, end)
+        if self.sampleTimes and len(times) > 0:
+            column = 1 + len(self.names) + self.names.index(name)
+            times = np.concatenate([self._readColumn(block, column)[first:last] for block, _, first, last in self._blockRanges(start, end)])
+        return times, values
+
+    def Close(self):
+        self.mapped.close()
+        self.file.close()
+
+    def _blockRanges(self, start, end):
+        '''
+        This function should be called only in this class
+        
+        Returns: a generator of (block, its times, index of its first row and after its last row) for the blocks between start and end
+        '''
+        for block in self.blocks:
+            if (start != None and block['last'] < start) or (end != None and block['first'] > end):
+                continue
+
+            times = self._readColumn(block, 0)
+            first, last = 0, len(times)
+            if start != None and block['first'] < start:
+                first = np.searchsorted(times, start)
+            if end != None and block['last'] > end:
+                last = np.searchsorted(times, end, 'right')
+            yield block, times, first, last
+
+    def _readColumn(self, block, column):
+        '''
+        This function should be called only in this class
+        Columns after the variables' are their sample times
+        '''
+        dtype = np.dtype(self.columns[column]['type'] if column < len(self.columns) else 'float64').newbyteorder('<')
+        offset = block['dataOffset'] + sum(block['sizes'][:column])
+        if self.compression == 'zlib':
+            return np.frombuffer(zlib.decompress(self.mapped[offset:offset + block['sizes'][column]]), dtype)
+        return np.frombuffer(self.mapped, dtype, block['rows'], offset)
+
+    def _readFooter(self):
+        '''
+        This function should be called only in this class
+
+        Returns: True if the file has a footer
+        '''
+        if len(self.mapped) < 12 or self.mapped[-4:] != 'IEND':
+            return False
+
+        footerOffset, = struct.unpack_from('<Q', self.mapped, len(self.mapped) - 12)
+        footerLength, = struct.unpack_from('<I', self.mapped, footerOffset + 4)
+        footer = json.loads(self.mapped[footerOffset + 8:footerOffset + 8 + footerLength])
+        for name, states in footer['states'].items():
+            self.states[name.encode('utf-8')] = [state.encode('utf-8') for state in states]
+        for offset, rows, first, last in footer['blocks']:
+            self._readBlockHeader(offset)
+        return True
+
+    def _scanBlocks(self, offset):
+        '''
+        This function should be called only in this class
+        Find the blocks by going over the file. A block that was only partly written is ignored.
+        '''
+        while offset + 8 <= len(self.mapped) and self.mapped[offset:offset + 4] == 'IBLK':
+            headerLength, = struct.unpack_from('<I', self.mapped, offset + 4)
+            if offset + 8 + headerLength > len(self.mapped):
+                break
+            block = self._readBlockHeader(offset)
+            if block['dataOffset'] + sum(block['sizes']) > len(self.mapped):
+                self.blocks.pop()
+                break
+            for name, states in block['newStates'].items():
+                self.states[name.encode('utf-8')].extend([state.encode('utf-8') for state in states])
+            offset = block['dataOffset'] + sum(block['sizes'])
+
+    def _readBlockHeader(self, offset):
+        '''
+        This function should be called only in this class
+        '''
+        headerLength, = struct.unpack_from('<I', self.mapped, offset + 4)
+        block = json.loads(self.mapped[offset + 8:offset + 8 + headerLength])
+        block['dataOffset'] = offset + 8 + headerLength
+        self.blocks.append(block)
+        return block
+
+
+class SignalCsvReader(SignalReader):
+    '''
+    Read a CSV signal log (see SignalCsvExporter), without parsing it all. The file is memory-mapped, a time is found
+    by bisecting the file, and rows are parsed a chunk at a time.
+    Times of day (the 'clock' format) are dated by the file's name (as given by the program, e.g. 2014_05_01-12_00_00.csv),
+    or by the file's modification date. They're assumed to be within 24 hours from the first row.
+    '''
+    chunkBytes = 256*1024
+    fileNameTimeFormat = '%Y_%m_%d-%H_%M_%S'
+
+    def __init__(self, path):
+        self.file = open(path, 'rb')
+        self.mapped = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        end = min(i for i in (self.mapped.find('\r'), self.mapped.find('\n')) if i >= 0)
+        self.lineEnd = '\r\n' if self.mapped[end:end + 2] == '\r\n' else self.mapped[end]
+
+        # a legend of digital states' codes, then the header
+        self.states = {}
+        self.stateCodes = {}
+        offset = 0
+        while self.mapped[offset] == '#':
+            end = self.mapped.find(self.lineEnd, offset)
+            name, legend = self.mapped[offset + 2:end].rsplit(': ', 1)
+            self.states[name] = [code.split('=', 1)[1] for code in legend.split(', ')]
+            offset = end + len(self.lineEnd)
+        end = self.mapped.find(self.lineEnd, offset)
+        self.names = list(ast.literal_eval('[' + self.mapped[offset:end].split(',', 1)[1] + ']'))
+        self.dataStart = end + len(self.lineEnd)
+        self.codedStates = set(self.states.keys())
+
+        # the time format is that of the first row. Digital variables have quoted states in the first rows
+        # (though a variable that wasn't read yet is 0, see _parseValues)
+        firstRow = self._line(self.dataStart)
+        self.firstTime = None
+        self.timeFormat = 'clock'
+        if firstRow != None:
+            fields = firstRow.split(',')
+            self.timeFormat = 'iso' if 'T' in fields[0] else 'clock' if ':' in fields[0] else 'offset'
+            for row in self.mapped[self.dataStart:self.dataStart + self.chunkBytes].split(self.lineEnd)[:-1]:
+                for name, field in zip(self.names, row.split(',')[1:]):
+                    if field.strip().startswith("'"):
+                        self.states.setdefault(name, [])
+        for name in self.states:
+            self.stateCodes[name] = StateCodes(self.states[name])
+            self.states[name] = self.stateCodes[name].states
+        self.baseTime = self._baseTime(path)
+        if firstRow != None:
+            self.firstTime = self._parseTimes([firstRow.split(',', 1)[0]], False)[0]
+
+    def Variables(self):
+        '''
+        Returns: the description of each variable (see SignalLogWriter)
+        '''
+        return [{'name': name, 'kind': 'digital', 'states': self.states[name]} if name in self.states else {'name': name, 'kind': 'analog'}
+                for name in self.names]
+
+    def TimeRange(self):
+        if self.firstTime == None:
+            return None
+        # the last complete row (a last line without a line break may still be being written)
+        end = self.mapped.rfind(self.lineEnd)
+        start = max(self.mapped.rfind(self.lineEnd, 0, end) + len(self.lineEnd), self.dataStart)
+        return self.firstTime, self._parseTimes([self.mapped[start:end].split(',', 1)[0]])[0]
+
+    def ReadBlocks(self, start=None, end=None, names=None):
+        '''
+        Rows are parsed a chunk of the file at a time (see SignalReader.ReadBlocks).
+        Only complete rows are read: a last line without a line break may still be being written.
+        '''
+        names = names if names != None else self.names
+        columns = [self.names.index(name) + 1 for name in names]
+        offset = self._find(start) if start != None else self.dataStart
+        while offset < len(self.mapped):
+            chunkEnd = self.mapped.find(self.lineEnd, offset + self.chunkBytes)
+            if chunkEnd < 0:
+                chunkEnd = self.mapped.rfind(self.lineEnd, offset)
+                if chunkEnd < 0:
+                    return
+            chunkEnd += len(self.lineEnd)
+            rows = [row.split(',') for row in self.mapped[offset:chunkEnd].split(self.lineEnd) if row != '']
+            # skip damaged rows (e.g. cut by a crash)
+            rows = [row for row in rows if len(row) == len(self.names) + 1]
+            offset = chunkEnd
+            if len(rows) == 0:
+                continue
+
+            fields = zip(*rows)
+            times = self._parseTimes(fields[0])
+            first, last = 0, len(times)
+            if start != None:
+                first = np.searchsorted(times, start)
+            if end != None:
+                last = np.searchsorted(times, end, 'right')
+            if first < last:
+                yield times[first:last], {name: self._parseValues(name, fields[column][first:last]) for name, column in zip(names, columns)}
+            if last < len(times):
+                return
+
+    def Close(self):
+        self.mapped.close()
+        self.file.close()
+
+    def _line(self, offset):
+        '''
+        This function should be called only in this class
+
+        Returns: the line starting at offset, or None at the end of the file (or if the line isn't complete yet)
+        '''
+        end = self.mapped.find(self.lineEnd, offset)
+        if end < 0:
+            return None
+        return self.mapped[offset:end]
+
+    def _find(self, sampleTime):
+        '''
+        This function should be called only in this class
+
+        Returns: the offset of a line that is before the first row at sampleTime or later (at most about a chunk before it)
+        '''
+        low, high = self.dataStart, len(self.mapped)
+        while high - low > self.chunkBytes:
+            middle = (low + high) // 2
+            lineStart = self.mapped.find(self.lineEnd, middle)
+            if lineStart < 0:
+                high = middle
+                continue
+            lineStart += len(self.lineEnd)
+            row = self._line(lineStart)
+            if row == None or row == '' or self._parseTimes([row.split(',', 1)[0]])[0] >= sampleTime:
+                high = middle
+            else:
+                low = lineStart
+        return low
+
+    def _baseTime(self, path):
+        '''
+        This function should be called only in this class
+
+        Returns: the epoch time that times in the file are relative to (midnight of the run's day for times of day)
+        '''
+        if self.timeFormat == 'iso':
+            return 0
+        match = re.search(r'\d{4}_\d{2}_\d{2}-\d{2}_\d{2}_\d{2}', os.path.basename(path))
+        if match != None:
+            start = time.mktime(time.strptime(match.group(0), self.fileNameTimeFormat))
+        else:
+            start = os.path.getmtime(path)
+        if self.timeFormat == 'offset':
+            return start
+        day = time.localtime(start)
+        return time.mktime((day.tm_year, day.tm_mon, day.tm_mday, 0, 0, 0, 0, 0, -1))
+
+    def _parseTimes(self, fields, unwrap=True):
+        '''
+        This function should be called only in this class
+        Convert the time fields of rows to seconds since the epoch
+        unwrap - times of day before the first row's are on the next day
+        '''
+        fields = np.array(fields)
+        if self.timeFormat == 'offset':
+            return self.baseTime + fields.astype(np.float64)
+
+        if self.timeFormat == 'iso':
+            # YYYY-MM-DDTHH:MM:SS.ffffff+HHMM
+            local = fields.astype('S26').astype('datetime64[us]').astype(np.int64) / 1e6
+            zone = fields.view('S1').reshape(len(fields), -1)[:, 26:31].copy().view('S5').ravel()
+            signs = np.where(zone.view('S1').reshape(len(fields), -1)[:, 0] == '-', -1, 1)
+            digits = zone.view(np.uint8).reshape(len(fields), -1)[:, 1:].astype(np.int64) - ord('0')
+            return local - signs * (digits[:, 0] * 36000 + digits[:, 1] * 3600 + digits[:, 2] * 600 + digits[:, 3] * 60)
+
+        # HH:MM:SS.ffffff
+        digits = fields.astype('S15').view(np.uint8).reshape(len(fields), -1).astype(np.int64) - ord('0')
+        seconds = (digits[:, 0] * 10 + digits[:, 1]) * 3600 + (digits[:, 3] * 10 + digits[:, 4]) * 60 + digits[:, 6] * 10 + digits[:, 7] + \
+                  digits[:, 9:15].dot(10 ** np.arange(5, -1, -1)) / 1e6
+        times = self.baseTime + seconds
+        if unwrap:
+            times += np.where(times < self.firstTime, 24 * 3600, 0)
+        return times
+
+    def _parseValues(self, name, fields):
+        '''
+        This function should be called only in this class
+        '''
+        fields = np.char.strip(np.array(fields))
+        if name not in self.states:
+            try:
+                return fields.astype(np.float64)
+            except ValueError:
+                # a digital variable that wasn't read during the first rows (its value was 0)
+                self.stateCodes[name] = StateCodes()
+                self.states[name] = self.stateCodes[name].states
+        if name in self.codedStates:
+            return fields.astype(np.uint8)
+        states, codes = np.unique(fields, return_inverse=True)
+        return np.array(self.stateCodes[name].Encode([state.strip("'") for state in states])[0], np.uint8)[codes]
+
+
+def OpenSignalLog(path):
+    '''
+    Open a signal log for reading, by its file extension: a binary signal log, or a CSV file
+
+    Returns: a SignalReader
+    '''
+    if path.endswith(fileExtension):
+        return SignalLogReader(path)
+    return SignalCsvReader(path)
+
+
+class SignalCsvExporter(object):
+    '''
+    Format signal rows as CSV, a block of rows at a time. Each column is formatted as a whole by NumPy, and the columns are joined
+    as byte matrices, so no Python objects are created for the samples.
+    The layout is that of the CSV written during runs: a header with the variables' names, then a row per sample, starting with its time.
+    '''
+    separator = ', '
+    rowEnd = '\r'
+
+    def __init__(self, names, states={}, timeFormat='clock', stateCodes=False):
+        '''
+        names - the variables' names, in the order of the columns
+        states - the states of each digital variable, in the order of their codes
+        timeFormat - 'clock' for the local time of day (HH:MM:SS.ffffff), 'iso' for the full local date and time (ISO 8601),
+                     or 'offset' for the seconds since the first row
+        stateCodes - write digital states as their codes, with a legend of the codes before the header,
+                     rather than as the states' names
+        '''
+        self.names = names
+        self.states = states
+        self.timeFormat = timeFormat
+        self.stateCodes = stateCodes
+        self.startTime = None
+
+    def Header(self):
+        '''
+        Returns: the header of the file
+        '''
+        legend = ''
+        if self.stateCodes:
+            for name in self.names:
+                if name in self.states:
+                    legend += '# ' + name + ': ' + ', '.join('%d=%s' % (code, state) for code, state in enumerate(self.states[name])) + self.rowEnd
+        return legend + 'time,' + str(self.names)[1:-1] + self.rowEnd
+
+    def FormatRows(self, times, columns):
+        '''
+        Format rows
+        times - the rows' times (seconds since the epoch)
+        columns - the values of each variable in the rows. Digital values are either the states' names or their codes (see SignalLogReader).
+
+        Returns: the rows as a string
+        '''
+        if len(times) == 0:
+            return ''
+
+        rowsNum = len(times)
+        cells = [self._formatTimes(np.asarray(times))]
+        for name, values in zip(self.names, columns):
+            cells.append(',' if len(cells) == 1 else self.separator)
+            cells.append(self._formatValues(name, np.asarray(values)))
+        cells.append(self.rowEnd)
+
+        # each row of the matrix is a CSV row, with the columns padded by NUL bytes, which are then removed
+        matrix = np.hstack([np.tile(np.frombuffer(cell, np.uint8), (rowsNum, 1)) if isinstance(cell, str) else
+                            np.ascontiguousarray(cell).view(np.uint8).reshape(rowsNum, -1) for cell in cells]).ravel()
+        return matrix[matrix != 0].tostring()
+
+    def _formatTimes(self, times):
+        '''
+        This function should be called only in this class
+        '''
+        if self.timeFormat == 'offset':
+            if self.startTime == None:
+                self.startTime = times[0]
+            return np.round(times - self.startTime, 6).astype(str)
+
+        localTimes = np.datetime_as_string((times * 1e6).round().astype(np.int64).astype('datetime64[us]'), timezone='local').astype(str)
+        if self.timeFormat == 'iso':
+            return localTimes
+        # the time of day is at a fixed position in the ISO strings (YYYY-MM-DDTHH:MM:SS.ffffff)
+        return localTimes.view('S1').reshape(len(localTimes), -1)[:, 11:26].copy().view('S15').ravel()
+
+    def _formatValues(self, name, values):
+        '''
+        This function should be called only in this class
+        '''
+        if values.dtype.kind in 'fiu' and (name not in self.states or self.stateCodes):
+            return values.astype(str)
+
+        if values.dtype.kind in 'iu':
+            # codes of digital states, written as the states' names
+            return np.array(["'%s'" % state for state in self.states[name]])[values]
+
+        # digital values (usually the states' names). Each distinct value is formatted once, as its repr,
+        # like in a printed list (e.g. a variable that wasn't read yet is 0, not '0')
+        states, codes = np.unique(values, return_inverse=True)
+        if self.stateCodes:
+            codes = np.array([self._stateCode(name, str(state)) for state in states])[codes]
+            return codes.astype(str)
+        return np.array([repr(state) for state in states])[codes]
+
+    def _stateCode(self, name, state):
+        '''
+        This function should be called only in this class
+        '''
+        states = self.states.setdefault(name, [])
+        if state not in states:
+            states.append(state)
+        return states.index(state)
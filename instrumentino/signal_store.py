@@ -0,0 +1,266 @@
+'''
+An SQLite database of the signals, for answering questions about parts of a run without reading the whole log.
+The samples of all the variables are in one table, clustered by variable and time, so a time range of a variable is read directly.
+Digital states are kept as codes (see the states table).
+The database is in WAL mode, so it can be queried while it's being written.
+'''
+from __future__ import division
+__author__ = 'yoelk'
+
+import json
+import time
+import sqlite3
+import itertools
+from Queue import Queue, Full, Empty
+from threading import Thread, Event
+import numpy as np
+from instrumentino.signal_log import StateCodes
+from instrumentino.util import monotonic
+
+fileExtension = '.sqlite'
+
+schema = '''
+CREATE TABLE IF NOT EXISTS variables (id INTEGER PRIMARY KEY, name TEXT UNIQUE NOT NULL, kind TEXT NOT NULL, metadata TEXT);
+CREATE TABLE IF NOT EXISTS states (variable INTEGER NOT NULL, code INTEGER NOT NULL, state TEXT NOT NULL, PRIMARY KEY (variable, code));
+CREATE TABLE IF NOT EXISTS samples (variable INTEGER NOT NULL, time REAL NOT NULL, value REAL, PRIMARY KEY (variable, time)) WITHOUT ROWID;
+'''
+
+class SignalStoreWriter(object):
+    '''
+    Write signal rows to the database. Rows are gathered in batches of batchRows, and each batch is inserted in one transaction,
+    by a background thread. At most maxQueuedBatches batches wait to be inserted. Beyond that (the disk is too slow, or the
+    database is locked), batches are dropped rather than blocking the caller. Drops and errors are counted (see Stats).
+    It has the same interface as SignalLogWriter, so both can be written with the same rows.
+    '''
+    maxQueuedBatches = 64
+    retries = 5
+    # closing waits this long for the queued batches to be inserted. The batches left are dropped.
+    closeTimeoutSec = 10
+
+    def __init__(self, path, variables, batchRows=1024):
+        '''
+        path - the database file (created if needed)
+        variables - a description of each variable (see SignalLogWriter)
+        '''
+        self.path = path
+        self.name = path
+        self.variables = [dict(variable) for variable in variables]
+        self.batchRows = batchRows
+        self.stateCodes = {}
+        for variable in self.variables:
+            if variable['kind'] == 'digital':
+                self.stateCodes[variable['name']] = StateCodes(variable.get('states', []))
+                variable['states'] = list(self.stateCodes[variable['name']].states)
+        self.pendingRows = []
+        self.pendingStates = []
+        self.stats = {'dropped': 0, 'droppedRows': 0, 'maxWriteSec': 0, 'errors': 0, 'lastError': None}
+
+        connection = _connect(path)
+        with connection:
+            self.ids = []
+            for variable in self.variables:
+                metadata = json.dumps({key: value for key, value in variable.items() if key not in ('name', 'kind', 'states')})
+                connection.execute('INSERT OR IGNORE INTO variables (name, kind, metadata) VALUES (?, ?, ?)',
+                                   (variable['name'], variable['kind'], metadata))
+                self.ids.append(connection.execute('SELECT id FROM variables WHERE name = ?', (variable['name'],)).fetchone()[0])
+                if variable['kind'] == 'digital':
+                    self.pendingStates += [(self.ids[-1], code, state) for code, state in enumerate(variable['states'])]
+
+        self.queue = Queue(self.maxQueuedBatches)
+        self.stopEvent = Event()
+        self.thread = Thread(target=self._run, args=(connection,))
+        self.thread.daemon = True
+        self.thread.start()
+
+    def Append(self, times, columns, sampleTimes=None):
+        '''
+        Add rows. Each variable's values are kept at their own sample times, so a value that was repeated in several rows
+        (e.g. a slow variable that wasn't read again) is kept once.
+        times - the rows' times (seconds since the epoch)
+        columns - the values of each variable in the rows, in the order of the variables
+        sampleTimes - the times each variable's values were acquired, in the order of the variables (None - the rows' times)
+        '''
+        if sampleTimes == None:
+            sampleTimes = [times] * len(columns)
+        for variableId, variable, values, times in zip(self.ids, self.variables, columns, sampleTimes):
+            times = np.asarray(times, np.float64).tolist()
+            if variable['kind'] == 'digital':
+                codes = self.stateCodes[variable['name']]
+                values, newStates = codes.Encode(values)
+                self.pendingStates += [(variableId, codes.codes[state], state) for state in newStates]
+            else:
+                values = np.asarray(values, np.float64).tolist()
+            self.pendingRows += zip(itertools.repeat(variableId), times, values)
+
+        if len(self.pendingRows) >= self.batchRows * len(self.variables):
+            self.Flush()
+
+    def Flush(self):
+        '''
+        Have the rows gathered so far inserted
+        '''
+        if len(self.pendingRows) == 0 and len(self.pendingStates) == 0:
+            return
+        try:
+            self.queue.put_nowait((self.pendingRows, self.pendingStates))
+        except Full:
+            # the states are kept for the next batch, since later rows may refer to them
+            self.stats['dropped'] += 1
+            self.stats['droppedRows'] += len(self.pendingRows) // max(1, len(self.variables))
+            self.pendingRows = []
+            return
+        self.pendingRows = []
+        self.pendingStates = []
+    
+    def Stats(self):
+        '''
+        Returns: a dictionary of the writer's metrics: how many batches (and rows) were dropped, the longest insertion, and the errors
+        '''
+        return dict(self.stats)
+
+    def Close(self):
+        '''
+        Insert the remaining rows and close the database. Waits for the background thread, but no more than closeTimeoutSec
+        (e.g. while the database is locked). The batches that weren't inserted by then are dropped.
+        '''
+        self.Flush()
+        deadline = monotonic() + self.closeTimeoutSec
+        try:
+            self.queue.put(None, timeout=self.closeTimeoutSec)
+        except Full:
+            pass
+        self.thread.join(max(0, deadline - monotonic()))
+        if self.thread.is_alive():
+            # the thread drops the batches and closes the database after its current insertion
+            self.stopEvent.set()
+            try:
+                self.queue.put_nowait(None)
+            except Full:
+                pass
+            self.thread.join(self.closeTimeoutSec)
+
+    def _run(self, connection):
+        '''
+        This function should be called only in this class
+        The background thread: insert each batch in one transaction
+        '''
+        # the states of a dropped batch are inserted with the next one, since later rows may refer to them
+        carriedStates = []
+        while True:
+            batch = self.queue.get()
+            if batch == None or self.stopEvent.is_set():
+                self._dropQueued(batch)
+                connection.close()
+                return
+
+            rows, states = batch
+            states = carriedStates + states
+            carriedStates = []
+            for attempt in range(self.retries):
+                insertStart = time.time()
+                try:
+                    with connection:
+                        connection.executemany('INSERT OR REPLACE INTO states VALUES (?, ?, ?)', states)
+                        connection.executemany('INSERT OR REPLACE INTO samples VALUES (?, ?, ?)', rows)
+                    self.stats['maxWriteSec'] = max(self.stats['maxWriteSec'], time.time() - insertStart)
+                    break
+                except sqlite3.Error as e:
+                    # e.g. the database is locked by a long query
+                    self.stats['errors'] += 1
+                    self.stats['lastError'] = str(e)
+                    if self.stopEvent.wait(1):
+                        self._dropQueued(batch)
+                        connection.close()
+                        return
+            else:
+                self.stats['dropped'] += 1
+                self.stats['droppedRows'] += len(rows) // max(1, len(self.variables))
+                carriedStates = states
+    
+    def _dropQueued(self, batch):
+        '''
+        This function should be called only in this class
+        Count a batch, and the batches still in the queue, as dropped
+        '''
+        while True:
+            if batch != None:
+                self.stats['dropped'] += 1
+                self.stats['droppedRows'] += len(batch[0]) // max(1, len(self.variables))
+            try:
+                batch = self.queue.get_nowait()
+            except Empty:
+                return
+
+
+class SignalStore(object):
+    '''
+    Query the signals' database
+    '''
+    def __init__(self, path):
+        self.connection = _connect(path)
+
+    def Variables(self):
+        '''
+        Returns: the description of each variable (see SignalLogWriter)
+        '''
+        variables = []
+        for variableId, name, kind, metadata in self.connection.execute('SELECT id, name, kind, metadata FROM variables ORDER BY id'):
+            variable = json.loads(metadata) if metadata != None else {}
+            variable.update({'name': name.encode('utf-8'), 'kind': kind})
+            if kind == 'digital':
+                variable['states'] = self.States(variable['name'])
+            variables.append(variable)
+        return variables
+
+    def States(self, name):
+        '''
+        Returns: the states of a digital variable, in the order of their codes
+        '''
+        rows = self.connection.execute('SELECT code, state FROM states WHERE variable = ? ORDER BY code', (self._id(name),)).fetchall()
+        return [state.encode('utf-8') for code, state in rows]
+
+    def TimeRange(self, name):
+        '''
+        Returns: (first time, last time) of a variable, or None if it has no samples
+        '''
+        first, last = self.connection.execute('SELECT MIN(time), MAX(time) FROM samples WHERE variable = ?', (self._id(name),)).fetchone()
+        return (first, last) if first != None else None
+
+    def Read(self, name, start=None, end=None):
+        '''
+        Read a variable's samples between two times (seconds since the epoch, None for no limit)
+
+        Returns: (times, values) as NumPy arrays. Digital values are the codes of the states (see States).
+        '''
+        start = start if start != None else float('-inf')
+        end = end if end != None else float('inf')
+        cursor = self.connection.execute('SELECT time, value FROM samples WHERE variable = ? AND time BETWEEN ? AND ? ORDER BY time',
+                                         (self._id(name), start, end))
+        # SQLite keeps NaN values as NULL
+        samples = np.fromiter(itertools.chain.from_iterable((sampleTime, value if value != None else np.nan) for sampleTime, value in cursor),
+                              np.float64).reshape(-1, 2)
+        return samples[:, 0].copy(), samples[:, 1].copy()
+
+    def Close(self):
+        self.connection.close()
+
+    def _id(self, name):
+        '''
+        This function should be called only in this class
+        '''
+        row = self.connection.execute('SELECT id FROM variables WHERE name = ?', (name,)).fetchone()
+        if row == None:
+            raise KeyError(name)
+        return row[0]
+
+
+def _connect(path):
+    '''
+    Open the database, and create its tables if needed
+    '''
+    connection = sqlite3.connect(path, check_same_thread=False)
+    connection.execute('PRAGMA journal_mode=WAL')
+    # in WAL mode, transactions are still atomic and durable except on power loss
+    connection.execute('PRAGMA synchronous=NORMAL')
+    connection.executescript(schema)
+    return connection
@@ -11,6 +11,53 @@ try:
 except ImportError:
     pass
 import itertools
+import tempfile
+import numpy as np
+import time
+from threading import Lock, Condition, Thread
+import ctypes
+import ctypes.util
+
+def _osMonotonic():
+    '''
+    Python 2 has no monotonic clock, so use the OS's: clock_gettime(CLOCK_MONOTONIC) on Linux and OS X, GetTickCount64 on Windows.
+    The wall clock can't be used for scheduling, since it can be stepped back (e.g. by NTP, or by the user).
+    
+    Returns: a function that returns the seconds of a monotonic clock, or None if the OS's clock isn't available
+    '''
+    try:
+        if os.name == 'nt':
+            GetTickCount64 = ctypes.windll.kernel32.GetTickCount64
+            GetTickCount64.restype = ctypes.c_uint64
+            return lambda: GetTickCount64() / 1000
+        
+        class timespec(ctypes.Structure):
+            _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+        clockMonotonic = 6 if sys.platform == 'darwin' else 1
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        clock_gettime = getattr(libc, 'clock_gettime', None)
+        if clock_gettime == None:
+            # older glibc versions have it in librt
+            clock_gettime = ctypes.CDLL(ctypes.util.find_library('rt'), use_errno=True).clock_gettime
+        clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(timespec)]
+        
+        def monotonic():
+            spec = timespec()
+            if clock_gettime(clockMonotonic, ctypes.byref(spec)) != 0:
+                raise OSError(ctypes.get_errno(), os.strerror(ctypes.get_errno()))
+            return spec.tv_sec + spec.tv_nsec * 1e-9
+        monotonic()
+        return monotonic
+    except (AttributeError, OSError, TypeError):
+        return None
+
+try:
+    from time import monotonic
+except ImportError:
+    monotonic = _osMonotonic()
+    if monotonic == None:
+        # the last resort. The users of the clock also handle it stepping back.
+        from time import time as monotonic
 
 class Chdir:    
     '''
@@ -24,6 +71,650 @@ class Chdir:
         os.chdir( self.savedPath )
 
 
+class RingBuffer(object):
+    '''
+    A fixed-size NumPy ring buffer.
+    Items are counted from the first one ever appended, so readers can keep their position and get only the items added since.
+    Appending and reading are thread safe.
+    '''
+    def __init__(self, capacity, dtype=float):
+        self.capacity = capacity
+        self.data = np.zeros(capacity, dtype)
+        self.count = 0
+        self.lock = Lock()
+        
+    def Append(self, values):
+        '''
+        Append an array of values. If the buffer is full, the oldest values are overwritten.
+        '''
+        values = np.asarray(values, self.data.dtype)
+        with self.lock:
+            total = len(values)
+            values = values[-self.capacity:]
+            start = (self.count + total - len(values)) % self.capacity
+            first = min(len(values), self.capacity - start)
+            self.data[start:start + first] = values[:first]
+            self.data[:len(values) - first] = values[first:]
+            self.count += total
+        
+    def Latest(self):
+        '''
+        Returns: the last value appended, or None if the buffer is empty
+        '''
+        with self.lock:
+            if self.count == 0:
+                return None
+            return self.data[(self.count - 1) % self.capacity]
+    
+    def GetSince(self, position):
+        '''
+        Get the values appended since position (but no more than the capacity of the buffer).
+        
+        Returns: (values, the position after the last value)
+        '''
+        with self.lock:
+            count = self.count
+            start = max(position, count - self.capacity)
+            startIdx = start % self.capacity
+            endIdx = startIdx + (count - start)
+            if endIdx <= self.capacity:
+                values = self.data[startIdx:endIdx].copy()
+            else:
+                values = np.concatenate((self.data[startIdx:], self.data[:endIdx - self.capacity]))
+            return values, count
+        
+
+class SignalHistory(object):
+    '''
+    The samples a SignalBuffer dropped from memory, kept in a temporary file that is memory-mapped for reading,
+    so only the parts that are read are loaded (by the OS, which can also evict them when memory is needed).
+    The file is deleted when it's closed (or when the program exits).
+    '''
+    def __init__(self, dtype, directory=None):
+        '''
+        dtype - the type of the values (not object)
+        directory - where to keep the file (None for the system's temporary directory)
+        '''
+        self.recordType = np.dtype([('time', np.float64), ('value', dtype)])
+        self.file = tempfile.TemporaryFile(dir=directory)
+        self.count = 0
+        self.mapped = None
+    
+    def Count(self):
+        '''
+        Returns: the number of samples in the file
+        '''
+        return self.count
+    
+    def Append(self, times, values):
+        '''
+        Append samples at the end of the file
+        '''
+        records = np.empty(len(times), self.recordType)
+        records['time'] = times
+        records['value'] = values
+        self.file.write(records.tostring())
+        self.count += len(records)
+    
+    def Times(self):
+        '''
+        Returns: a memory-mapped view of the sample times
+        '''
+        return self._map()['time']
+    
+    def Values(self):
+        '''
+        Returns: a memory-mapped view of the values
+        '''
+        return self._map()['value']
+    
+    def Close(self):
+        self.mapped = None
+        self.file.close()
+    
+    def _map(self):
+        '''
+        This function should be called only in this class
+        Map the file, again if it grew since it was last mapped. The file is only written at its end, so old mappings stay valid.
+        '''
+        if self.mapped is None or len(self.mapped) < self.count:
+            self.file.flush()
+            self.mapped = np.memmap(self.file, self.recordType, 'r', shape=(self.count,)) if self.count > 0 else np.empty(0, self.recordType)
+        return self.mapped
+
+
+class SignalBuffer(object):
+    '''
+    Preallocated NumPy storage for a signal: a column of sample times (float64, seconds since the epoch) and a column of values.
+    Only the latest windowChunks chunks of chunkRows samples are kept in memory. When the window is full, the oldest chunk is
+    passed to OnOverflow (if given) and dropped, so memory use doesn't grow during long runs.
+    Dropped chunks can be spilled to disk (see SignalHistory), and then the whole signal can still be read with IndexOf and Range.
+    The columns are contiguous, so Times() and Values() are views that can be plotted without copying.
+    Views are only valid until the next Append, which may move the samples when a chunk is dropped.
+    '''
+    def __init__(self, chunkRows=1024, windowChunks=16, dtype=np.float64, OnOverflow=None, spill=False, spillDirectory=None):
+        '''
+        dtype - the type of the values. None for a buffer of times only.
+        OnOverflow - called with the times and values of each dropped chunk (views, valid only during the call)
+        spill - keep the dropped chunks on disk (not for buffers of times only or of objects)
+        spillDirectory - where to keep them (None for the system's temporary directory)
+        '''
+        self.chunkRows = chunkRows
+        capacity = (windowChunks + 1) * chunkRows
+        self.times = np.zeros(capacity)
+        self.values = np.zeros(capacity, dtype) if dtype != None else None
+        self.fillValue = np.nan if dtype == None or np.dtype(dtype).kind == 'f' else None
+        self.length = 0
+        # the number of samples dropped so far, which is also the index of the first sample in memory
+        self.dropped = 0
+        self.OnOverflow = OnOverflow
+        self.history = SignalHistory(dtype, spillDirectory) if spill else None
+    
+    def __len__(self):
+        '''
+        Returns: the number of samples in memory
+        '''
+        return self.length
+    
+    def Count(self):
+        '''
+        Returns: the number of samples ever appended
+        '''
+        return self.dropped + self.length
+    
+    def Append(self, sampleTime, value=None):
+        '''
+        Append a sample. A value of None is stored as NaN in float buffers.
+        '''
+        if self.length == len(self.times):
+            self._dropChunk()
+        self.times[self.length] = sampleTime
+        if self.values is not None:
+            self.values[self.length] = value if value != None else self.fillValue
+        self.length += 1
+    
+    def Extend(self, times, values=None):
+        '''
+        Append samples from arrays (None values are stored as NaN in float buffers)
+        '''
+        total = len(times)
+        if self.values is not None:
+            values = np.asarray(values, self.values.dtype if self.values.dtype.kind != 'f' else np.float64)
+        appended = 0
+        while appended < total:
+            if self.length == len(self.times):
+                self._dropChunk()
+            count = min(total - appended, len(self.times) - self.length)
+            self.times[self.length:self.length + count] = times[appended:appended + count]
+            if self.values is not None:
+                self.values[self.length:self.length + count] = values[appended:appended + count]
+            self.length += count
+            appended += count
+    
+    def Times(self, start=0):
+        '''
+        Returns: a view of the sample times in memory, from index start (negative indices count from the end)
+        '''
+        return self.times[:self.length][start:]
+    
+    def Values(self, start=0):
+        '''
+        Returns: a view of the values in memory, from index start (negative indices count from the end)
+        '''
+        return self.values[:self.length][start:]
+    
+    def Last(self):
+        '''
+        Returns: the last value appended, or None if the buffer is empty
+        '''
+        if self.length == 0:
+            return None
+        return self.values[self.length - 1]
+    
+    def Close(self):
+        '''
+        Delete the samples spilled to disk (if any). The buffer shouldn't be used after that.
+        '''
+        if self.history != None:
+            self.history.Close()
+            self.history = None
+    
+    def IndexOf(self, sampleTimes):
+        '''
+        Find where sample times would be inserted to keep the times sorted (like np.searchsorted)
+        
+        Returns: the indices, counted from the first sample ever appended. Times before the samples that are kept give
+                 the index of the first sample kept.
+        '''
+        sampleTimes = np.asarray(sampleTimes)
+        indices = self.dropped + np.searchsorted(self.Times(), sampleTimes)
+        if self.history != None and self.history.Count() > 0 and self.length > 0:
+            inHistory = sampleTimes < self.times[0]
+            if inHistory.any():
+                indices = np.where(inHistory, np.searchsorted(self.history.Times(), sampleTimes), indices)
+        return indices
+    
+    def Range(self, first, last):
+        '''
+        Get the samples from index first up to index last (counted from the first sample ever appended, see IndexOf)
+        
+        Returns: (times, values). Views when all the samples are in memory, otherwise copies that include samples from the disk.
+        '''
+        first = max(first, 0 if self.history != None else self.dropped)
+        last = max(last, first)
+        if first >= self.dropped:
+            return self.Times()[first - self.dropped:last - self.dropped], self.Values()[first - self.dropped:last - self.dropped]
+        
+        historyTimes = self.history.Times()[first:last]
+        historyValues = self.history.Values()[first:last]
+        if last <= self.dropped:
+            return np.array(historyTimes), np.array(historyValues)
+        return (np.concatenate((historyTimes, self.Times()[:last - self.dropped])),
+                np.concatenate((historyValues, self.Values()[:last - self.dropped])))
+    
+    def _dropChunk(self):
+        '''
+        This function should be called only in this class
+        Drop the oldest chunk from memory
+        '''
+        chunkRows = self.chunkRows
+        if self.OnOverflow != None:
+            self.OnOverflow(self.times[:chunkRows], self.values[:chunkRows] if self.values is not None else None)
+        if self.history != None:
+            self.history.Append(self.times[:chunkRows], self.values[:chunkRows])
+        
+        keep = self.length - chunkRows
+        self.times[:keep] = self.times[chunkRows:self.length]
+        if self.values is not None:
+            self.values[:keep] = self.values[chunkRows:self.length]
+        self.length = keep
+        self.dropped += chunkRows
+
+
+class MinMaxPyramid(object):
+    '''
+    Lower resolution versions of a signal, for drawing long time spans with few points.
+    Level k holds bins of factor**k samples. Each bin keeps its first sample's time and its minimum and maximum (with their times),
+    so peaks aren't lost when a bin is drawn as two points.
+    The levels are updated incrementally as samples are appended, at an amortized constant cost per sample.
+    Like SignalBuffer, each level only keeps a bounded window in memory, and can spill older bins to disk.
+    '''
+    factor = 4
+    binType = np.dtype([('minTime', np.float64), ('min', np.float64), ('maxTime', np.float64), ('max', np.float64)])
+    
+    def __init__(self, chunkRows=1024, windowChunks=16, spill=False, spillDirectory=None):
+        '''
+        chunkRows, windowChunks, spill, spillDirectory - as for the raw signal (see SignalBuffer). The levels cover about the same time span.
+        '''
+        self.levels = [None]
+        self.partialBins = [None]
+        binSamples = self.factor
+        while binSamples <= chunkRows * windowChunks:
+            self.levels.append(SignalBuffer(max(1, chunkRows // binSamples), windowChunks, self.binType, spill=spill, spillDirectory=spillDirectory))
+            self.partialBins.append(None)
+            binSamples *= self.factor
+    
+    def Append(self, sampleTime, value=None):
+        '''
+        Add a raw sample. None and NaN values are skipped by the minimum and maximum (a bin of them only is NaN).
+        '''
+        value = value if value != None else np.nan
+        self._addToLevel(1, (sampleTime, sampleTime, value, sampleTime, value, 1))
+    
+    def Extend(self, times, values):
+        '''
+        Add raw samples from arrays (like Append, but the bins are computed with NumPy)
+        '''
+        times = np.asarray(times, np.float64)
+        values = np.asarray(values, np.float64)
+        bins = np.empty(len(times), self.binType)
+        bins['minTime'] = bins['maxTime'] = times
+        bins['min'] = bins['max'] = values
+        self._extendLevel(1, times, bins)
+    
+    def Close(self):
+        '''
+        Delete the bins spilled to disk (if any)
+        '''
+        for level in self.levels[1:]:
+            level.Close()
+    
+    def Decimate(self, signal, start, end, maxPoints):
+        '''
+        Get the signal between start and end with no more than about maxPoints points, from the highest resolution that allows it.
+        The points from one more span on each side are included, so the view can be panned a bit.
+        signal - the raw signal (a SignalBuffer). If it spills to disk, the pyramid should too, so old parts can be drawn.
+        
+        Returns: (times, values). Raw data that is in memory is returned as views, without copying.
+        '''
+        span = end - start
+        bounds = [start, end, start - span, end + span]
+        visibleFirst, visibleLast, first, last = signal.IndexOf(bounds)
+        if visibleLast - visibleFirst <= maxPoints or len(self.levels) == 1:
+            return signal.Range(first, last)
+        
+        for level in range(1, len(self.levels)):
+            visibleFirst, visibleLast, first, last = self.levels[level].IndexOf(bounds)
+            if 2 * (visibleLast - visibleFirst) <= maxPoints or level == len(self.levels) - 1:
+                break
+        
+        # the samples that aren't in a complete bin of this level yet are in the partial bins of this level and the ones below it
+        bins = self.levels[level].Range(first, last)[1]
+        partialBins = []
+        if last == self.levels[level].Count():
+            partialBins = [tuple(self.partialBins[k][1:5]) for k in range(level, 0, -1) if self.partialBins[k] != None]
+        if len(partialBins) > 0:
+            bins = np.concatenate((bins, np.array(partialBins, self.binType)))
+        
+        # each bin is drawn as its minimum and maximum, in the order they occurred
+        minFirst = bins['minTime'] <= bins['maxTime']
+        decimatedTimes = np.empty(2 * len(bins))
+        decimatedValues = np.empty(2 * len(bins))
+        decimatedTimes[0::2] = np.where(minFirst, bins['minTime'], bins['maxTime'])
+        decimatedTimes[1::2] = np.where(minFirst, bins['maxTime'], bins['minTime'])
+        decimatedValues[0::2] = np.where(minFirst, bins['min'], bins['max'])
+        decimatedValues[1::2] = np.where(minFirst, bins['max'], bins['min'])
+        return decimatedTimes, decimatedValues
+    
+    def _extendLevel(self, level, firstTimes, bins):
+        '''
+        This function should be called only in this class
+        Merge bins of the level below (or raw samples) into a level, and pass the complete bins up
+        firstTimes - the time of each bin's first sample
+        '''
+        if level >= len(self.levels) or len(bins) == 0:
+            return
+        
+        # complete the partial bin first
+        idx = 0
+        while self.partialBins[level] != None and idx < len(bins):
+            self._addToLevel(level, (firstTimes[idx],) + tuple(bins[idx]) + (1,))
+            idx += 1
+        
+        # merge the following bins in groups, with NaN values never chosen over real ones
+        groupsNum = (len(bins) - idx) // self.factor
+        if groupsNum > 0:
+            end = idx + groupsNum * self.factor
+            groups = bins[idx:end].reshape(groupsNum, self.factor)
+            rows = np.arange(groupsNum)
+            minIdx = np.where(np.isnan(groups['min']), np.inf, groups['min']).argmin(1)
+            maxIdx = np.where(np.isnan(groups['max']), -np.inf, groups['max']).argmax(1)
+            merged = np.empty(groupsNum, self.binType)
+            merged['minTime'] = groups['minTime'][rows, minIdx]
+            merged['min'] = groups['min'][rows, minIdx]
+            merged['maxTime'] = groups['maxTime'][rows, maxIdx]
+            merged['max'] = groups['max'][rows, maxIdx]
+            mergedFirstTimes = firstTimes[idx:end:self.factor]
+            self.levels[level].Extend(mergedFirstTimes, merged)
+            self._extendLevel(level + 1, mergedFirstTimes, merged)
+            idx = end
+        
+        # the rest start a new partial bin
+        for idx in range(idx, len(bins)):
+            self._addToLevel(level, (firstTimes[idx],) + tuple(bins[idx]) + (1,))
+    
+    def _addToLevel(self, level, newBin):
+        '''
+        This function should be called only in this class
+        Merge a bin of the level below (or a raw sample) into the partial bin of a level, and pass the bin up when it's complete
+        newBin - (first time, minimum time, minimum, maximum time, maximum, samples number)
+        '''
+        if level >= len(self.levels):
+            return
+        
+        partialBin = self.partialBins[level]
+        if partialBin == None:
+            partialBin = list(newBin[:5]) + [0]
+        else:
+            # NaN comparisons are False, so NaN values never replace real ones
+            if newBin[2] < partialBin[2] or partialBin[2] != partialBin[2]:
+                partialBin[1:3] = newBin[1:3]
+            if newBin[4] > partialBin[4] or partialBin[4] != partialBin[4]:
+                partialBin[3:5] = newBin[3:5]
+        partialBin[5] += 1
+        
+        if partialBin[5] < self.factor:
+            self.partialBins[level] = partialBin
+            return
+        self.partialBins[level] = None
+        self.levels[level].Append(partialBin[0], tuple(partialBin[1:5]))
+        self._addToLevel(level + 1, partialBin)
+
+
+class SubmittedData(object):
+    '''
+    Data that an AsyncFileWriter creates in its background thread, by calling CreateData(*args) (see AsyncFileWriter.Submit)
+    '''
+    def __init__(self, CreateData, args):
+        self.CreateData = CreateData
+        self.args = args
+
+
+class AsyncFileWriter(object):
+    '''
+    A file that is written by a background thread, so a slow disk (e.g. a network drive that stalls) doesn't block the writers.
+    Data is queued, and written in batches. The queue is bounded: when it's full (the disk is too slow, full or gone),
+    new data is dropped rather than blocking the writer, and the drops are counted (see Stats).
+    It has the writing methods of a file (write, flush, close), so it can be used instead of one.
+    The data is written to the file's descriptor as is, so the file should be opened in binary mode.
+    
+    The data reaches the disk according to the flush policy: after flushIntervalSec, after flushBytes were written,
+    or when asked to (flush, or Sync for critical events). Flushes can include an fsync.
+    Data can also be given as a function that creates it (see Submit), so e.g. formatting is done by the background thread too.
+    Unicode data is written in UTF-8.
+    '''
+    closeRetries = 5
+    
+    def __init__(self, file, maxQueuedBytes=16*1024*1024, maxQueuedItems=100000, flushIntervalSec=1, flushBytes=1024*1024, fsync=False):
+        '''
+        file - a file opened for writing
+        maxQueuedBytes, maxQueuedItems - the bound on the queue (data given as functions is counted as items only)
+        flushIntervalSec - the longest time data is kept unflushed (None for no limit)
+        flushBytes - flush after this many bytes were written since the last flush (None for no limit)
+        fsync - also make the OS write the flushed data to the disk
+        '''
+        self.file = file
+        self.maxQueuedBytes = maxQueuedBytes
+        self.maxQueuedItems = maxQueuedItems
+        self.flushIntervalSec = flushIntervalSec
+        self.flushBytes = flushBytes
+        self.fsync = fsync
+        
+        self.condition = Condition(Lock())
+        self.queue = []
+        self.queuedBytes = 0
+        self.flushRequested = False
+        self.syncRequested = False
+        self.closing = False
+        self.stats = {'writtenBytes': 0, 'peakQueuedBytes': 0, 'peakQueuedItems': 0, 'dropped': 0, 'droppedBytes': 0,
+                      'maxWriteSec': 0, 'errors': 0, 'lastError': None}
+        
+        self.thread = Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+    
+    def write(self, data):
+        '''
+        Queue data to be written
+        '''
+        self._enqueue(data, len(data))
+    
+    def Submit(self, CreateData, *args):
+        '''
+        Queue data that the background thread creates, by calling CreateData(*args). The arguments shouldn't change after they're passed.
+        '''
+        self._enqueue(SubmittedData(CreateData, args), 0)
+    
+    def flush(self):
+        '''
+        Have the queued data flushed as soon as it's written (doesn't wait for it)
+        '''
+        with self.condition:
+            self.flushRequested = True
+            self.condition.notify_all()
+    
+    def Sync(self):
+        '''
+        Have the queued data flushed and written to the disk (fsync) as soon as possible, e.g. after a critical event (doesn't wait for it)
+        '''
+        with self.condition:
+            self.flushRequested = True
+            self.syncRequested = True
+            self.condition.notify_all()
+    
+    def close(self):
+        '''
+        Write all the queued data, flush it to the disk and close the file. Waits for the background thread.
+        '''
+        with self.condition:
+            self.closing = True
+            self.condition.notify_all()
+        self.thread.join()
+    
+    @property
+    def name(self):
+        return self.file.name
+    
+    @property
+    def closed(self):
+        return self.closing
+    
+    def Stats(self):
+        '''
+        Returns: a dictionary of the writer's metrics: the bytes written so far, the queue's current and peak sizes,
+                 how many writes (and bytes) were dropped because the queue was full, the longest write,
+                 and the errors (of writing, or of creating submitted data)
+        '''
+        with self.condition:
+            stats = dict(self.stats)
+            stats['queuedBytes'] = self.queuedBytes
+            stats['queuedItems'] = len(self.queue)
+        return stats
+    
+    def _enqueue(self, item, size):
+        '''
+        This function should be called only in this class
+        '''
+        with self.condition:
+            if self.closing:
+                raise ValueError('I/O operation on closed file')
+            if self._isFull():
+                self.stats['dropped'] += 1
+                self.stats['droppedBytes'] += size
+                return
+            
+            self.queue.append(item)
+            self.queuedBytes += size
+            self.stats['peakQueuedBytes'] = max(self.stats['peakQueuedBytes'], self.queuedBytes)
+            self.stats['peakQueuedItems'] = max(self.stats['peakQueuedItems'], len(self.queue))
+            self.condition.notify_all()
+    
+    def _isFull(self):
+        '''
+        This function should be called only in this class
+        '''
+        return len(self.queue) > 0 and (self.queuedBytes >= self.maxQueuedBytes or len(self.queue) >= self.maxQueuedItems)
+    
+    def _run(self):
+        '''
+        This function should be called only in this class
+        The background thread: write the queued data in batches, and flush it according to the policy
+        '''
+        lastFlush = monotonic()
+        unflushed = []
+        unflushedBytes = 0
+        while True:
+            with self.condition:
+                while len(self.queue) == 0 and not self.flushRequested and not self.closing:
+                    timeout = None
+                    if self.flushIntervalSec != None and unflushedBytes > 0:
+                        timeout = max(0, lastFlush + self.flushIntervalSec - monotonic())
+                        if timeout == 0:
+                            break
+                    self.condition.wait(timeout)
+                
+                items = self.queue
+                self.queue = []
+                queuedBytes = self.queuedBytes
+                self.queuedBytes = 0
+                flush = self.flushRequested or self.closing
+                sync = self.syncRequested or (self.closing and self.fsync)
+                self.flushRequested = self.syncRequested = False
+                closing = self.closing
+            
+            # the data is kept until it's flushed, and then written at once
+            created = [self._create(item) for item in items]
+            unflushed += created
+            unflushedBytes += sum(len(data) for data in created)
+            flush = flush or (self.flushBytes != None and unflushedBytes >= self.flushBytes) or \
+                    (self.flushIntervalSec != None and unflushedBytes > 0 and monotonic() - lastFlush >= self.flushIntervalSec)
+            if flush:
+                self._write(''.join(unflushed), sync or self.fsync)
+                lastFlush = monotonic()
+                unflushed = []
+                unflushedBytes = 0
+            
+            if closing:
+                self.file.close()
+                return
+    
+    def _create(self, item):
+        '''
+        This function should be called only in this class
+        Create the data of a queued item (see Submit), and encode it. 
+        Errors are counted, and the item is skipped, so the following data is still written.
+        
+        Returns: the item's data, as a string
+        '''
+        try:
+            data = item.CreateData(*item.args) if isinstance(item, SubmittedData) else item
+            if isinstance(data, unicode):
+                data = data.encode('utf-8')
+            if not isinstance(data, str):
+                raise TypeError('Only strings can be written, not %s' % type(data).__name__)
+            return data
+        except Exception as e:
+            with self.condition:
+                self.stats['errors'] += 1
+                self.stats['lastError'] = str(e)
+            return ''
+    
+    def _write(self, data, sync):
+        '''
+        This function should be called only in this class
+        Write data (and fsync it), retrying after errors (e.g. while a network drive is unavailable).
+        The data is written with os.write, which tells how much was written, so a retry continues where the failed write stopped.
+        Meanwhile, new data is dropped once the queue is full (see _enqueue).
+        When the file is being closed, it's only retried closeRetries times.
+        '''
+        written = 0
+        retries = 0
+        while True:
+            writeStart = monotonic()
+            try:
+                while written < len(data):
+                    count = os.write(self.file.fileno(), data[written:])
+                    written += count
+                    with self.condition:
+                        self.stats['writtenBytes'] += count
+                if sync:
+                    os.fsync(self.file.fileno())
+            except (IOError, OSError) as e:
+                with self.condition:
+                    self.stats['errors'] += 1
+                    self.stats['lastError'] = str(e)
+                    closing = self.closing
+                if closing and retries >= self.closeRetries:
+                    return
+                retries += 1
+                time.sleep(1)
+                continue
+            
+            with self.condition:
+                self.stats['maxWriteSec'] = max(self.stats['maxWriteSec'], monotonic() - writeStart)
+            return
+
+
 """
 Lists the serial ports available on the computer.
 some of the code was taken from Eli Bendersky (eliben@gmail.com), License: this code is in the public domain
@@ -64,9 +755,22 @@ class SerialUtil():
                 for portname in self.enumerate_serial_ports():
                     ports.append(portname)
             elif os.name == 'posix':
-                ports = glob.glob('/dev/tty*')
+                # pseudo-terminals are listed too, for simulated devices (see controllers.arduino.simulator)
+                ports = glob.glob('/dev/tty*') + glob.glob('/dev/pts/[0-9]*')
                 
             return ports
+    
+    def getSerialPortsInfo(self):
+        '''
+        List the serial ports with their USB identification (taken from sysfs on Linux), when it's available
+        
+        Returns: a list of (port name, USB vendor id, USB serial number). The USB fields are None for non-USB ports.
+        '''
+        try:
+            from serial.tools import list_ports
+            return [(info.device, info.vid, info.serial_number) for info in list_ports.comports()]
+        except (ImportError, AttributeError):
+            return [(port, None, None) for port in self.getSerialPortsList()]
         
 if __name__ == '__main__':
     print SerialUtil().getSerialPortsList()
\ No newline at end of file
@@ -4,7 +4,7 @@ ez_setup.use_setuptools()
 from setuptools import setup, find_packages
 
 setup(install_requires = ['wxPython', 'pyserial', 'matplotlib', 'numpy', 'ez_setup'],
-      packages=find_packages(),
+      packages=find_packages(exclude=['tests']),
       package_data={'': ['*.png', '*.xrc', '*.dll']},
       zip_safe=True,
 
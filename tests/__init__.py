@@ -0,0 +1,4 @@
+'''
+Regression tests. The Arduino's tests run against the controlino simulator (see controllers.arduino.simulator), so no board is needed.
+Run them with: python -m unittest discover tests
+'''
@@ -0,0 +1,191 @@
+from __future__ import division
+__author__ = 'yoelk'
+
+import os
+import time
+import shutil
+import tempfile
+import unittest
+from threading import Thread, Event
+from instrumentino import cfg
+from instrumentino.controllers.arduino import Arduino
+
+def WaitFor(condition, timeoutSec=5):
+    '''
+    Poll a condition until it's true
+
+    Returns: True if the condition became true before timeoutSec
+    '''
+    deadline = time.time() + timeoutSec
+    while not condition():
+        if time.time() > deadline:
+            return False
+        time.sleep(0.01)
+    return True
+
+
+@unittest.skipUnless(os.name == 'posix', 'the simulator runs on a pseudo-terminal')
+class ArduinoTestCase(unittest.TestCase):
+    '''
+    Connect an Arduino to a simulated board. The events the Arduino logs are kept in logs, rather than shown in the GUI.
+    '''
+    binary = True
+
+    def setUp(self):
+        from instrumentino.controllers.arduino.simulator import ControlinoSimulator
+        self.logs = []
+        self.LogFromOtherThread = cfg.LogFromOtherThread
+        cfg.LogFromOtherThread = lambda text, critical=False: self.logs.append(text)
+
+        self.simulator = ControlinoSimulator(latencySec=0.001, seed=1)
+        self.arduino = Arduino()
+        self.arduino.useBinaryProtocol = self.binary
+        self.assertTrue(self.arduino.Connect(self.simulator.Start()))
+
+    def tearDown(self):
+        self.arduino.Close()
+        self.simulator.Stop()
+        cfg.LogFromOtherThread = self.LogFromOtherThread
+
+    def OccupyAcquisitionThread(self):
+        '''
+        Keep the acquisition thread busy, so the commands wait in the queue
+
+        Returns: an event that releases the thread
+        '''
+        occupied = Event()
+        release = Event()
+        def occupy():
+            occupied.set()
+            release.wait()
+        thread = Thread(target=self.arduino._transact, args=(occupy,))
+        thread.daemon = True
+        thread.start()
+        self.assertTrue(occupied.wait(5))
+        return release
+
+
+class TestBinaryProtocol(ArduinoTestCase):
+    def testConnect(self):
+        self.assertNotEqual(self.arduino.protocol, None)
+        self.assertTrue(self.simulator.binary)
+
+    def testRead(self):
+        self.simulator.SetAnalogInput(0, 700)
+        self.simulator.SetAnalogInput(1, lambda t: 300)
+        self.assertTrue(WaitFor(lambda: self.arduino.AnalogRead(0) == 700 and self.arduino.AnalogRead(1) == 300))
+        self.assertAlmostEqual(self.arduino.AnalogReadTime(0), time.time(), delta=2)
+
+    def testWrite(self):
+        self.arduino.DigitalWrite(5, 1)
+        self.arduino.AnalogWrite(6, 128)
+        self.assertEqual(self.simulator.digitalValues.get(5), 1)
+        self.assertEqual(self.simulator.pwmValues.get(6), 128)
+
+    def testBatch(self):
+        executed = self.simulator.commandsExecuted
+        with self.arduino.Batch():
+            for pin in range(2, 8):
+                self.arduino.DigitalWrite(pin, 1)
+        self.assertEqual([self.simulator.digitalValues.get(pin) for pin in range(2, 8)], [1] * 6)
+        # the batch itself is a command too
+        self.assertGreaterEqual(self.simulator.commandsExecuted - executed, 6)
+
+    def testPipeline(self):
+        with self.arduino.Pipeline() as replies:
+            for pin in range(2, 8):
+                self.arduino.DigitalWrite(pin, pin % 2)
+        self.assertEqual(len(replies), 6)
+        self.assertNotIn(None, replies)
+        self.assertEqual([self.simulator.digitalValues.get(pin) for pin in range(2, 8)], [pin % 2 for pin in range(2, 8)])
+
+    def testPipelineTimedOut(self):
+        release = self.OccupyAcquisitionThread()
+        self.arduino.commandTimeoutSec = 0.2
+        try:
+            with self.arduino.Pipeline() as replies:
+                for pin in range(2, 5):
+                    self.arduino.DigitalWrite(pin, 1)
+        finally:
+            release.set()
+        self.assertEqual(replies, [None] * 3)
+        self.assertTrue(any('timed out' in text for text in self.logs))
+
+    def testPipelineCancelled(self):
+        release = self.OccupyAcquisitionThread()
+        result = {}
+        def pipeline():
+            with self.arduino.Pipeline() as replies:
+                for pin in range(2, 5):
+                    self.arduino.DigitalWrite(pin, 1)
+            result['replies'] = replies
+        thread = Thread(target=pipeline)
+        thread.start()
+        try:
+            self.assertTrue(WaitFor(lambda: not self.arduino.commandQueue.empty()))
+            self.arduino.CancelCommands()
+            thread.join(5)
+        finally:
+            release.set()
+        self.assertEqual(result.get('replies'), [None] * 3)
+        self.assertEqual([self.simulator.digitalValues.get(pin) for pin in range(2, 5)], [None] * 3)
+
+    def testStreaming(self):
+        # the streamed samples are logged to a file in the log directory
+        logDirectory = tempfile.mkdtemp()
+        initialPath, cfg.initial_path = cfg.initial_path, logDirectory
+        cfg.timeNow = getattr(cfg, 'timeNow', 'test')
+        try:
+            self.simulator.SetAnalogInput(2, 400)
+            self.assertTrue(self.arduino.StreamAnalogPin(2, 500))
+            self.assertTrue(WaitFor(lambda: len(self.arduino.GetStreamedSamples()[0]) >= 100))
+            times, values, _ = self.arduino.GetStreamedSamples()
+            self.assertTrue((values['A2'][:len(times)] == 400).all())
+            self.assertTrue((times[1:] >= times[:-1]).all())
+            self.assertEqual(self.arduino.AnalogRead(2), 400)
+            self.arduino.StopStreaming()
+            self.assertEqual(self.simulator.streamPeriodUs, None)
+        finally:
+            self.arduino.Close()
+            cfg.initial_path = initialPath
+            shutil.rmtree(logDirectory)
+
+
+class TestAsciiProtocol(ArduinoTestCase):
+    binary = False
+
+    def testConnect(self):
+        self.assertEqual(self.arduino.protocol, None)
+        self.assertFalse(self.simulator.binary)
+
+    def testRead(self):
+        self.simulator.SetAnalogInput(0, 123)
+        self.assertTrue(WaitFor(lambda: self.arduino.AnalogRead(0) == 123))
+
+    def testWrite(self):
+        self.arduino.DigitalWrite(5, 1)
+        self.arduino.AnalogWrite(6, 200)
+        self.assertEqual(self.simulator.digitalValues.get(5), 1)
+        self.assertEqual(self.simulator.pwmValues.get(6), 200)
+
+    def testBatch(self):
+        # without batches, the commands are sent one by one
+        with self.arduino.Batch():
+            for pin in range(2, 5):
+                self.arduino.DigitalWrite(pin, 1)
+        self.assertEqual([self.simulator.digitalValues.get(pin) for pin in range(2, 5)], [1] * 3)
+
+    def testPipeline(self):
+        with self.arduino.Pipeline() as replies:
+            for pin in range(2, 5):
+                self.arduino.DigitalWrite(pin, 1)
+        self.assertEqual(len(replies), 3)
+        self.assertNotIn(None, replies)
+
+    def testStreaming(self):
+        # streaming requires the binary protocol
+        self.assertFalse(self.arduino.StreamAnalogPin(2, 500))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,100 @@
+from __future__ import division
+__author__ = 'yoelk'
+
+import os
+import shutil
+import tempfile
+import unittest
+import numpy as np
+from instrumentino.signal_log import SignalLogWriter, SignalLogReader
+from instrumentino.replay import SignalLogReplay
+
+class RecordingGraph(object):
+    '''
+    Keeps the rows a replay adds, instead of showing them (see LogGraphPanel.AddRows)
+    '''
+    def __init__(self):
+        self.Clear()
+
+    def Clear(self):
+        self.times = []
+        self.rows = {}
+
+    def AddRows(self, times, rows):
+        self.times += list(times)
+        for name, values in rows.items():
+            self.rows.setdefault(name, []).extend(values)
+
+
+class TestReplay(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'log.isig')
+        # rows are clamped to stay sorted, so several rows can have the same time, also across blocks
+        self.times = 1400000000 + np.array([0, 1, 2, 3, 3, 3, 3, 4, 5, 6, 7, 8], np.float64)
+        self.values = np.arange(len(self.times), dtype=np.float64)
+        self.states = ['off', 'on'] * (len(self.times) // 2)
+        writer = SignalLogWriter(self.path, [{'name': 'voltage', 'kind': 'analog'}, {'name': 'valve', 'kind': 'digital', 'states': []}],
+                                 blockRows=4)
+        writer.Append(self.times[:4], [self.values[:4], self.states[:4]])
+        writer.Append(self.times[4:], [self.values[4:], self.states[4:]])
+        writer.Close()
+        self.graph = RecordingGraph()
+        self.replay = SignalLogReplay(SignalLogReader(self.path), self.graph)
+
+    def tearDown(self):
+        self.replay.Close()
+        shutil.rmtree(self.directory)
+
+    def Advance(self, sec):
+        '''
+        Tick as if sec seconds passed since the last tick
+        '''
+        self.replay.lastTick -= sec
+        return self.replay.Tick()
+
+    def testPlay(self):
+        self.replay.Seek(self.replay.start)
+        self.assertEqual(self.graph.times, [self.times[0]])
+        self.replay.Play(speed=2)
+        self.assertTrue(self.Advance(1))
+        self.assertEqual(self.graph.times, list(self.times[:3]))
+        # the rows of the next block with the same time are added too, and only once
+        self.assertTrue(self.Advance(0.5))
+        self.assertEqual(self.graph.rows['voltage'], list(self.values[:7]))
+        self.assertFalse(self.Advance(10))
+        self.assertEqual(self.graph.times, list(self.times))
+        self.assertEqual(self.graph.rows['voltage'], list(self.values))
+        self.assertEqual(list(self.graph.rows['valve']), self.states)
+        self.assertEqual(self.replay.error, None)
+
+    def testSeek(self):
+        # the graph shows the history before the position
+        self.replay.Seek(self.times[8], historySec=2)
+        self.assertEqual(self.graph.times, list(self.times[3:9]))
+        self.replay.Seek(self.times[2])
+        self.assertEqual(self.graph.times, [self.times[2]])
+
+    def testSpeed(self):
+        self.replay.SetSpeed(10 * SignalLogReplay.maxSpeed)
+        self.assertEqual(self.replay.speed, SignalLogReplay.maxSpeed)
+        self.replay.SetSpeed(0)
+        self.assertEqual(self.replay.speed, SignalLogReplay.minSpeed)
+
+    def testReadError(self):
+        # the second block can't be read
+        readBlocks = self.replay.reader.ReadBlocks
+        def ReadBlocks(start=None, end=None, names=None):
+            blocks = readBlocks(start, end, names)
+            yield next(blocks)
+            raise IOError('the log is gone')
+        self.replay.reader.ReadBlocks = ReadBlocks
+        self.replay.Seek(self.replay.start)
+        self.replay.Play()
+        self.assertFalse(self.Advance(10))
+        self.assertEqual(self.replay.error, 'the log is gone')
+        self.assertEqual(self.graph.times, list(self.times[:4]))
+
+
+if __name__ == '__main__':
+    unittest.main()
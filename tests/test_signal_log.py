@@ -0,0 +1,147 @@
+from __future__ import division
+__author__ = 'yoelk'
+
+import os
+import shutil
+import tempfile
+import unittest
+import numpy as np
+from instrumentino import signal_log, signal_store
+from instrumentino.signal_log import SignalLogWriter, SignalLogReader, SignalCsvExporter, SignalCsvReader
+from instrumentino.signal_store import SignalStoreWriter, SignalStore
+
+variables = [{'name': 'voltage', 'kind': 'analog', 'range': [0, 5]},
+             {'name': 'valve', 'kind': 'digital', 'states': ['off', 'on']}]
+
+def Rows(rowsNum, start=1400000000):
+    '''
+    Returns: (rows' times, the variables' columns, the variables' sample times). The voltage has a NaN, and the valve gets a new state.
+    '''
+    times = start + np.arange(rowsNum) * 0.25
+    voltage = np.sin(np.arange(rowsNum) / 10)
+    voltage[3] = np.nan
+    valve = np.array(['off', 'on', 'open'] * (rowsNum // 3) + ['off'] * (rowsNum % 3), object)
+    return times, [voltage, valve], [times - 0.1, times - 0.2]
+
+
+class SignalLogTestCase(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def Path(self, name):
+        return os.path.join(self.directory, name)
+
+
+class TestSignalLog(SignalLogTestCase):
+    def Write(self, path, rows, sampleTimes=False, compress=True, close=True):
+        times, columns, variableTimes = rows
+        writer = SignalLogWriter(path, variables, compress=compress, blockRows=64, sampleTimes=sampleTimes)
+        # in parts that don't match the blocks
+        for start in range(0, len(times), 50):
+            writer.Append(times[start:start + 50], [column[start:start + 50] for column in columns],
+                          [column[start:start + 50] for column in variableTimes])
+        if close:
+            writer.Close()
+        else:
+            writer.Flush()
+            writer.file.close()
+
+    def CheckRoundTrip(self, path, rows):
+        times, (voltage, valve), _ = rows
+        reader = signal_log.OpenSignalLog(path)
+        self.assertEqual(reader.names, ['voltage', 'valve'])
+        self.assertEqual(reader.TimeRange(), (times[0], times[-1]))
+        readTimes, readVoltage = reader.Read('voltage')
+        np.testing.assert_array_equal(readVoltage, voltage)
+        # a CSV log's states are known once they're read
+        codes = reader.Read('valve')[1]
+        readValve = np.array(reader.States('valve'), object)[codes]
+        self.assertEqual(list(readValve), list(valve))
+
+        # a time range
+        blocks = list(reader.ReadBlocks(times[100], times[199]))
+        np.testing.assert_array_equal(np.concatenate([blockTimes for blockTimes, _ in blocks]), times[100:200])
+        reader.Close()
+        return readTimes
+
+    def testRoundTrip(self):
+        rows = Rows(500)
+        for compress in (True, False):
+            self.Write(self.Path('log.isig'), rows, compress=compress)
+            np.testing.assert_array_equal(self.CheckRoundTrip(self.Path('log.isig'), rows), rows[0])
+
+    def testSampleTimes(self):
+        rows = Rows(500)
+        self.Write(self.Path('log.isig'), rows, sampleTimes=True)
+        reader = SignalLogReader(self.Path('log.isig'))
+        np.testing.assert_array_equal(reader.Read('voltage')[0], rows[2][0])
+        np.testing.assert_array_equal(reader.Read('valve', rows[0][10], rows[0][19])[0], rows[2][1][10:20])
+        # the rows keep their own times
+        np.testing.assert_array_equal(np.concatenate([times for times, _ in reader.ReadBlocks()]), rows[0])
+        reader.Close()
+
+    def testWithoutFooter(self):
+        # e.g. the program didn't close properly
+        rows = Rows(500)
+        self.Write(self.Path('log.isig'), rows, close=False)
+        self.CheckRoundTrip(self.Path('log.isig'), rows)
+
+    def testCsvRoundTrip(self):
+        rows = Rows(500)
+        self.Write(self.Path('log.isig'), rows)
+        reader = SignalLogReader(self.Path('log.isig'))
+        reader.ExportCsv(self.Path('log.csv'), timeFormat='iso')
+        reader.Close()
+        self.CheckRoundTrip(self.Path('log.csv'), rows)
+
+    def testCsvPartialLine(self):
+        # the last line may still be being written
+        times, columns, _ = Rows(10)
+        exporter = SignalCsvExporter(['voltage', 'valve'], timeFormat='iso')
+        with open(self.Path('log.csv'), 'wb') as csvFile:
+            csvFile.write(exporter.Header() + exporter.FormatRows(times, columns))
+            csvFile.write(exporter.FormatRows(times[:1] + 10, [column[:1] for column in columns])[:12])
+        reader = SignalCsvReader(self.Path('log.csv'))
+        self.assertEqual(reader.TimeRange()[1], times[-1])
+        np.testing.assert_array_equal(reader.Read('voltage')[1], columns[0])
+        reader.Close()
+
+
+class TestSignalStore(SignalLogTestCase):
+    def testRoundTrip(self):
+        times, (voltage, valve), variableTimes = Rows(500)
+        writer = SignalStoreWriter(self.Path('log' + signal_store.fileExtension), variables, batchRows=64)
+        for start in range(0, len(times), 50):
+            writer.Append(times[start:start + 50], [voltage[start:start + 50], valve[start:start + 50]],
+                          [column[start:start + 50] for column in variableTimes])
+        writer.Close()
+        self.assertEqual(writer.Stats()['dropped'], 0)
+
+        store = SignalStore(self.Path('log' + signal_store.fileExtension))
+        self.assertEqual([variable['name'] for variable in store.Variables()], ['voltage', 'valve'])
+        self.assertEqual(store.Variables()[0]['range'], [0, 5])
+        self.assertEqual(store.TimeRange('voltage'), (variableTimes[0][0], variableTimes[0][-1]))
+        readTimes, readVoltage = store.Read('voltage')
+        np.testing.assert_array_equal(readTimes, variableTimes[0])
+        np.testing.assert_array_equal(readVoltage, voltage)
+        readTimes, codes = store.Read('valve', variableTimes[1][10], variableTimes[1][19])
+        np.testing.assert_array_equal(readTimes, variableTimes[1][10:20])
+        self.assertEqual([store.States('valve')[int(code)] for code in codes], list(valve[10:20]))
+        store.Close()
+
+    def testRepeatedValues(self):
+        # a value repeated in several rows (its variable wasn't read again) is kept once
+        times = np.arange(10.)
+        writer = SignalStoreWriter(self.Path('log' + signal_store.fileExtension), variables[:1])
+        writer.Append(times, [np.repeat([1., 2.], 5)], [np.repeat([0., 5.], 5)])
+        writer.Close()
+        store = SignalStore(self.Path('log' + signal_store.fileExtension))
+        np.testing.assert_array_equal(store.Read('voltage')[0], [0, 5])
+        store.Close()
+
+
+if __name__ == '__main__':
+    unittest.main()